@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+Generate seeded synthetic legend / bgzipped VCF pairs for benchmarking
+check_allele_switch.py.
+
+Sites are generated in position order in a single streaming pass, so memory
+use stays flat even for 80M-site panels. Shared (target + reference) sites
+are drawn with exact counts for each allele class, and the expected counts
+are written next to the data so benchmark runs can be checked for
+correctness as well as speed.
+
+Usage:
+    generate_data.py --sites 10M [--target-sites 2M] [--overlap 0.8] [--switch 0.02] [--seed 1] [--outdir bench_data]
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+
+import bgzf
+from check_allele_switch import ALLELE_STATUSES, classify_alleles
+
+BASES = 'ACGT'
+COMPLEMENT = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A'}
+# Non-palindromic REF/ALT pairs, so every allele class is unambiguous
+PAIRS = [(r, a) for r in BASES for a in BASES if r != a and COMPLEMENT[r] != a]
+GENOTYPES = ('0|0', '0|1', '1|0', '1|1')
+GENOTYPE_POOL_SIZE = 256
+START_POSITION = 10_000_000
+LEGEND_HEADER = "ID\tCHROM\tPOS\tREF\tALT\tAAF_AFR\tAAF_ALL\tMAF_AFR\tMAF_ALL\n"
+
+
+def parse_count(text):
+    """Parse a site count such as 500000, 1M or 80M"""
+    multipliers = {'K': 1_000, 'M': 1_000_000, 'G': 1_000_000_000}
+    text = text.strip().upper()
+    if text and text[-1] in multipliers:
+        return int(float(text[:-1]) * multipliers[text[-1]])
+    return int(text)
+
+
+def target_alleles(status, ref, alt):
+    """Target REF/ALT that classify as status against the reference pair"""
+    if status == "MATCH":
+        return ref, alt
+    if status == "SWITCH":
+        return alt, ref
+    if status == "COMPLEMENT":
+        return COMPLEMENT[ref], COMPLEMENT[alt]
+    if status == "COMPLEMENT_SWITCH":
+        return COMPLEMENT[alt], COMPLEMENT[ref]
+    # OTHER: keep REF, pick an ALT that is neither the reference ALT nor its complement
+    for other in BASES:
+        if classify_alleles(ref, other, ref, alt) == "OTHER" and other != ref:
+            return ref, other
+    raise ValueError(f"no OTHER allele for {ref}/{alt}")
+
+
+def allocate(total, fractions):
+    """Split total into exact per-class counts; MATCH takes the remainder"""
+    counts = {status: int(round(total * fractions.get(status, 0.0))) for status in ALLELE_STATUSES if status != "MATCH"}
+    counts["MATCH"] = total - sum(counts.values())
+    if counts["MATCH"] < 0:
+        raise ValueError("class fractions add up to more than 1")
+    return counts
+
+
+def generate(args):
+    rng = random.Random(args.seed)
+    num_ref = args.sites
+    num_target = args.target_sites if args.target_sites is not None else num_ref
+    num_shared = int(round(num_target * args.overlap))
+    if num_shared > num_ref:
+        raise ValueError(f"overlap needs {num_shared:,} shared sites but the reference only has {num_ref:,}")
+    class_counts = allocate(num_shared, {"SWITCH": args.switch, "COMPLEMENT": args.complement,
+                                         "COMPLEMENT_SWITCH": args.complement_switch, "OTHER": args.other})
+
+    os.makedirs(args.outdir, exist_ok=True)
+    prefix = os.path.join(args.outdir, args.prefix or f"bench_{args.chrom}_{args.sites_label}")
+    legend_path = f"{prefix}.legend.gz"
+    vcf_path = f"{prefix}.vcf.gz"
+
+    samples = [f"S{i + 1}" for i in range(args.samples)]
+    genotype_pool = ['\t'.join(rng.choice(GENOTYPES) for _ in samples) for _ in range(GENOTYPE_POOL_SIZE)]
+    total_sites = num_ref + num_target - num_shared
+    mean_gap = args.mean_gap or max(1, 40_000_000 // max(total_sites, 1))
+
+    # Remaining draws per category; each step picks one with probability proportional to what is left
+    remaining = {"ref_only": num_ref - num_shared, "target_only": num_target - num_shared}
+    remaining_classes = dict(class_counts)
+    remaining_shared = num_shared
+    chrom = args.chrom
+    position = START_POSITION
+
+    with bgzf.BgzfWriter(legend_path) as legend, bgzf.BgzfWriter(vcf_path) as vcf:
+        legend.write(LEGEND_HEADER.encode())
+        vcf.write((
+            "##fileformat=VCFv4.2\n"
+            "##reference=GRCh38\n"
+            f"##contig=<ID={chrom}>\n"
+            '##INFO=<ID=AC,Number=A,Type=Integer,Description="Allele count">\n'
+            '##INFO=<ID=AN,Number=1,Type=Integer,Description="Total alleles">\n'
+            '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n'
+            "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t" + "\t".join(samples) + "\n").encode())
+
+        legend_lines = []
+        vcf_lines = []
+        an = 2 * len(samples)
+        for left in range(total_sites, 0, -1):
+            position += rng.randint(1, 2 * mean_gap - 1)
+            pick = rng.random() * left
+            ref, alt = rng.choice(PAIRS)
+            if pick < remaining_shared:
+                pick = rng.random() * remaining_shared
+                for status, count in remaining_classes.items():
+                    if pick < count:
+                        break
+                    pick -= count
+                remaining_classes[status] -= 1
+                remaining_shared -= 1
+                legend_lines.append(f"{chrom}:{position}:{ref}:{alt}\t{chrom}\t{position}\t{ref}\t{alt}\t.\t.\t.\t.\n")
+                vcf_ref, vcf_alt = target_alleles(status, ref, alt)
+            elif pick < remaining_shared + remaining["ref_only"]:
+                remaining["ref_only"] -= 1
+                legend_lines.append(f"{chrom}:{position}:{ref}:{alt}\t{chrom}\t{position}\t{ref}\t{alt}\t.\t.\t.\t.\n")
+                vcf_ref = None
+            else:
+                remaining["target_only"] -= 1
+                vcf_ref, vcf_alt = ref, alt
+            if vcf_ref is not None:
+                vcf_lines.append(f"{chrom}\t{position}\tbench{position}\t{vcf_ref}\t{vcf_alt}\t.\tPASS\t"
+                                 f"AC=1;AN={an}\tGT\t{genotype_pool[position % GENOTYPE_POOL_SIZE]}\n")
+            if len(vcf_lines) >= 10000 or len(legend_lines) >= 10000:
+                legend.write(''.join(legend_lines).encode())
+                vcf.write(''.join(vcf_lines).encode())
+                legend_lines.clear()
+                vcf_lines.clear()
+        legend.write(''.join(legend_lines).encode())
+        vcf.write(''.join(vcf_lines).encode())
+
+    expected = {
+        "legend": os.path.basename(legend_path),
+        "vcf": os.path.basename(vcf_path),
+        "seed": args.seed,
+        "totals": {"target": num_target, "reference": num_ref, "common": num_shared},
+        "counts": class_counts,
+    }
+    with open(f"{prefix}.expected.json", "w") as out:
+        json.dump(expected, out, indent=2)
+        out.write("\n")
+    return legend_path, vcf_path, expected
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic legend/VCF pairs for benchmarks')
+    parser.add_argument('--sites', default='1M', help='Reference legend sites, e.g. 1M, 10M, 80M (default: 1M)')
+    parser.add_argument('--target-sites', help='Target VCF sites (default: same as --sites)')
+    parser.add_argument('--overlap', type=float, default=0.8, help='Fraction of target sites also in the reference (default: 0.8)')
+    parser.add_argument('--switch', type=float, default=0.02, help='Fraction of shared sites with REF/ALT switched (default: 0.02)')
+    parser.add_argument('--complement', type=float, default=0.01, help='Fraction of shared sites on the other strand (default: 0.01)')
+    parser.add_argument('--complement-switch', type=float, default=0.005, help='Fraction complemented and switched (default: 0.005)')
+    parser.add_argument('--other', type=float, default=0.005, help='Fraction with unrelated alleles (default: 0.005)')
+    parser.add_argument('--samples', type=int, default=10, help='Genotype columns in the VCF (default: 10)')
+    parser.add_argument('--mean-gap', type=int, help='Mean distance between sites (default: spread over ~40 Mb)')
+    parser.add_argument('--chrom', default='chr22', help='Chromosome name (default: chr22)')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed (default: 1)')
+    parser.add_argument('--prefix', help='Output file prefix (default: bench_<chrom>_<sites>)')
+    parser.add_argument('--outdir', default='bench_data', help='Output directory (default: bench_data)')
+    args = parser.parse_args()
+
+    args.sites_label = args.sites.strip()
+    args.sites = parse_count(args.sites)
+    if args.target_sites is not None:
+        args.target_sites = parse_count(args.target_sites)
+
+    try:
+        legend_path, vcf_path, expected = generate(args)
+    except ValueError as e:
+        print(f"ERROR: {e}")
+        sys.exit(1)
+    print(f"Wrote {legend_path} ({expected['totals']['reference']:,} sites)")
+    print(f"Wrote {vcf_path} ({expected['totals']['target']:,} sites, {expected['totals']['common']:,} shared)")
+    print("Expected counts: " + ", ".join(f"{k}={v:,}" for k, v in expected['counts'].items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Phase benchmark for check_allele_switch.py.
+
+Runs the in-memory check on one legend/VCF pair with --trace and records
+the per-phase timings the checker itself reports (reference parsing,
+target extraction, classification, extracted legend writing, ...), then
+optionally runs the full checker once per engine as a subprocess. Each run
+appends one JSON line with per-phase wall/CPU time, sites/sec and peak RSS
+to a results file, so runs on different commits or machines can be
+compared. Nothing here touches the network.
+
+Usage:
+    run_benchmark.py <legend> <vcf> [--expected bench.expected.json] [--engines memory,streaming,columnar]
+                     [--threads N] [--label name] [--results benchmarks/results.jsonl]
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BIN_DIR = os.path.join(BENCH_DIR, '..', 'bin')
+
+RESULTS_VERSION = 1
+ENGINES = ('memory', 'streaming', 'columnar')
+
+
+def run_checker(engine, legend_file, vcf_file, run_dir, threads, trace=False):
+    """Run the checker end to end in a child process; returns timing, peak RSS, its metrics and its trace"""
+    os.makedirs(run_dir, exist_ok=True)
+    metrics_file = os.path.join(run_dir, 'metrics.json')
+    trace_file = os.path.join(run_dir, 'trace.json')
+    cmd = [sys.executable, os.path.join(BIN_DIR, 'check_allele_switch.py'),
+           os.path.abspath(vcf_file), os.path.abspath(legend_file), 'switches.tsv', '--legend',
+           '--engine', engine, '--threads', str(threads), '--metrics', 'metrics.json']
+    if trace:
+        cmd += ['--trace', 'trace.json']
+    wall = time.perf_counter()
+    with open(os.path.join(run_dir, 'run.log'), 'w') as log:
+        process = subprocess.Popen(cmd, cwd=run_dir, stdout=log, stderr=subprocess.STDOUT)
+        # wait4 reports the child's own resource usage, so each engine gets its own peak RSS
+        _, status, usage = os.wait4(process.pid, 0)
+    wall = time.perf_counter() - wall
+    exit_code = process.returncode = os.waitstatus_to_exitcode(status)
+    result = {
+        'exit_code': exit_code,
+        'wall_seconds': round(wall, 3),
+        'cpu_seconds': round(usage.ru_utime + usage.ru_stime, 3),
+        'peak_rss_mb': round(usage.ru_maxrss / (1 << 20 if sys.platform == 'darwin' else 1 << 10), 1),
+    }
+    if exit_code == 0 and os.path.exists(metrics_file):
+        with open(metrics_file) as f:
+            record = json.load(f)
+        result['totals'] = record['totals']
+        result['counts'] = record['counts']
+        if wall > 0:
+            result['sites_per_second'] = round(record['totals']['target'] / wall)
+    if exit_code == 0 and trace and os.path.exists(trace_file):
+        with open(trace_file) as f:
+            result['trace'] = json.load(f)
+    return result
+
+
+def run_phases(legend_file, vcf_file, workdir, threads):
+    """Run the in-memory check with --trace; returns (phases, counts, totals) from the checker's own trace
+
+    phases is None when the check failed, with its exit status in place of the counts.
+    """
+    result = run_checker('memory', legend_file, vcf_file, os.path.join(workdir, 'phases'), threads, trace=True)
+    if 'trace' not in result:
+        return None, result['exit_code'], None
+    phases = {}
+    for traced in result['trace']['phases']:
+        record = {
+            'wall_seconds': traced['wall_seconds'],
+            'cpu_seconds': traced['cpu_seconds'],
+            'peak_rss_mb': traced['peak_rss_mb'],
+        }
+        # Phases reading records count them; the rate of the first counted input stands for sites/s
+        records = [(name, count) for name, count in traced['counters'].items() if name.endswith('_records')]
+        if records:
+            name, record['sites'] = records[0]
+            record['sites_per_second'] = round(traced['rates'].get(f"{name}_per_second", 0))
+        phases[traced['name']] = record
+    return phases, result['counts'], result['totals']
+
+
+def run_engine(engine, legend_file, vcf_file, workdir, threads):
+    """Run one engine end to end; returns timing, peak RSS and its metrics"""
+    return run_checker(engine, legend_file, vcf_file, os.path.join(workdir, engine), threads)
+
+
+def git_commit():
+    """Short commit hash of the checkout being benchmarked, or None"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def check_expected(expected, totals, counts):
+    """Return a list of mismatches between observed and generated counts"""
+    problems = []
+    for key, value in expected['totals'].items():
+        if totals.get(key) != value:
+            problems.append(f"{key} sites: expected {value:,}, got {totals.get(key)}")
+    for status, value in expected['counts'].items():
+        if counts.get(status) != value:
+            problems.append(f"{status}: expected {value:,}, got {counts.get(status)}")
+    return problems
+
+
+def print_report(record):
+    print(f"Benchmark: {record['label']} (commit {record['commit'] or 'unknown'}, threads {record['threads']})")
+    print(f"{'phase':<24}{'wall s':>10}{'cpu s':>10}{'sites/s':>14}{'peak RSS MiB':>15}")
+    for name, values in list(record['phases'].items()) + list(record['engines'].items()):
+        print(f"{name:<24}{values['wall_seconds']:>10.3f}{values['cpu_seconds']:>10.3f}"
+              f"{values.get('sites_per_second', 0):>14,}{values['peak_rss_mb']:>15.1f}")
+    for problem in record['problems']:
+        print(f"MISMATCH: {problem}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the phases of check_allele_switch.py')
+    parser.add_argument('legend', help='Reference legend file (e.g. from generate_data.py)')
+    parser.add_argument('vcf', help='Target VCF file')
+    parser.add_argument('--expected', help='Expected counts written by generate_data.py')
+    parser.add_argument('--engines', default='',
+                        help=f"Comma-separated engines to also run end to end ({', '.join(ENGINES)}; default: none)")
+    parser.add_argument('--skip-phases', action='store_true', help='Only run the end-to-end engines')
+    parser.add_argument('--threads', type=int, default=1, help='Worker processes for BGZF parsing (default: 1)')
+    parser.add_argument('--label', help='Name recorded with the results (default: VCF file name)')
+    parser.add_argument('--results', default=os.path.join(BENCH_DIR, 'results.jsonl'),
+                        help='JSON Lines file the run is appended to (default: benchmarks/results.jsonl)')
+    parser.add_argument('--keep-workdir', action='store_true', help='Keep the outputs written by the run')
+    args = parser.parse_args()
+
+    engines = [engine for engine in args.engines.split(',') if engine]
+    unknown = [engine for engine in engines if engine not in ENGINES]
+    if unknown:
+        parser.error(f"unknown engine(s): {', '.join(unknown)}")
+    for path in (args.legend, args.vcf):
+        if not os.path.exists(path):
+            print(f"ERROR: {path} not found")
+            sys.exit(1)
+
+    workdir = tempfile.mkdtemp(prefix='checkref_bench_')
+    record = {
+        'benchmark_version': RESULTS_VERSION,
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'label': args.label or os.path.basename(args.vcf),
+        'commit': git_commit(),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'threads': max(1, args.threads),
+        'legend': os.path.abspath(args.legend),
+        'vcf': os.path.abspath(args.vcf),
+        'phases': {},
+        'engines': {},
+        'problems': [],
+    }
+    expected = None
+    if args.expected:
+        with open(args.expected) as f:
+            expected = json.load(f)
+
+    try:
+        if not args.skip_phases:
+            phases, counts, totals = run_phases(args.legend, args.vcf, workdir, record['threads'])
+            if phases is None:
+                record['problems'].append(f"phases: traced check exited with status {counts}")
+            else:
+                record['phases'] = phases
+                record['totals'] = totals
+                record['counts'] = counts
+            if phases is not None and expected:
+                record['problems'] += [f"phases: {p}" for p in check_expected(expected, totals, counts)]
+        for engine in engines:
+            result = run_engine(engine, args.legend, args.vcf, workdir, record['threads'])
+            record['engines'][engine] = result
+            if result['exit_code'] != 0:
+                record['problems'].append(f"{engine}: exited with status {result['exit_code']}")
+            elif expected:
+                record['problems'] += [f"{engine}: {p}" for p in
+                                       check_expected(expected, result.get('totals', {}), result.get('counts', {}))]
+    finally:
+        if args.keep_workdir:
+            print(f"Outputs kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.results, 'a') as out:
+        out.write(json.dumps(record) + "\n")
+    print_report(record)
+    print(f"Results appended to {args.results}")
+    if record['problems']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Merge per-chromosome CheckRef metrics records into one report.
+
+Reads the JSON/TSV records written by `check_allele_switch.py --metrics` and
+writes the all-chromosome text summary (the format CREATE_SUMMARY has always
+published) and, optionally, a combined JSON document.
+
+Usage:
+    aggregate_metrics.py <metrics>... [--summary all_chromosomes_summary.txt] [--json all_chromosomes_metrics.json]
+"""
+
+import argparse
+import json
+import os
+import sys
+
+from metrics import METRICS_SCHEMA, METRICS_VERSION, percent, read_metrics
+
+RECORD_SUFFIXES = ("_allele_switch_metrics.json", "_allele_switch_metrics.tsv", ".json", ".tsv")
+
+
+def record_label(path):
+    """Name shown for a record, taken from its file name like the old summary-file names"""
+    name = os.path.basename(path)
+    for suffix in RECORD_SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def aggregate(records):
+    """Totals over (label, record) pairs; each reference file is counted once"""
+    totals = {"target": 0, "reference": 0, "common": 0}
+    counts = {}
+    references = {}
+    for _, record in records:
+        totals["target"] += record["totals"]["target"]
+        totals["common"] += record["totals"]["common"]
+        references[record["reference_file"]] = record["totals"]["reference"]
+        for status, count in record["counts"].items():
+            counts[status] = counts.get(status, 0) + count
+    totals["reference"] = sum(references.values())
+    return totals, counts
+
+
+def pct(part, whole):
+    return f"{part * 100 / whole:.2f}" if whole else "0.00"
+
+
+def write_summary(path, records, totals, counts):
+    lines = [
+        "====================================",
+        "ALLELE SWITCH CHECKER SUMMARY",
+        "====================================",
+        "",
+        f"Processed files: {len(records)}",
+        "",
+        "Individual Chromosome Results:",
+        "------------------------------------",
+    ]
+    for label, record in records:
+        lines += [
+            "",
+            f"Chromosome: {label}",
+            f"  - Target variants: {record['totals']['target']}",
+            f"  - Common variants: {record['totals']['common']}",
+            f"  - Matched: {record['counts'].get('MATCH', 0)}",
+            f"  - Switched: {record['counts'].get('SWITCH', 0)}",
+        ]
+    lines += [
+        "",
+        "====================================",
+        "AGGREGATED RESULTS (ALL CHROMOSOMES)",
+        "====================================",
+        "",
+        f"Total variants in all target VCFs: {totals['target']}",
+        f"Total variants in reference: {totals['reference']}",
+        f"Total variants at common positions: {totals['common']}",
+        "",
+        "Overlap Statistics:",
+        f"  - Target VCF coverage: {totals['common']}/{totals['target']} ({pct(totals['common'], totals['target'])}%)",
+        f"  - Reference coverage: {totals['common']}/{totals['reference']} ({pct(totals['common'], totals['reference'])}%)",
+        "",
+        "Allele Comparison Results:",
+        f"  - Matched variants: {counts.get('MATCH', 0)} ({pct(counts.get('MATCH', 0), totals['common'])}%)",
+        f"  - Switched alleles: {counts.get('SWITCH', 0)} ({pct(counts.get('SWITCH', 0), totals['common'])}%)",
+        f"  - Complementary strand issues: {counts.get('COMPLEMENT', 0)}",
+        f"  - Complement + switch issues: {counts.get('COMPLEMENT_SWITCH', 0)}",
+        f"  - Other inconsistencies: {counts.get('OTHER', 0)}",
+        "",
+        "====================================",
+        "END OF SUMMARY",
+        "====================================",
+    ]
+    with open(path, "w") as out:
+        out.write("\n".join(lines) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge CheckRef metrics records into one summary')
+    parser.add_argument('metrics', nargs='+', help='Metrics records (JSON or TSV) from check_allele_switch.py')
+    parser.add_argument('--summary', default='all_chromosomes_summary.txt', help='Text summary to write')
+    parser.add_argument('--json', help='Also write the merged records and totals as JSON')
+    args = parser.parse_args()
+
+    from check_allele_switch import chrom_sort_key
+
+    records = []
+    for path in args.metrics:
+        try:
+            records.append((record_label(path), read_metrics(path)))
+        except (OSError, ValueError) as e:
+            print(f"ERROR: {e}")
+            sys.exit(1)
+    records.sort(key=lambda item: (chrom_sort_key(item[1]["chroms"][0].lstrip('chr')) if item[1]["chroms"]
+                                   else (2, 0, ''), item[0]))
+
+    totals, counts = aggregate(records)
+    write_summary(args.summary, records, totals, counts)
+    print(f"Merged {len(records)} metrics records into {args.summary}")
+
+    if args.json:
+        with open(args.json, "w") as out:
+            json.dump({
+                "schema": f"{METRICS_SCHEMA}-summary",
+                "version": METRICS_VERSION,
+                "totals": totals,
+                "counts": counts,
+                "overlap": {"target_pct": percent(totals["common"], totals["target"]),
+                            "reference_pct": percent(totals["common"], totals["reference"])},
+                "records": {label: record for label, record in records},
+            }, out, indent=2)
+            out.write("\n")
+        print(f"Wrote merged metrics to {args.json}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""
+BGZF block utilities for CheckRef.
+
+BGZF files (bgzipped VCFs and legends) are a series of independent gzip
+members of at most 64 KiB each. This module splits such a file into runs of
+whole blocks, inflates and tokenizes the runs in a worker pool, and stitches
+the lines that straddle run boundaries back together in file order. It also
+writes BGZF, tracking the virtual offsets an index needs, and reads lines
+back from a virtual offset for indexed lookups.
+"""
+
+import multiprocessing
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import run_trace
+
+BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+HEADER_SIZE = 12          # fixed gzip header up to and including XLEN
+DEFAULT_RUN_SIZE = 4 << 20
+BLOCK_DATA_SIZE = 0xff00  # uncompressed bytes per written block, as in htslib
+MAX_BLOCK_SIZE = 1 << 16
+DEFAULT_LEVEL = 6
+EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+
+def is_bgzf(path):
+    """True if the file starts with a BGZF block"""
+    with open(path, 'rb') as f:
+        head = f.read(HEADER_SIZE + 6)
+    return len(head) == HEADER_SIZE + 6 and head[:4] == BGZF_MAGIC and _find_bsize(head, 0) is not None
+
+
+def _find_bsize(buf, offset):
+    """Return the total size of the BGZF block starting at offset, or None if not a BGZF header"""
+    xlen = struct.unpack_from('<H', buf, offset + 10)[0]
+    pos = offset + HEADER_SIZE
+    end = pos + xlen
+    if end > len(buf):
+        return None
+    while pos + 4 <= end:
+        si1, si2, slen = buf[pos], buf[pos + 1], struct.unpack_from('<H', buf, pos + 2)[0]
+        if si1 == 66 and si2 == 67 and slen == 2:  # 'B', 'C'
+            return struct.unpack_from('<H', buf, pos + 4)[0] + 1
+        pos += 4 + slen
+    return None
+
+
+def block_size(buf, offset):
+    """Total size of the BGZF block at offset; raises ValueError for non-BGZF data"""
+    if buf[offset:offset + 4] != BGZF_MAGIC:
+        raise ValueError(f"no BGZF block header at offset {offset}")
+    bsize = _find_bsize(buf, offset)
+    if bsize is None:
+        raise ValueError(f"gzip member at offset {offset} has no BGZF block size")
+    return bsize
+
+
+def complete_blocks_end(buf):
+    """Offset just past the last complete block in buf"""
+    offset = 0
+    while offset + HEADER_SIZE + 6 <= len(buf):
+        bsize = block_size(buf, offset)
+        if offset + bsize > len(buf):
+            break
+        offset += bsize
+    return offset
+
+
+def read_block_runs(f, run_size=DEFAULT_RUN_SIZE):
+    """Yield runs of whole compressed blocks of roughly run_size bytes"""
+    pending = b''
+    while True:
+        data = f.read(run_size)
+        if not data:
+            break
+        buf = pending + data if pending else data
+        end = complete_blocks_end(buf)
+        if end:
+            yield buf[:end]
+        pending = buf[end:]
+    if pending:
+        raise ValueError("BGZF file ends with a truncated block")
+
+
+def inflate_block(buf, offset, bsize):
+    """Decompress one block"""
+    xlen = struct.unpack_from('<H', buf, offset + 10)[0]
+    return zlib.decompress(buf[offset + HEADER_SIZE + xlen:offset + bsize - 8], -15)
+
+
+def inflate_run(data):
+    """Decompress a run of whole blocks"""
+    out = []
+    offset = 0
+    while offset < len(data):
+        bsize = block_size(data, offset)
+        out.append(inflate_block(data, offset, bsize))
+        offset += bsize
+    return b''.join(out)
+
+
+def _parse_run(data, parse_line, decode):
+    """Worker: inflate a run and parse its complete lines.
+
+    Returns (head, records, tail, size): the bytes before the first newline
+    and after the last one are handed back unparsed for stitching; records
+    is None when the run holds no newline at all. size is the inflated size.
+    """
+    text = inflate_run(data)
+    first = text.find(b'\n')
+    if first < 0:
+        return text, None, None, len(text)
+    last = text.rfind(b'\n')
+    records = []
+    if last > first:
+        # Newlines never fall inside a multi-byte character, so the interior decodes cleanly
+        interior = text[first + 1:last]
+        lines = interior.decode().split('\n') if decode else interior.split(b'\n')
+        for line in lines:
+            record = parse_line(line)
+            if record is not None:
+                records.append(record)
+    return text[:first], records, text[last + 1:], len(text)
+
+
+def parallel_parse(path, parse_line, threads, skip_first_line=False, decode=False, run_size=DEFAULT_RUN_SIZE):
+    """Yield parse_line(line) results for every line of a BGZF file, in order, using a process pool.
+
+    parse_line must be a picklable top-level callable returning a record or
+    None; it receives str lines when decode is set, bytes otherwise.
+    skip_first_line drops a header line before parsing.
+    """
+    # fork keeps the already-imported parser modules available to workers
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+    with ProcessPoolExecutor(max_workers=threads, mp_context=context) as pool, open(path, 'rb') as f:
+        in_flight = deque()
+        carry = b''
+        runs = read_block_runs(f, run_size)
+
+        def submit_next():
+            run = next(runs, None)
+            if run is not None:
+                in_flight.append(pool.submit(_parse_run, run, parse_line, decode))
+
+        def parse_stitched(line):
+            return parse_line(line.decode() if decode else line)
+
+        # Keep a bounded number of runs in flight so memory stays flat
+        for _ in range(threads * 2):
+            submit_next()
+        while in_flight:
+            head, records, tail, size = in_flight.popleft().result()
+            submit_next()
+            run_trace.count("bytes_decompressed", size)
+            if records is None:
+                carry += head
+                continue
+            if skip_first_line:
+                skip_first_line = False
+            else:
+                record = parse_stitched(carry + head)
+                if record is not None:
+                    yield record
+            # Lines inside one run are complete; only the run head needed stitching
+            for record in records:
+                yield record
+            carry = tail
+        if carry and not skip_first_line:
+            record = parse_stitched(carry)
+            if record is not None:
+                yield record
+
+
+def compress_block(data, level=DEFAULT_LEVEL):
+    """Compress up to BLOCK_DATA_SIZE bytes into one complete BGZF block"""
+    deflate = zlib.compressobj(level, zlib.DEFLATED, -15)
+    payload = deflate.compress(data) + deflate.flush()
+    if len(payload) + 26 > MAX_BLOCK_SIZE:
+        # Incompressible data; a stored block of BLOCK_DATA_SIZE bytes always fits
+        deflate = zlib.compressobj(0, zlib.DEFLATED, -15)
+        payload = deflate.compress(data) + deflate.flush()
+    header = struct.pack('<4sIBBHBBHH', BGZF_MAGIC, 0, 0, 0xff, 6, 66, 67, 2, len(payload) + 25)
+    return header + payload + struct.pack('<II', zlib.crc32(data), len(data))
+
+
+class BgzfWriter:
+    """Write a BGZF file, exposing htslib-style virtual offsets through tell()
+
+    With threads > 1, full blocks are compressed in a thread pool (zlib
+    releases the GIL) and written in order. Compressed sizes are then not
+    known when tell() is called, so it returns offsets keyed by block
+    number instead; pass them through resolve() once the file is closed.
+    """
+
+    def __init__(self, path, level=DEFAULT_LEVEL, threads=1):
+        self.path = path
+        self.level = level
+        self._f = open(path, 'wb')
+        self._buf = bytearray()
+        self._offset = 0  # compressed bytes written so far
+        self._pool = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+        self._max_pending = threads * 4
+        self._pending = deque()
+        self._blocks = 0            # blocks handed to the pool
+        self._block_offsets = []    # compressed start of each written block (threaded mode)
+
+    def tell(self):
+        """Virtual offset of the next byte written: (block start << 16) | offset within block"""
+        if self._pool is not None:
+            return (self._blocks << 16) | len(self._buf)
+        return (self._offset << 16) | len(self._buf)
+
+    def resolve(self, voffset):
+        """Real virtual offset of a tell() value; the identity unless writing with threads"""
+        if not self._block_offsets:
+            return voffset
+        return (self._block_offsets[voffset >> 16] << 16) | (voffset & 0xffff)
+
+    def write(self, data):
+        buf = self._buf
+        buf += data
+        while len(buf) >= BLOCK_DATA_SIZE:
+            self._write_block(bytes(buf[:BLOCK_DATA_SIZE]))
+            del buf[:BLOCK_DATA_SIZE]
+
+    def _write_block(self, data):
+        if self._pool is not None:
+            self._pending.append(self._pool.submit(compress_block, data, self.level))
+            self._blocks += 1
+            # Keep a bounded number of blocks in flight so memory stays flat
+            while len(self._pending) > self._max_pending:
+                self._write_pending()
+            return
+        block = compress_block(data, self.level)
+        self._f.write(block)
+        self._offset += len(block)
+
+    def _write_pending(self):
+        block = self._pending.popleft().result()
+        self._block_offsets.append(self._offset)
+        self._f.write(block)
+        self._offset += len(block)
+
+    def close(self):
+        if self._f.closed:
+            return
+        if self._buf:
+            self._write_block(bytes(self._buf))
+            self._buf.clear()
+        if self._pool is not None:
+            while self._pending:
+                self._write_pending()
+            self._pool.shutdown()
+            # Offsets that point just past the last block land on the EOF marker
+            self._block_offsets.append(self._offset)
+        self._f.write(EOF_BLOCK)
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class BgzfReader:
+    """Read lines of a BGZF file from htslib-style virtual offsets"""
+
+    def __init__(self, path):
+        self.path = path
+        self._f = open(path, 'rb')
+        self._block_start = None
+        self._next_block = 0
+        self._data = b''
+        self._pos = 0
+
+    def _load(self, coffset):
+        """Inflate the block at coffset; False at end of file"""
+        if coffset == self._block_start:
+            return True
+        self._f.seek(coffset)
+        buf = self._f.read(MAX_BLOCK_SIZE)
+        if len(buf) < HEADER_SIZE + 6:
+            return False
+        bsize = block_size(buf, 0)
+        self._data = inflate_block(buf, 0, bsize)
+        run_trace.count("bytes_decompressed", len(self._data))
+        self._block_start = coffset
+        self._next_block = coffset + bsize
+        self._pos = 0
+        return True
+
+    def _advance(self):
+        """Move to the next non-empty block; False at end of file"""
+        while self._pos >= len(self._data):
+            if not self._load(self._next_block):
+                return False
+        return True
+
+    def seek(self, voffset):
+        self._load(voffset >> 16)
+        self._pos = voffset & 0xffff
+
+    def tell(self):
+        return (self._block_start << 16) | self._pos
+
+    def readline(self):
+        """Return the next line (bytes, with newline), or b'' at end of file"""
+        parts = []
+        while self._advance():
+            newline = self._data.find(b'\n', self._pos)
+            if newline >= 0:
+                parts.append(self._data[self._pos:newline + 1])
+                self._pos = newline + 1
+                break
+            parts.append(self._data[self._pos:])
+            self._pos = len(self._data)
+        # Land on the start of the next block, as htslib does, so tell() compares with index offsets
+        self._advance()
+        return b''.join(parts)
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -5,6 +5,32 @@ import re
 import argparse
 import gzip
 import os
+import functools
+import bisect
+import itertools
+import random
+import time
+
+import bgzf
+import genotype_flip
+import metrics
+import profile_input
+import run_trace
+import shards
+import stages
+import tabix_index
+import vcf_reader
+
+# Allele comparison outcomes, in the order they are reported
+ALLELE_STATUSES = ("MATCH", "SWITCH", "COMPLEMENT", "COMPLEMENT_SWITCH", "OTHER")
+
+# Exit status for position-unsorted input in the sorted-only modes, so callers can sort and retry
+UNSORTED_EXIT_CODE = 3
+
+# Consecutive untouched sites --verify-sites takes after each seek into an indexed reference
+VERIFY_RUN = 20
+
+SWITCHED_INFO_HEADER = b'##INFO=<ID=SWITCHED,Number=0,Type=Flag,Description="Alleles were switched to match reference">\n'
 
 def run_command(cmd):
     """Run a shell command and return the output"""
@@ -16,101 +42,192 @@ def run_command(cmd):
         sys.exit(1)
     return stdout.decode()
 
-def parse_legend_file(legend_file):
-    """Parse a legend file and return variants information"""
-    variants = {}
-    original_chroms = {}
+def stream_command(cmd):
+    """Run a shell command and yield its output line by line"""
+    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True, bufsize=1 << 20)
+    try:
+        for line in proc.stdout:
+            yield line
+    except GeneratorExit:
+        # Consumer stopped early (e.g. unsorted input); don't leave the pipeline running
+        proc.kill()
+        proc.wait()
+        raise
+    stderr = proc.stderr.read()
+    proc.wait()
+    if proc.returncode != 0:
+        print(f"Error executing command: {cmd}")
+        print(stderr)
+        sys.exit(1)
+
+class UnsortedInputError(Exception):
+    """Raised when a streamed input is not sorted by chromosome and position"""
+
+def chrom_sort_key(chrom):
+    """Natural sort key for a chromosome name without the 'chr' prefix (1..22, X, Y, MT, others)"""
+    if chrom.isdigit():
+        return (0, int(chrom), '')
+    special = {'X': 23, 'Y': 24, 'XY': 25, 'M': 26, 'MT': 26}
+    if chrom.upper() in special:
+        return (0, special[chrom.upper()], '')
+    return (1, 0, chrom)
+
+def legend_layout(header, legend_file):
+    """Work out the legend column layout from its first line"""
+    # Check if header exists
+    if header.startswith('id') or header.startswith('ID'):
+        header_cols = header.upper().split()
+        if 'CHROM' in header_cols:
+            chrom_idx = header_cols.index('CHROM')
+        else:
+            chrom_idx = None
+            
+        if 'POS' in header_cols:
+            pos_idx = header_cols.index('POS')
+        elif 'POSITION' in header_cols:
+            pos_idx = header_cols.index('POSITION')
+        else:
+            pos_idx = 2  # Default position index
+            
+        if 'REF' in header_cols:
+            ref_idx = header_cols.index('REF')
+        elif 'A0' in header_cols:
+            ref_idx = header_cols.index('A0')
+        else:
+            ref_idx = 3  # Default reference index
+            
+        if 'ALT' in header_cols:
+            alt_idx = header_cols.index('ALT')
+        elif 'A1' in header_cols:
+            alt_idx = header_cols.index('A1')
+        else:
+            alt_idx = 4  # Default alternate index
+        
+        print(f"Using column indices - CHROM: {chrom_idx if chrom_idx is not None else 'N/A'}, POS: {pos_idx}, REF: {ref_idx}, ALT: {alt_idx}")
+        has_header = True
+    else:
+        # Default column order in legend file: ID position a0 a1
+        chrom_idx = None
+        pos_idx = 1
+        ref_idx = 2
+        alt_idx = 3
+        has_header = False
+
+    # Chromosome to fall back on when neither a CHROM column nor the ID carries one
+    match = re.search(r'(chr\d+|chrX|chrY|chrMT)', legend_file)
+    if match:
+        filename_chrom = match.group(1)
+    else:
+        match = re.search(r'(\d+|X|Y|MT)', legend_file)
+        filename_chrom = f"chr{match.group(1)}" if match else "unknown"
+
+    return {
+        'has_header': has_header,
+        'chrom_idx': chrom_idx,
+        'pos_idx': pos_idx,
+        'ref_idx': ref_idx,
+        'alt_idx': alt_idx,
+        'min_cols': max(pos_idx, ref_idx, alt_idx, chrom_idx if chrom_idx is not None else 0),
+        'filename_chrom': filename_chrom,
+    }
+
+def parse_legend_row(layout, line):
+    """Return (chrom, original_chrom, pos, ref, alt) for a legend row, or None if it is too short"""
+    cols = line.strip().split()
+    if len(cols) <= layout['min_cols']:
+        return None
+        
+    # Determine chromosome
+    chrom_idx = layout['chrom_idx']
+    if chrom_idx is not None:
+        original_chrom = cols[chrom_idx]
+        chrom = original_chrom.lstrip('chr')
+    else:
+        # Try to extract chromosome from ID
+        id_parts = cols[0].split('_')
+        if len(id_parts) > 0 and id_parts[0].startswith(('chr', 'CHR')):
+            original_chrom = id_parts[0]
+            chrom = original_chrom.lstrip('chrCHR')
+        else:
+            # Default to chromosome from filename
+            original_chrom = layout['filename_chrom']
+            chrom = original_chrom.lstrip('chr')
     
+    return chrom, original_chrom, cols[layout['pos_idx']], cols[layout['ref_idx']], cols[layout['alt_idx']]
+
+def iter_legend_records(legend_file, threads=1, region=None):
+    """Yield (chrom, original_chrom, pos, ref, alt) for each variant row of a legend file (in region, if given)"""
     # Detect if file is gzipped
     open_func = gzip.open if legend_file.endswith('.gz') else open
     mode = 'rt' if legend_file.endswith('.gz') else 'r'
-    
-    try:
-        with open_func(legend_file, mode) as f:
-            # Read header
-            header = f.readline().strip()
-            print(f"Legend file header: {header}")
-            
-            # Check if header exists
-            if header.startswith('id') or header.startswith('ID'):
-                header_cols = header.upper().split()
-                if 'CHROM' in header_cols:
-                    chrom_idx = header_cols.index('CHROM')
-                else:
-                    chrom_idx = None
-                    
-                if 'POS' in header_cols:
-                    pos_idx = header_cols.index('POS')
-                elif 'POSITION' in header_cols:
-                    pos_idx = header_cols.index('POSITION')
-                else:
-                    pos_idx = 2  # Default position index
-                    
-                if 'REF' in header_cols:
-                    ref_idx = header_cols.index('REF')
-                elif 'A0' in header_cols:
-                    ref_idx = header_cols.index('A0')
-                else:
-                    ref_idx = 3  # Default reference index
-                    
-                if 'ALT' in header_cols:
-                    alt_idx = header_cols.index('ALT')
-                elif 'A1' in header_cols:
-                    alt_idx = header_cols.index('A1')
-                else:
-                    alt_idx = 4  # Default alternate index
-                
-                print(f"Using column indices - CHROM: {chrom_idx if chrom_idx is not None else 'N/A'}, POS: {pos_idx}, REF: {ref_idx}, ALT: {alt_idx}")
-            else:
-                # Default column order in legend file: ID position a0 a1
-                chrom_idx = None
-                pos_idx = 1
-                ref_idx = 2
-                alt_idx = 3
+
+    with open_func(legend_file, mode) as f:
+        # Read header
+        header = f.readline().strip()
+        print(f"Legend file header: {header}")
+        layout = legend_layout(header, legend_file)
+
+        index_path = tabix_index.current_index(legend_file) if region is not None else None
+        if index_path is not None and bgzf.is_bgzf(legend_file):
+            # Read only the blocks of the region through the legend's index
+            print(f"Reading {shards.format_region(region)} of the legend through {index_path}")
+            records = shards.fetch_records(legend_file, index_path, region,
+                                           lambda line: parse_legend_row(layout, line.decode()))
+        elif threads > 1 and bgzf.is_bgzf(legend_file):
+            # Inflate and tokenize BGZF blocks in parallel, records come back in file order
+            print(f"Decoding BGZF legend with {threads} workers")
+            records = bgzf.parallel_parse(legend_file, functools.partial(parse_legend_row, layout), threads,
+                                          skip_first_line=layout['has_header'], decode=True)
+        else:
+            if not layout['has_header']:
                 # Rewind if we skipped a non-header line
                 f.seek(0)
-                
-            line_count = 0
-            for line in f:
-                line_count += 1
-                cols = line.strip().split()
-                if len(cols) <= max(pos_idx, ref_idx, alt_idx, chrom_idx if chrom_idx is not None else 0):
-                    continue
-                    
-                # Determine chromosome
-                if chrom_idx is not None:
-                    original_chrom = cols[chrom_idx]
-                    chrom = original_chrom.lstrip('chr')
-                else:
-                    # Try to extract chromosome from ID
-                    id_parts = cols[0].split('_')
-                    if len(id_parts) > 0 and id_parts[0].startswith(('chr', 'CHR')):
-                        original_chrom = id_parts[0]
-                        chrom = original_chrom.lstrip('chrCHR')
-                    else:
-                        # Default to chromosome from filename
-                        match = re.search(r'(chr\d+|chrX|chrY|chrMT)', legend_file)
-                        if match:
-                            original_chrom = match.group(1)
-                        else:
-                            match = re.search(r'(\d+|X|Y|MT)', legend_file)
-                            original_chrom = f"chr{match.group(1)}" if match else "unknown"
-                        chrom = original_chrom.lstrip('chr')
-                
-                pos = cols[pos_idx]
-                ref = cols[ref_idx]
-                alt = cols[alt_idx]
-                
-                # Store position without 'chr' prefix for matching
-                variants[(chrom, pos)] = (ref, alt)
-                # Store original chromosome notation
-                original_chroms[chrom] = original_chrom
-                
-                # Print sample of variants being processed
-                if line_count <= 5 or line_count % 100000 == 0:
-                    print(f"Sample variant {line_count}: CHROM={original_chrom}, POS={pos}, REF={ref}, ALT={alt}")
+            records = (parse_legend_row(layout, line) for line in f)
+            if legend_file.endswith('.gz'):
+                records = counted_inflate(records, f.buffer)
+
+        line_count = 0
+        for record in records:
+            line_count += 1
+            if record is None:
+                continue
+            if region is not None and not shards.in_region(region, record[0], record[2]):
+                continue
             
-            print(f"Finished processing {line_count} lines from legend file.")
+            # Print sample of variants being processed
+            if line_count <= 5 or line_count % 100000 == 0:
+                _, original_chrom, pos, ref, alt = record
+                print(f"Sample variant {line_count}: CHROM={original_chrom}, POS={pos}, REF={ref}, ALT={alt}")
+
+            yield record
+        
+        print(f"Finished processing {line_count} lines from legend file.")
+
+def counted_inflate(records, gzip_file):
+    """Pass records through, then count the bytes gzip_file inflated into the active trace"""
+    try:
+        yield from records
+    finally:
+        # A consumer that stopped early may have closed the file already
+        if not gzip_file.closed:
+            run_trace.count("bytes_decompressed", gzip_file.tell())
+
+def collect_variants(records):
+    """Load (chrom, original_chrom, pos, ref, alt) records into a site dict and chromosome notations"""
+    variants = {}
+    original_chroms = {}
+    for chrom, original_chrom, pos, ref, alt in records:
+        # Store position without 'chr' prefix for matching
+        variants[(chrom, pos)] = (ref, alt)
+        # Store original chromosome notation
+        original_chroms[chrom] = original_chrom
+    return variants, original_chroms
+
+def parse_legend_file(legend_file, threads=1, region=None):
+    """Parse a legend file and return variants information"""
+    try:
+        variants, original_chroms = collect_variants(iter_legend_records(legend_file, threads, region))
     except Exception as e:
         print(f"Error parsing legend file: {e}")
         print(f"File exists: {os.path.exists(legend_file)}")
@@ -122,15 +239,23 @@ def parse_legend_file(legend_file):
 def detect_genome_build(vcf_file):
     """Detect genome build from VCF file"""
     try:
-        # Check VCF header for build information
-        header_cmd = f"bcftools view -h {vcf_file}"
-        header_output = run_command(header_cmd)
+        profile = profile_input.cached_profile(vcf_file, 'vcf')
+        if profile is not None:
+            # The profiler already searched the header during its single scan
+            if profile['build']['header'] != 'unknown':
+                return profile['build']['header']
+        else:
+            # Check VCF header for build information
+            try:
+                header_output = vcf_reader.read_header(vcf_file)
+            except vcf_reader.UnsupportedVcfError:
+                header_output = run_command(f"bcftools view -h {vcf_file}")
 
-        # Look for build indicators in header
-        if 'GRCh38' in header_output or 'hg38' in header_output:
-            return 'hg38'
-        elif 'GRCh37' in header_output or 'hg19' in header_output:
-            return 'hg19'
+            # Look for build indicators in header
+            if 'GRCh38' in header_output or 'hg38' in header_output:
+                return 'hg38'
+            elif 'GRCh37' in header_output or 'hg19' in header_output:
+                return 'hg19'
 
         # Check filename for build indicators
         if 'hg38' in vcf_file or 'GRCh38' in vcf_file:
@@ -151,6 +276,10 @@ def detect_legend_build(legend_file):
         elif 'hg19' in legend_file or 'GRCh37' in legend_file:
             return 'hg19'
 
+        profile = profile_input.cached_profile(legend_file, 'legend')
+        if profile is not None:
+            return profile['build']['content']
+
         # Check file content for build indicators (sample a few positions)
         open_func = gzip.open if legend_file.endswith('.gz') else open
         mode = 'rt' if legend_file.endswith('.gz') else 'r'
@@ -177,13 +306,29 @@ def detect_legend_build(legend_file):
     except:
         return 'unknown'
 
-def check_allele_switch(target_vcf, reference_file, output_file, use_legend=False):
-    """Check for allele switches between target and reference files"""
-    print(f"Checking allele switches between {target_vcf} and {reference_file}")
+def open_catalog_source(catalog_path, reference_file):
+    """Return (catalog, source) when a compiled reference catalog is valid for the legend, else (None, None)"""
+    if not catalog_path:
+        return None, None
+    try:
+        import reference_catalog
+        catalog = reference_catalog.ReferenceCatalog(catalog_path)
+        source = catalog.source_for(reference_file)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"WARNING: Could not open reference catalog {catalog_path}: {e}")
+        source = None
+    if source is None:
+        print("WARNING: Falling back to parsing the reference legend file")
+        return None, None
+    print(f"Using reference catalog {catalog_path} for {source['file']}")
+    return catalog, source
 
-    # Detect genome builds
+def check_genome_builds(target_vcf, reference_file, output_file, legend_build=None):
+    """Detect target/reference genome builds and stop early on a mismatch; returns (target_build, legend_build)"""
+    # Detect genome builds (a catalog already records the legend build)
     target_build = detect_genome_build(target_vcf)
-    legend_build = detect_legend_build(reference_file)
+    if legend_build is None:
+        legend_build = detect_legend_build(reference_file)
 
     print(f"Detected target VCF build: {target_build}")
     print(f"Detected reference legend build: {legend_build}")
@@ -217,7 +362,6 @@ def check_allele_switch(target_vcf, reference_file, output_file, use_legend=Fals
             f.write("# No results - genome build mismatch detected\n")
 
         # Use a different approach - create a special marker file and exit normally
-        import os
         with open('BUILD_MISMATCH_DETECTED', 'w') as f:
             f.write("Build mismatch detected - workflow should terminate\n")
 
@@ -228,89 +372,283 @@ def check_allele_switch(target_vcf, reference_file, output_file, use_legend=Fals
         print("WARNING: Could not definitively determine genome builds from file names/headers")
         print("WARNING: Please verify that both files use the same genome build")
         print("WARNING: Proceeding with analysis but results may be incorrect if builds differ")
+    return target_build, legend_build
+
+def extracted_legend_name(reference_file):
+    """Name of the extracted reference legend written next to the results"""
+    # Get reference panel name from the reference file path
+    ref_panel_name = reference_file.split('/')[-1].replace('.legend.gz', '').replace('.legend', '')
+    return f"{ref_panel_name}_extracted.legend.gz"
+
+def genomic_order(sites):
+    """Return (chrom, pos) site keys in numeric genomic order, sorting only if they are not already in order"""
+    chrom_keys = {}
+    keys = []
+    for chrom, pos in sites:
+        chrom_key = chrom_keys.get(chrom)
+        if chrom_key is None:
+            chrom_key = chrom_keys[chrom] = chrom_sort_key(chrom)
+        keys.append((chrom_key, int(pos)))
+    if all(keys[i] <= keys[i + 1] for i in range(len(keys) - 1)):
+        return sites
+    order = sorted(range(len(sites)), key=keys.__getitem__)
+    return [sites[i] for i in order]
+
+class ExtractedLegendWriter:
+    """Write compared reference sites, in genomic order, as a BGZF legend plus a tabix index (-s2 -b3 -e3 -S1)"""
+
+    def __init__(self, path, level=bgzf.DEFAULT_LEVEL, threads=1):
+        self.path = path
+        self.count = 0
+        self._out = bgzf.BgzfWriter(path, level, threads)
+        self._index = tabix_index.TabixIndexBuilder(tabix_index.LEGEND_PRESET)
+        # Legend header (matching the original format)
+        self._out.write(b"ID\tCHROM\tPOS\tREF\tALT\n")
+
+    def add(self, original_chrom, position, ref, alt):
+        self.add_line(original_chrom, position,
+                      f"{original_chrom}:{position}:{ref}:{alt}\t{original_chrom}\t{position}\t{ref}\t{alt}\n".encode())
+
+    def add_line(self, original_chrom, position, line):
+        """Write an already formatted row (bytes, with newline)"""
+        out = self._out
+        start = out.tell()
+        out.write(line)
+        position = int(position)
+        self._index.add(original_chrom, position - 1, position, start, out.tell())
+        self.count += 1
+
+    def close(self):
+        self._out.close()
+        self._index.write(f"{self.path}.tbi", self._out.resolve)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def classify_alleles(target_ref, target_alt, ref_ref, ref_alt):
+    """Classify a target allele pair against the reference allele pair"""
+    # Same alleles
+    if target_ref == ref_ref and target_alt == ref_alt:
+        return "MATCH"
+    # Switched alleles
+    if target_ref == ref_alt and target_alt == ref_ref:
+        return "SWITCH"
+    # Complementary alleles (A↔T, C↔G)
+    if is_complement(target_ref, ref_ref) and is_complement(target_alt, ref_alt):
+        return "COMPLEMENT"
+    # Complementary + switch
+    if is_complement(target_ref, ref_alt) and is_complement(target_alt, ref_ref):
+        return "COMPLEMENT_SWITCH"
+    return "OTHER"
+
+def print_results_summary(output_file, ref_panel_file, num_target, num_ref, num_common, counts):
+    """Print the end-of-run summary (parsed downstream by CREATE_SUMMARY)"""
+    matched = counts["MATCH"]
+    switched = counts["SWITCH"]
+    complementary = counts["COMPLEMENT"]
+    complement_switched = counts["COMPLEMENT_SWITCH"]
+    other = counts["OTHER"]
+
+    print("\nResults Summary:")
+    print(f"Total variants in target VCF: {num_target}")
+    print(f"Total variants in reference: {num_ref}")
+    print(f"Total variants at common positions: {num_common}")
+    
+    # Calculate overlap percentages
+    if num_target > 0:
+        target_overlap_pct = (num_common / num_target) * 100
+        print(f"Overlap with target VCF: {num_common}/{num_target} ({target_overlap_pct:.2f}%)")
+    
+    if num_ref > 0:
+        ref_overlap_pct = (num_common / num_ref) * 100
+        print(f"Overlap with reference: {num_common}/{num_ref} ({ref_overlap_pct:.2f}%)")
+    
+    if num_common > 0:
+        print(f"Matched variants: {matched} ({matched/num_common*100:.2f}%)")
+        print(f"Switched alleles (written to file): {switched} ({switched/num_common*100:.2f}%)")
+        print(f"Complementary strand issues: {complementary} ({complementary/num_common*100:.2f}%)")
+        print(f"Complement + switch issues: {complement_switched} ({complement_switched/num_common*100:.2f}%)")
+        print(f"Other inconsistencies: {other} ({other/num_common*100:.2f}%)")
+    else:
+        print("No common positions found between target and reference files.")
+    
+    print(f"Switched alleles written to file: {output_file}")
+    print(f"Reference panel legend file created: {ref_panel_file}")
+    print(f"Total variants in source reference: {num_ref}")
+    print(f"Variants compared (written to extracted legend): {num_common}")
+    print(f"  - Matched: {num_common}")
+    print(f"  - Switched: {switched}")
+
+def restore_cached_check(cache, key, target_vcf, reference_file, output_file):
+    """Copy a cached check's outputs into place and report them; returns its metrics record, or None on a miss"""
+    ref_panel_file = extracted_legend_name(reference_file)
+    record = cache.restore(key, output_file, ref_panel_file)
+    if record is None:
+        print(f"Result cache miss ({key[:16]})")
+        return None
+    print(f"Result cache hit ({key[:16]}): reusing the results of an identical check")
+    print(f"Successfully created reference legend file: {ref_panel_file}")
+    totals = record["totals"]
+    print_results_summary(output_file, ref_panel_file, totals["target"], totals["reference"], totals["common"],
+                          record["counts"])
+    # Same bytes, but possibly other paths than the run that filled the cache
+    record["target_vcf"] = target_vcf
+    record["reference_file"] = reference_file
+    return record
+
+def load_reference(reference_file, use_legend=False, catalog=None, source=None, vcf_backend='native', threads=1,
+                   region=None):
+    """Load reference sites for the in-memory engine; returns (ref_variants, ref_chroms)"""
+    if use_legend:
+        if catalog is not None and region is None:
+            # Sites are looked up in the mapped catalog tables, nothing is parsed or copied
+            import reference_catalog
+            print("Mapping reference variants from catalog...")
+            tables = {chrom: catalog.chrom(chrom) for chrom in source['chroms']}
+            ref_chroms = {chrom: table.original_chrom for chrom, table in tables.items()}
+            return reference_catalog.CatalogSites(tables), ref_chroms
+        if catalog is not None:
+            print("Loading reference variants in the region from catalog...")
+            return collect_variants(catalog_records(catalog, source, region))
+        print("Parsing reference legend file...")
+        return parse_legend_file(reference_file, threads, region)
+
+    print("Extracting variants from reference VCF...")
+    ref_variants = {}
+    ref_chroms = {}
+    line_count = 0
+    for chrom, original_chrom, pos, ref, alt in iter_vcf_snps(reference_file, vcf_backend, threads, region):
+        line_count += 1
+        ref_variants[(chrom, pos)] = (ref, alt)
+        # Keep the first notation seen, as the target merge below does
+        ref_chroms.setdefault(chrom, original_chrom)
+
+        # Print status every 100,000 lines
+        if line_count % 100000 == 0:
+            print(f"Processed {line_count} lines from reference file...")
+    return ref_variants, ref_chroms
+
+def write_extracted_legend(ref_panel_file, common_positions, ref_variants, original_chroms,
+                           compress_level=bgzf.DEFAULT_LEVEL, threads=1):
+    """Write the reference alleles at the compared positions as the extracted legend (plain text if BGZF fails)"""
+    try:
+        # A sorted target already gives genomic order; otherwise sort numerically once
+        legend_positions = genomic_order(common_positions)
+        with run_trace.phase("write_extracted_legend"), \
+                ExtractedLegendWriter(ref_panel_file, compress_level, threads) as ref_out:
+            for pos in legend_positions:
+                chrom, position = pos
+                ref_ref, ref_alt = ref_variants[pos]
+                # Use original chromosome notation
+                original_chrom = original_chroms.get(chrom, f"chr{chrom}")
+                ref_out.add(original_chrom, position, ref_ref, ref_alt)
+        variants_written = ref_out.count
+        print(f"Successfully created reference legend file: {ref_panel_file}")
+        print(f"Wrote {variants_written:,} reference variants at compared positions")
+    except Exception as e:
+        print(f"Error creating reference legend file: {e}")
+        # Create a simple uncompressed legend file as fallback
+        try:
+            ref_panel_file_txt = ref_panel_file.replace('.gz', '')
+            variants_written = 0
+            with open(ref_panel_file_txt, 'w') as ref_out:
+                ref_out.write("ID\tCHROM\tPOS\tREF\tALT\n")
+                for pos in sorted(common_positions):
+                    chrom, position = pos
+                    ref_ref, ref_alt = ref_variants[pos]
+                    original_chrom = original_chroms.get(chrom, f"chr{chrom}")
+                    variant_id = f"{original_chrom}:{position}:{ref_ref}:{ref_alt}"
+                    ref_out.write(f"{variant_id}\t{original_chrom}\t{position}\t{ref_ref}\t{ref_alt}\n")
+                    variants_written += 1
+            print(f"Created uncompressed reference legend file: {ref_panel_file_txt}")
+            print(f"Wrote {variants_written:,} reference variants at compared positions")
+        except Exception as e2:
+            print(f"Error creating uncompressed legend file: {e2}")
+
+def load_reference_phase(*args):
+    """load_reference(), traced as the reference_parse phase"""
+    with run_trace.phase("reference_parse"):
+        ref_variants, ref_chroms = load_reference(*args)
+        run_trace.count("reference_records", len(ref_variants))
+    return ref_variants, ref_chroms
+
+def check_allele_switch(target_vcf, reference_file, output_file, use_legend=False, catalog_path=None,
+                        vcf_backend='native', threads=1, compress_level=bgzf.DEFAULT_LEVEL, reference=None,
+                        region=None, builds=None):
+    """Check for allele switches between target and reference files
+
+    reference is an already loaded (ref_variants, ref_chroms, legend_build),
+    e.g. from load_reference() in the check service or a shared-memory
+    reference_catalog.CatalogSites in batch mode; when given the reference
+    file is not read again. region (chrom, start, end) limits the check to
+    the sites starting in it. builds is the (target, legend) build pair from
+    check_genome_builds() when the caller already ran it.
+    """
+    print(f"Checking allele switches between {target_vcf} and {reference_file}")
+
+    if reference is not None:
+        ref_variants, ref_chroms, legend_build = reference
+    else:
+        catalog, source = open_catalog_source(catalog_path, reference_file) if use_legend else (None, None)
+        legend_build = source['build'] if source else None
+    if builds is None:
+        with run_trace.phase("build_detection"):
+            check_genome_builds(target_vcf, reference_file, output_file, legend_build)
+
+    # With threads to spare, the reference loads while the target is read, sharing the worker processes
+    target_threads = threads
+    reference_loading = None
+    if reference is None and threads > 1:
+        target_threads, ref_threads = stages.split_threads(threads)
+        reference_loading = stages.start_background(load_reference_phase, reference_file, use_legend, catalog,
+                                                    source, vcf_backend, ref_threads, region)
 
     # Get variants from target VCF
     print("Extracting variants from target VCF...")
-    target_view_cmd = f"bcftools view -v snps {target_vcf} | bcftools query -f '%CHROM\\t%POS\\t%REF\\t%ALT\\n' > target_variants.txt"
-    run_command(target_view_cmd)
-    
     target_variants = {}
     original_chroms = {}
     
-    print("Processing target variants...")
-    with open("target_variants.txt", "r") as f:
-        line_count = 0
-        for line in f:
+    line_count = 0
+    with run_trace.phase("target_extraction"):
+        for chrom, original_chrom, pos, ref, alt in iter_vcf_snps(target_vcf, vcf_backend, target_threads, region):
             line_count += 1
-            try:
-                chrom, pos, ref, alt = line.strip().split()
-                # Handle multi-allelic variants by taking first alt
-                alt = alt.split(',')[0]
-                # Save original chromosome notation
-                original_chrom = chrom
-                # Store without 'chr' prefix for consistent matching
-                chrom = chrom.lstrip('chr')
-                target_variants[(chrom, pos)] = (ref, alt)
-                # Store original chromosome notation
-                original_chroms[chrom] = original_chrom
-                
-                # Print sample of variants being processed
-                if line_count <= 5 or line_count % 100000 == 0:
-                    print(f"Sample target variant {line_count}: CHROM={original_chrom}, POS={pos}, REF={ref}, ALT={alt}")
-            except ValueError:
-                # Skip malformed lines
-                continue
+            target_variants[(chrom, pos)] = (ref, alt)
+            # Store original chromosome notation
+            original_chroms[chrom] = original_chrom
+
+            # Print sample of variants being processed
+            if line_count <= 5 or line_count % 100000 == 0:
+                print(f"Sample target variant {line_count}: CHROM={original_chrom}, POS={pos}, REF={ref}, ALT={alt}")
+        run_trace.count("target_records", line_count)
     
     print(f"Processed {len(target_variants)} variants from target VCF.")
     
     # Get variants from reference file
-    if use_legend:
-        print("Parsing reference legend file...")
-        ref_variants, ref_chroms = parse_legend_file(reference_file)
-        # Merge chromosome notations, prioritizing target VCF notation
-        for chrom in ref_chroms:
-            if chrom not in original_chroms:
-                original_chroms[chrom] = ref_chroms[chrom]
+    if reference is not None:
+        print(f"Using loaded reference variants ({len(ref_variants):,} sites)")
+    elif reference_loading is not None:
+        ref_variants, ref_chroms = reference_loading.result()
     else:
-        print("Extracting variants from reference VCF...")
-        ref_view_cmd = f"bcftools view -v snps {reference_file} | bcftools query -f '%CHROM\\t%POS\\t%REF\\t%ALT\\n' > ref_variants.txt"
-        run_command(ref_view_cmd)
-        
-        ref_variants = {}
-        print("Processing reference variants...")
-        with open("ref_variants.txt", "r") as f:
-            line_count = 0
-            for line in f:
-                line_count += 1
-                try:
-                    chrom, pos, ref, alt = line.strip().split()
-                    # Handle multi-allelic variants by taking first alt
-                    alt = alt.split(',')[0]
-                    # Save original chromosome notation
-                    original_chrom = chrom
-                    # Store without 'chr' prefix for consistent matching
-                    chrom = chrom.lstrip('chr')
-                    ref_variants[(chrom, pos)] = (ref, alt)
-                    # Store original chromosome notation if not already present
-                    if chrom not in original_chroms:
-                        original_chroms[chrom] = original_chrom
-                except ValueError:
-                    # Skip malformed lines
-                    continue
-                
-                # Print status every 100,000 lines
-                if line_count % 100000 == 0:
-                    print(f"Processed {line_count} lines from reference file...")
+        ref_variants, ref_chroms = load_reference_phase(reference_file, use_legend, catalog, source, vcf_backend,
+                                                        threads, region)
+    # Merge chromosome notations, prioritizing target VCF notation
+    for chrom in ref_chroms:
+        if chrom not in original_chroms:
+            original_chroms[chrom] = ref_chroms[chrom]
     
     print(f"Processed {len(ref_variants)} variants from reference file.")
     
-    # Find common positions
-    common_positions = set(target_variants.keys()) & set(ref_variants.keys())
+    # Find common positions in target order (probing the reference avoids copying its keys into a second set)
+    with run_trace.phase("intersection"):
+        common_positions = [pos for pos in target_variants if pos in ref_variants]
     num_common = len(common_positions)
     print(f"Found {num_common} variants at common positions")
     
     # Sample a few common positions for debugging
-    sample_positions = list(common_positions)[:5] if num_common > 0 else []
+    sample_positions = common_positions[:5]
     for pos in sample_positions:
         target_ref, target_alt = target_variants[pos]
         ref_ref, ref_alt = ref_variants[pos]
@@ -318,20 +656,19 @@ def check_allele_switch(target_vcf, reference_file, output_file, use_legend=Fals
         print(f"Sample common position: CHROM={original_chrom}, POS={pos[1]}, Target: {target_ref}/{target_alt}, Reference: {ref_ref}/{ref_alt}")
     
     # Check for allele switches
-    matched = 0
-    switched = 0
-    complementary = 0
-    complement_switched = 0
-    other = 0
+    counts = {status: 0 for status in ALLELE_STATUSES}
     
-    # Get reference panel name from the reference file path  
-    ref_panel_name = reference_file.split('/')[-1].replace('.legend.gz', '').replace('.legend', '')
-    ref_panel_file = f"{ref_panel_name}_extracted.legend.gz"
-    
-    # Track matched positions for statistics
-    matched_ref_positions = set()
+    ref_panel_file = extracted_legend_name(reference_file)
+
+    # The extracted legend only needs the common positions, so with threads to spare it is
+    # written while the sites are classified
+    legend_writing = None
+    if threads > 1:
+        legend_writing = stages.start_background(write_extracted_legend, ref_panel_file, common_positions,
+                                                 ref_variants, original_chroms, compress_level, threads)
     
-    with open(output_file, "w") as out:
+    # Switches are written to the results file as they are classified
+    with run_trace.phase("classification"), open(output_file, "w") as out:
         # Write header for allele switches
         out.write("CHROM\tPOS\tALLELE_SWITCH\n")
         
@@ -343,131 +680,1030 @@ def check_allele_switch(target_vcf, reference_file, output_file, use_legend=Fals
             # Use original chromosome notation with 'chr' prefix
             original_chrom = original_chroms.get(chrom, f"chr{chrom}")
             
-            # Track this as a matched position
-            matched_ref_positions.add(pos)
-            
-            # Same alleles
-            if target_ref == ref_ref and target_alt == ref_alt:
-                status = "MATCH"
-                matched += 1
-            # Switched alleles
-            elif target_ref == ref_alt and target_alt == ref_ref:
-                status = "SWITCH"
-                switched += 1
+            status = classify_alleles(target_ref, target_alt, ref_ref, ref_alt)
+            counts[status] += 1
+            if status == "SWITCH":
                 # Only write SWITCH variants in 1-based coordinate format
                 # Add additional info as a third column
                 allele_info = f"{target_ref}>{target_alt}|{ref_ref}>{ref_alt}"
                 out.write(f"{original_chrom}\t{position}\t{allele_info}\n")
-            # Complementary alleles (A↔T, C↔G)
-            elif (is_complement(target_ref, ref_ref) and is_complement(target_alt, ref_alt)):
-                status = "COMPLEMENT"
-                complementary += 1
-            # Complementary + switch
-            elif (is_complement(target_ref, ref_alt) and is_complement(target_alt, ref_ref)):
-                status = "COMPLEMENT_SWITCH"
-                complement_switched += 1
-            else:
-                status = "OTHER"
-                other += 1
     
     # Create the reference panel legend file with ONLY variants that were compared
-    try:
-        with gzip.open(ref_panel_file, 'wt') as ref_out:
-            # Write legend header (matching the original format)
-            ref_out.write("ID\tCHROM\tPOS\tREF\tALT\n")
+    if legend_writing is None:
+        write_extracted_legend(ref_panel_file, common_positions, ref_variants, original_chroms, compress_level,
+                               threads)
+    else:
+        legend_writing.result()
 
-            # Write ONLY reference variants at common positions (sites that were actually compared)
-            variants_written = 0
-            for pos in sorted(common_positions):
-                chrom, position = pos
-                ref_ref, ref_alt = ref_variants[pos]
-                # Use original chromosome notation
-                original_chrom = original_chroms.get(chrom, f"chr{chrom}")
+    print_results_summary(output_file, ref_panel_file, len(target_variants), len(ref_variants), num_common, counts)
+    target_chroms = sorted({chrom for chrom, _ in target_variants}, key=chrom_sort_key)
+    return metrics.build_record(target_vcf, reference_file, 'memory', [original_chroms[c] for c in target_chroms],
+                                len(target_variants), len(ref_variants), num_common, counts)
 
-                # Create variant ID
-                variant_id = f"{original_chrom}:{position}:{ref_ref}:{ref_alt}"
+def iter_query_records(lines):
+    """Yield (chrom, original_chrom, pos, ref, alt) from 'CHROM POS REF ALT' query lines"""
+    for line in lines:
+        try:
+            original_chrom, pos, ref, alt = line.strip().split()
+        except ValueError:
+            # Skip malformed lines
+            continue
+        # Handle multi-allelic variants by taking first alt
+        alt = alt.split(',')[0]
+        # Store without 'chr' prefix for consistent matching
+        yield original_chrom.lstrip('chr'), original_chrom, pos, ref, alt
 
-                # Write variant
-                ref_out.write(f"{variant_id}\t{original_chrom}\t{position}\t{ref_ref}\t{ref_alt}\n")
-                variants_written += 1
-        print(f"Successfully created reference legend file: {ref_panel_file}")
-        print(f"Wrote {variants_written:,} reference variants at compared positions")
-    except Exception as e:
-        print(f"Error creating reference legend file: {e}")
-        # Create a simple uncompressed legend file as fallback
+def catalog_records(catalog, source, region=None):
+    """Records of a catalog source, limited to a region if given"""
+    records = catalog.iter_records(source)
+    return records if region is None else shards.filter_records(records, region)
+
+def iter_vcf_snps(vcf_file, backend='native', threads=1, region=None):
+    """Yield (chrom, original_chrom, pos, ref, alt) for SNP records of a VCF (in region, if given)"""
+    if region is not None:
+        index_path = tabix_index.current_index(vcf_file)
+        if backend == 'native' and index_path is not None and bgzf.is_bgzf(vcf_file):
+            # Read only the blocks of the region through the index
+            print(f"Reading {shards.format_region(region)} of {vcf_file} through {index_path}")
+            return shards.fetch_records(vcf_file, index_path, region, vcf_reader.parse_snp_line)
+        return shards.filter_records(iter_vcf_snps(vcf_file, backend, threads), region)
+    if backend == 'native':
         try:
-            ref_panel_file_txt = ref_panel_file.replace('.gz', '')
-            variants_written = 0
-            with open(ref_panel_file_txt, 'w') as ref_out:
-                ref_out.write("ID\tCHROM\tPOS\tREF\tALT\n")
-                for pos in sorted(common_positions):
-                    chrom, position = pos
-                    ref_ref, ref_alt = ref_variants[pos]
-                    original_chrom = original_chroms.get(chrom, f"chr{chrom}")
-                    variant_id = f"{original_chrom}:{position}:{ref_ref}:{ref_alt}"
-                    ref_out.write(f"{variant_id}\t{original_chrom}\t{position}\t{ref_ref}\t{ref_alt}\n")
-                    variants_written += 1
-            print(f"Created uncompressed reference legend file: {ref_panel_file_txt}")
-            print(f"Wrote {variants_written:,} reference variants at compared positions")
-        except Exception as e2:
-            print(f"Error creating uncompressed legend file: {e2}")
-    
-    # Clean up
-    run_command("rm target_variants.txt")
-    if not use_legend:
-        run_command("rm ref_variants.txt")
-    
-    # Print summary
-    print("\nResults Summary:")
-    print(f"Total variants in target VCF: {len(target_variants)}")
-    print(f"Total variants in reference: {len(ref_variants)}")
-    print(f"Total variants at common positions: {num_common}")
-    
-    # Calculate overlap percentages
-    if len(target_variants) > 0:
-        target_overlap_pct = (num_common / len(target_variants)) * 100
-        print(f"Overlap with target VCF: {num_common}/{len(target_variants)} ({target_overlap_pct:.2f}%)")
-    
-    if len(ref_variants) > 0:
-        ref_overlap_pct = (num_common / len(ref_variants)) * 100
-        print(f"Overlap with reference: {num_common}/{len(ref_variants)} ({ref_overlap_pct:.2f}%)")
-    
-    if num_common > 0:
-        print(f"Matched variants: {matched} ({matched/num_common*100:.2f}%)")
-        print(f"Switched alleles (written to file): {switched} ({switched/num_common*100:.2f}%)")
-        print(f"Complementary strand issues: {complementary} ({complementary/num_common*100:.2f}%)")
-        print(f"Complement + switch issues: {complement_switched} ({complement_switched/num_common*100:.2f}%)")
-        print(f"Other inconsistencies: {other} ({other/num_common*100:.2f}%)")
+            # Probe once so BCF input is detected before any record is consumed
+            vcf_reader.open_vcf(vcf_file).close()
+            return vcf_reader.iter_snp_records(vcf_file, threads)
+        except vcf_reader.UnsupportedVcfError as e:
+            print(f"{e}; using bcftools instead")
+    query_cmd = f"bcftools view -v snps {vcf_file} | bcftools query -f '%CHROM\\t%POS\\t%REF\\t%ALT\\n'"
+    return iter_query_records(stream_command(query_cmd))
+
+def iter_unique_sites(records, label):
+    """Collapse repeated sites (last record wins) and verify the input is position-sorted"""
+    prev_key = None
+    pending = None
+    for record in records:
+        key = (chrom_sort_key(record[0]), int(record[2]))
+        if pending is not None:
+            if key == prev_key:
+                pending = record
+                continue
+            if key < prev_key:
+                raise UnsortedInputError(
+                    f"{label} is not sorted: {record[1]}:{record[2]} appears after "
+                    f"{pending[1]}:{pending[2]}")
+        if pending is not None:
+            yield prev_key, pending
+        prev_key, pending = key, record
+    if pending is not None:
+        yield prev_key, pending
+
+def merge_join(target_sites, ref_sites):
+    """Walk two sorted site streams together, yielding (target, reference) records at shared sites"""
+    target_iter = iter(target_sites)
+    ref_iter = iter(ref_sites)
+    target = next(target_iter, None)
+    ref = next(ref_iter, None)
+    while target is not None and ref is not None:
+        if target[0] < ref[0]:
+            target = next(target_iter, None)
+        elif ref[0] < target[0]:
+            ref = next(ref_iter, None)
+        else:
+            yield target[1], ref[1]
+            target = next(target_iter, None)
+            ref = next(ref_iter, None)
+
+    # Drain the remaining stream so totals and sort checks cover the whole file
+    for _ in target_iter:
+        pass
+    for _ in ref_iter:
+        pass
+
+def count_sites(sites, totals, key, label=None, chroms=None):
+    """Pass sites through while counting them (and printing a sample if label is set)"""
+    for site in sites:
+        totals[key] += 1
+        if chroms is not None and site[1][1] not in chroms:
+            chroms.append(site[1][1])
+        if label and (totals[key] <= 5 or totals[key] % 100000 == 0):
+            record = site[1]
+            print(f"Sample {label} {totals[key]}: CHROM={record[1]}, POS={record[2]}, REF={record[3]}, ALT={record[4]}")
+        yield site
+
+def check_allele_switch_streaming(target_vcf, reference_file, output_file, use_legend=False, catalog_path=None,
+                                  vcf_backend='native', threads=1, compress_level=bgzf.DEFAULT_LEVEL, region=None,
+                                  builds=None):
+    """Check for allele switches with a single sorted merge-join pass over both inputs"""
+    print(f"Checking allele switches between {target_vcf} and {reference_file} (streaming)")
+
+    catalog, source = open_catalog_source(catalog_path, reference_file) if use_legend else (None, None)
+    if builds is None:
+        with run_trace.phase("build_detection"):
+            check_genome_builds(target_vcf, reference_file, output_file, source['build'] if source else None)
+
+    # Both inputs are read at once, so they share the worker processes
+    target_threads, ref_threads = stages.split_threads(threads) if threads > 1 else (1, 1)
+
+    print("Streaming variants from target VCF...")
+    target_records = iter_vcf_snps(target_vcf, vcf_backend, target_threads, region)
+
+    if catalog is not None:
+        print("Streaming reference variants from catalog...")
+        ref_records = catalog_records(catalog, source, region)
+    elif use_legend:
+        print("Streaming reference legend file...")
+        ref_records = iter_legend_records(reference_file, ref_threads, region)
     else:
-        print("No common positions found between target and reference files.")
-    
-    print(f"Switched alleles written to file: {output_file}")
-    print(f"Reference panel legend file created: {ref_panel_file}")
-    print(f"Total variants in source reference: {len(ref_variants)}")
-    print(f"Variants compared (written to extracted legend): {len(common_positions)}")
-    print(f"  - Matched: {len(matched_ref_positions)}")
-    print(f"  - Switched: {switched}")
+        print("Streaming variants from reference VCF...")
+        ref_records = iter_vcf_snps(reference_file, vcf_backend, ref_threads, region)
+
+    if threads > 1:
+        # Reader threads inflate and tokenize both inputs ahead of the join, through bounded queues
+        target_records = stages.prefetch(target_records, name='target-reader')
+        ref_records = stages.prefetch(ref_records, name='reference-reader')
+
+    totals = {"target": 0, "ref": 0}
+    counts = {status: 0 for status in ALLELE_STATUSES}
+    num_common = 0
+    ref_panel_file = extracted_legend_name(reference_file)
+
+    # Reading, joining, classifying and both writes interleave in one pass, traced as a single phase
+    with run_trace.phase("merge_join"), open(output_file, "w") as out, \
+            ExtractedLegendWriter(ref_panel_file, compress_level, threads) as ref_out:
+        out.write("CHROM\tPOS\tALLELE_SWITCH\n")
+
+        target_chroms = []
+        target_sites = count_sites(iter_unique_sites(target_records, "Target VCF"), totals, "target", "target variant",
+                                   target_chroms)
+        ref_sites = count_sites(iter_unique_sites(ref_records, "Reference"), totals, "ref")
+        joined = merge_join(target_sites, ref_sites)
+        for target, ref in joined:
+            num_common += 1
+            # Target notation wins, as in the in-memory engine
+            original_chrom = target[1]
+            position = target[2]
+            target_ref, target_alt = target[3], target[4]
+            ref_ref, ref_alt = ref[3], ref[4]
+
+            if num_common <= 5:
+                print(f"Sample common position: CHROM={original_chrom}, POS={position}, Target: {target_ref}/{target_alt}, Reference: {ref_ref}/{ref_alt}")
+
+            status = classify_alleles(target_ref, target_alt, ref_ref, ref_alt)
+            counts[status] += 1
+            if status == "SWITCH":
+                out.write(f"{original_chrom}\t{position}\t{target_ref}>{target_alt}|{ref_ref}>{ref_alt}\n")
+
+            # Sites arrive in genomic order, so the extracted legend needs no sort
+            ref_out.add(original_chrom, position, ref_ref, ref_alt)
+        run_trace.count("target_records", totals["target"])
+        run_trace.count("reference_records", totals["ref"])
+
+    print(f"Processed {totals['target']} variants from target VCF.")
+    print(f"Processed {totals['ref']} variants from reference file.")
+    print(f"Found {num_common} variants at common positions")
+    print(f"Successfully created reference legend file: {ref_panel_file}")
+    print(f"Wrote {num_common:,} reference variants at compared positions")
+
+    print_results_summary(output_file, ref_panel_file, totals["target"], totals["ref"], num_common, counts)
+    return metrics.build_record(target_vcf, reference_file, 'streaming', target_chroms,
+                                totals["target"], totals["ref"], num_common, counts)
+
+def check_allele_switch_columnar(target_vcf, reference_file, output_file, use_legend=False, catalog_path=None,
+                                 vcf_backend='native', threads=1, compress_level=bgzf.DEFAULT_LEVEL, region=None,
+                                 builds=None):
+    """Check for allele switches using NumPy-backed variant tables and vectorized classification"""
+    import variant_table
+    np = variant_table.np
+    if np is None:
+        print("ERROR: the columnar engine requires NumPy")
+        print("Install numpy or rerun with --engine memory / --engine streaming.")
+        sys.exit(1)
+
+    print(f"Checking allele switches between {target_vcf} and {reference_file} (columnar)")
+
+    catalog, source = open_catalog_source(catalog_path, reference_file) if use_legend else (None, None)
+    if builds is None:
+        with run_trace.phase("build_detection"):
+            check_genome_builds(target_vcf, reference_file, output_file, source['build'] if source else None)
+
+    def load_reference_tables(ref_threads):
+        with run_trace.phase("reference_parse"):
+            if catalog is not None and region is None:
+                # Arrays are mapped straight from the catalog file, nothing to parse
+                print("Mapping reference variants from catalog...")
+                tables = {chrom: variant_table.table_from_catalog(catalog.chrom(chrom))
+                          for chrom in source['chroms']}
+            elif catalog is not None:
+                print("Loading reference variants in the region from catalog...")
+                tables = variant_table.build_tables(catalog_records(catalog, source, region))
+            elif use_legend:
+                print("Parsing reference legend file...")
+                tables = variant_table.build_tables(iter_legend_records(reference_file, ref_threads, region))
+            else:
+                print("Extracting variants from reference VCF...")
+                tables = variant_table.build_tables(iter_vcf_snps(reference_file, vcf_backend, ref_threads, region))
+            run_trace.count("reference_records", sum(len(table) for table in tables.values()))
+        return tables
+
+    # With threads to spare, the reference tables build while the target is read, sharing the worker processes
+    target_threads = threads
+    reference_loading = None
+    if threads > 1:
+        target_threads, ref_threads = stages.split_threads(threads)
+        reference_loading = stages.start_background(load_reference_tables, ref_threads)
+
+    print("Extracting variants from target VCF...")
+    with run_trace.phase("target_extraction"):
+        target_tables = variant_table.build_tables(iter_vcf_snps(target_vcf, vcf_backend, target_threads, region))
+        num_target = sum(len(table) for table in target_tables.values())
+        run_trace.count("target_records", num_target)
+    print(f"Processed {num_target} variants from target VCF.")
+
+    ref_tables = reference_loading.result() if reference_loading is not None else load_reference_tables(threads)
+    num_ref = sum(len(table) for table in ref_tables.values())
+    print(f"Processed {num_ref} variants from reference file.")
+    table_bytes = sum(t.nbytes for t in target_tables.values()) + sum(t.nbytes for t in ref_tables.values())
+    print(f"Variant tables use {table_bytes / 1e6:.1f} MB")
+
+    status_table = variant_table.build_status_table(classify_alleles)
+    switch_code = variant_table.STATUS_CODES["SWITCH"]
+    status_counts = np.zeros(len(ALLELE_STATUSES), dtype=np.int64)
+    num_common = 0
+    ref_panel_file = extracted_legend_name(reference_file)
+
+    with open(output_file, "w") as out, ExtractedLegendWriter(ref_panel_file, compress_level, threads) as ref_out:
+        out.write("CHROM\tPOS\tALLELE_SWITCH\n")
+
+        for chrom in sorted(target_tables, key=chrom_sort_key):
+            if chrom not in ref_tables:
+                continue
+            target = target_tables[chrom]
+            reference = ref_tables[chrom]
+            # Target notation wins, as in the in-memory engine
+            original_chrom = target.original_chrom
+
+            # Phases entered once per chromosome add up in the trace summary
+            with run_trace.phase("intersection"):
+                target_rows, ref_rows = variant_table.join_sites(target, reference)
+            with run_trace.phase("classification"):
+                statuses = variant_table.classify_sites(target, reference, target_rows, ref_rows,
+                                                        status_table, classify_alleles)
+                status_counts += np.bincount(statuses, minlength=len(ALLELE_STATUSES))
+
+            for i in range(min(5 - num_common, len(target_rows))):
+                target_ref, target_alt = target.alleles(int(target_rows[i]))
+                ref_ref, ref_alt = reference.alleles(int(ref_rows[i]))
+                print(f"Sample common position: CHROM={original_chrom}, POS={target.positions[target_rows[i]]}, Target: {target_ref}/{target_alt}, Reference: {ref_ref}/{ref_alt}")
+            num_common += len(target_rows)
+
+            with run_trace.phase("write_results"):
+                for i in np.nonzero(statuses == switch_code)[0]:
+                    target_ref, target_alt = target.alleles(int(target_rows[i]))
+                    ref_ref, ref_alt = reference.alleles(int(ref_rows[i]))
+                    out.write(f"{original_chrom}\t{target.positions[target_rows[i]]}\t{target_ref}>{target_alt}|{ref_ref}>{ref_alt}\n")
+
+            # Joined rows are already in ascending position order
+            with run_trace.phase("write_extracted_legend"):
+                for row, position in zip(ref_rows.tolist(), reference.positions[ref_rows].tolist()):
+                    ref_ref, ref_alt = reference.alleles(row)
+                    ref_out.add(original_chrom, position, ref_ref, ref_alt)
+
+    print(f"Found {num_common} variants at common positions")
+    print(f"Successfully created reference legend file: {ref_panel_file}")
+    print(f"Wrote {num_common:,} reference variants at compared positions")
+
+    counts = dict(zip(ALLELE_STATUSES, (int(c) for c in status_counts)))
+    print_results_summary(output_file, ref_panel_file, num_target, num_ref, num_common, counts)
+    target_chroms = [target_tables[chrom].original_chrom for chrom in sorted(target_tables, key=chrom_sort_key)]
+    return metrics.build_record(target_vcf, reference_file, 'columnar', target_chroms,
+                                num_target, num_ref, num_common, counts)
+
+def reference_lookup(reference_file, use_legend=False, catalog=None, source=None, vcf_backend='native', threads=1):
+    """Return (lookup, num_ref) where lookup(chrom, pos) gives the reference (ref, alt) at a site or None"""
+    if catalog is not None:
+        # Binary-search the mapped position arrays directly, nothing is loaded
+        print("Mapping reference variants from catalog...")
+        tables = {chrom: catalog.chrom(chrom) for chrom in source['chroms']}
+
+        def lookup(chrom, pos):
+            table = tables.get(chrom)
+            if table is None:
+                return None
+            pos = int(pos)
+            row = bisect.bisect_left(table.positions, pos)
+            if row < len(table.positions) and table.positions[row] == pos:
+                return table.alleles(row)
+            return None
+
+        return lookup, sum(len(table) for table in tables.values())
+
+    if use_legend:
+        print("Parsing reference legend file...")
+        ref_variants, _ = parse_legend_file(reference_file, threads)
+    else:
+        print("Extracting variants from reference VCF...")
+        ref_variants, _ = collect_variants(iter_vcf_snps(reference_file, vcf_backend, threads))
+    return (lambda chrom, pos: ref_variants.get((chrom, pos))), len(ref_variants)
+
+def check_and_correct(target_vcf, reference_file, output_file, use_legend=False, catalog_path=None,
+                      vcf_backend='native', threads=1, compress_level=bgzf.DEFAULT_LEVEL, corrected_vcf=None):
+    """Check allele switches and write the corrected target (BGZF + .tbi) in the same pass over the target"""
+    print(f"Checking and correcting allele switches between {target_vcf} and {reference_file} (fused)")
+
+    catalog, source = open_catalog_source(catalog_path, reference_file) if use_legend else (None, None)
+    with run_trace.phase("build_detection"):
+        check_genome_builds(target_vcf, reference_file, output_file, source['build'] if source else None)
+
+    with run_trace.phase("reference_parse"):
+        lookup, num_ref = reference_lookup(reference_file, use_legend, catalog, source, vcf_backend, threads)
+        run_trace.count("reference_records", num_ref)
+    print(f"Processed {num_ref} variants from reference file.")
+
+    try:
+        target = vcf_reader.open_vcf(target_vcf)
+    except vcf_reader.UnsupportedVcfError as e:
+        print(f"ERROR: {e}")
+        print("Convert the target to VCF (bcftools view -Oz) or rerun without --correct-output.")
+        sys.exit(1)
+
+    counts = {status: 0 for status in ALLELE_STATUSES}
+    num_target = 0
+    num_common = 0
+    fixed_count = 0
+    failed_count = 0
+    ref_panel_file = extracted_legend_name(reference_file)
+    index = tabix_index.TabixIndexBuilder()
+
+    # Target reading, classification, correction and all three writes share one pass, traced as one phase
+    with run_trace.phase("check_and_correct"), target, open(output_file, "w") as out, \
+            ExtractedLegendWriter(ref_panel_file, compress_level, threads) as ref_out, \
+            bgzf.BgzfWriter(corrected_vcf, compress_level, threads) as vcf_out:
+        out.write("CHROM\tPOS\tALLELE_SWITCH\n")
+
+        header = []
+        first_record = None
+        for line in target:
+            if not line.startswith(b'#'):
+                first_record = line
+                break
+            header.append(line)
+
+        # Declare the SWITCHED flag (and the contig, if missing) ahead of the #CHROM line
+        extra_header = []
+        if not any(line.startswith(b'##INFO=<ID=SWITCHED,') for line in header):
+            extra_header.append(SWITCHED_INFO_HEADER)
+        if first_record is not None:
+            first_chrom = first_record.split(b'\t', 1)[0]
+            if not any(line.startswith(b'##contig=<ID=' + first_chrom + b',') or
+                       line.startswith(b'##contig=<ID=' + first_chrom + b'>') for line in header):
+                extra_header.append(b'##contig=<ID=' + first_chrom + b'>\n')
+        if header and header[-1].startswith(b'#CHROM'):
+            header[-1:-1] = extra_header
+        else:
+            header.extend(extra_header)
+        vcf_out.write(b''.join(header))
+
+        def finish_site(record, ref_alleles, status):
+            nonlocal num_target, num_common
+            num_target += 1
+            if num_target <= 5 or num_target % 100000 == 0:
+                print(f"Sample target variant {num_target}: CHROM={record[1]}, POS={record[2]}, REF={record[3]}, ALT={record[4]}")
+            if ref_alleles is None:
+                return
+            num_common += 1
+            original_chrom, position, target_ref, target_alt = record[1], record[2], record[3], record[4]
+            ref_ref, ref_alt = ref_alleles
+            if num_common <= 5:
+                print(f"Sample common position: CHROM={original_chrom}, POS={position}, Target: {target_ref}/{target_alt}, Reference: {ref_ref}/{ref_alt}")
+            counts[status] += 1
+            if status == "SWITCH":
+                out.write(f"{original_chrom}\t{position}\t{target_ref}>{target_alt}|{ref_ref}>{ref_alt}\n")
+            ref_out.add(original_chrom, position, ref_ref, ref_alt)
+
+        # The last record at a repeated site is the one reported, as in the other engines
+        pending = None
+        pending_key = None
+        prev_beg = -1
+        # With threads to spare, a reader thread inflates and splits target lines ahead of the classifier
+        lines = stages.prefetch(target, name='target-reader') if threads > 1 else target
+        for line in itertools.chain([first_record] if first_record is not None else [], lines):
+            if line.startswith(b'#'):
+                continue
+            fields = line.split(b'\t', 8)
+            if len(fields) < 8:
+                vcf_out.write(line)
+                continue
+            chrom_name = fields[0].decode()
+            beg, end = tabix_index.vcf_span(fields[1], fields[3], fields[7])
+            # The index (and the site de-duplication below) need coordinate-sorted input
+            if index.names and (beg < prev_beg if chrom_name == index.names[-1] else chrom_name in index.names):
+                raise UnsortedInputError(f"Target VCF is not sorted: {chrom_name}:{beg + 1} appears after "
+                                         f"{index.names[-1]}:{prev_beg + 1}")
+            prev_beg = beg
+            key = (chrom_name, beg)
+
+            status = None
+            record = None
+            alleles = vcf_reader.snp_alleles(fields[3], fields[4])
+            if alleles is not None:
+                record = (chrom_name.lstrip('chr'), chrom_name, fields[1].decode(), alleles[0], alleles[1])
+                ref_alleles = lookup(record[0], record[2])
+                if ref_alleles is not None:
+                    status = classify_alleles(alleles[0], alleles[1], ref_alleles[0], ref_alleles[1])
+                    if status == "SWITCH":
+                        corrected = genotype_flip.flip_record(line)
+                        if corrected is None:
+                            failed_count += 1
+                        else:
+                            line = corrected
+                            fixed_count += 1
+
+            vstart = vcf_out.tell()
+            vcf_out.write(line)
+            index.add(chrom_name, beg, end, vstart, vcf_out.tell())
+
+            if record is None:
+                continue
+            if pending is not None and key != pending_key:
+                finish_site(*pending)
+            pending = (record, ref_alleles, status)
+            pending_key = key
+        if pending is not None:
+            finish_site(*pending)
+        run_trace.count("target_records", num_target)
+        if isinstance(target.raw, gzip.GzipFile):
+            run_trace.count("bytes_decompressed", target.raw.tell())
+
+    with run_trace.phase("write_index"):
+        index.write(f"{corrected_vcf}.tbi", vcf_out.resolve)
+
+    print(f"Processed {num_target} variants from target VCF.")
+    print(f"Found {num_common} variants at common positions")
+    print(f"Successfully created reference legend file: {ref_panel_file}")
+    print(f"Wrote {num_common:,} reference variants at compared positions")
+    print(f"Corrected VCF written to: {corrected_vcf} (indexed)")
+
+    print_results_summary(output_file, ref_panel_file, num_target, num_ref, num_common, counts)
+    print(f"Corrected switched sites: {fixed_count}")
+    print(f"Switched sites left uncorrected (multi-allelic or non-ACGT): {failed_count}")
+    return metrics.build_record(target_vcf, reference_file, 'fused', index.names, num_target, num_ref, num_common,
+                                counts, corrections={"fixed": fixed_count, "failed": failed_count})
+
+def read_switch_results(switch_results):
+    """Return {(chrom, pos): original_chrom} for the sites listed in an allele switch results file"""
+    sites = {}
+    with open(switch_results) as f:
+        next(f, None)
+        for line in f:
+            cols = line.split('\t')
+            if len(cols) < 2 or line.startswith('#'):
+                continue
+            sites[(cols[0].lstrip('chr'), cols[1].strip())] = cols[0]
+    return sites
+
+def site_order(key):
+    """Genomic sort key of a (chrom, pos) site"""
+    return chrom_sort_key(key[0]), int(key[1])
+
+def lookup_target_sites(target_vcf, sites, vcf_backend='native', threads=1):
+    """Return {(chrom, pos): record} for the target SNPs at the given sites, through the target's index if it has one"""
+    target = {}
+    index_path = f"{target_vcf}.tbi"
+    if os.path.exists(index_path):
+        index = tabix_index.TabixIndex(index_path)
+        names = {name.lstrip('chr'): name for name in index.names}
+        with bgzf.BgzfReader(target_vcf) as reader:
+            for key in sorted(sites, key=lambda k: (chrom_sort_key(k[0]), int(k[1]))):
+                name = names.get(key[0])
+                if name is None:
+                    continue
+                pos = int(key[1])
+                for line in index.fetch(reader, name, pos - 1, pos):
+                    record = vcf_reader.parse_snp_line(line)
+                    # Last SNP record starting at the site wins, as in the full check
+                    if record is not None and record[2] == key[1]:
+                        target[key] = record
+    else:
+        print(f"No index found at {index_path}; scanning the target VCF for the selected sites")
+        for record in iter_vcf_snps(target_vcf, vcf_backend, threads):
+            key = (record[0], record[2])
+            if key in sites:
+                target[key] = record
+    return target
+
+def fetch_reference_sites(reference_file, index_path, use_legend, switched, sample_size, rng):
+    """Reference records at the switched sites through its .tbi, plus untouched ones after random BGZF seeks
+
+    Returns (records at switched sites, sampled untouched records, number of seeks).
+    """
+    # Block seeking is shared with the preflight sampler, which imports this module
+    import preflight
+
+    parse_line = preflight.reference_parser(reference_file, use_legend)
+    index = tabix_index.TabixIndex(index_path)
+    names = {name.lstrip('chr'): name for name in index.names}
+    found = {}
+    with bgzf.BgzfReader(reference_file) as reader:
+        for key in sorted(switched, key=site_order):
+            name = names.get(key[0])
+            if name is None:
+                continue
+            pos = int(key[1])
+            for line in index.fetch(reader, name, pos - 1, pos):
+                record = parse_line(line)
+                # Last record at the site wins, as in the full check
+                if record is not None and record[0] == key[0] and record[2] == key[1]:
+                    found[key] = record
+
+    # Runs of consecutive untouched sites, each after a seek to a random block of one stratum
+    seeks = -(-sample_size // VERIFY_RUN)
+    end = preflight.data_end(reference_file)
+    sampled = {}
+    last_block = -1
+    with open(reference_file, 'rb') as f, bgzf.BgzfReader(reference_file) as reader:
+        for i in range(seeks):
+            coffset = preflight.next_block(f, end * i // seeks + rng.randrange(max(1, end // seeks)), end)
+            if coffset is None or coffset <= last_block:
+                continue
+            last_block = coffset
+            taken = 0
+            for line in preflight.lines_from(reader, coffset):
+                record = parse_line(line)
+                if record is None or (record[0], record[2]) in switched:
+                    continue
+                sampled[(record[0], record[2])] = record
+                taken += 1
+                if taken >= VERIFY_RUN or len(sampled) >= sample_size:
+                    break
+            if len(sampled) >= sample_size:
+                break
+    return found, list(sampled.values()), seeks
+
+def verify_corrections(target_vcf, reference_file, output_file, use_legend=False, vcf_backend='native', threads=1,
+                       switch_results=None, sample_size=1000, seed=1):
+    """Re-check only the previously switched sites plus a random sample of untouched sites"""
+    print(f"Verifying {target_vcf} against {reference_file} at the sites listed in {switch_results}")
+    switched = read_switch_results(switch_results)
+    print(f"Loaded {len(switched)} switched sites to verify")
+
+    rng = random.Random(seed)
+    index_path = tabix_index.current_index(reference_file)
+    if index_path is not None and bgzf.is_bgzf(reference_file):
+        # E.g. the extracted legend of the check: only the blocks holding the sites are read
+        reference, sampled, seeks = fetch_reference_sites(reference_file, index_path, use_legend, switched,
+                                                          sample_size, rng)
+        sample_note = f"from {seeks} random block seeks through {index_path}"
+    else:
+        # Reference alleles at the switched sites, plus a reservoir sample of the other sites
+        print(f"No up-to-date index for {reference_file}; reading the whole reference")
+        if use_legend:
+            records = iter_legend_records(reference_file, threads)
+        else:
+            records = iter_vcf_snps(reference_file, vcf_backend, threads)
+        reference = {}
+        sampled = []
+        seen_untouched = 0
+        for record in records:
+            key = (record[0], record[2])
+            if key in switched:
+                reference[key] = record
+                continue
+            seen_untouched += 1
+            if len(sampled) < sample_size:
+                sampled.append(record)
+            else:
+                slot = rng.randrange(seen_untouched)
+                if slot < sample_size:
+                    sampled[slot] = record
+        sample_note = f"of {seen_untouched}"
+    # Counted before the sample is merged in: repeated positions collapse to one entry
+    missing_ref = len(switched) - sum(key in reference for key in switched)
+    for record in sampled:
+        reference[(record[0], record[2])] = record
+    print(f"Sampled {len(sampled)} untouched reference sites {sample_note}")
+
+    if missing_ref:
+        print(f"WARNING: {missing_ref} switched sites are not in the reference and cannot be verified")
+
+    target = lookup_target_sites(target_vcf, reference, vcf_backend, threads)
+
+    counts = {status: 0 for status in ALLELE_STATUSES}
+    switched_found = 0
+    sampled_found = 0
+    with open(output_file, "w") as out:
+        out.write("CHROM\tPOS\tALLELE_SWITCH\n")
+        for key in sorted(target, key=lambda k: (chrom_sort_key(k[0]), int(k[1]))):
+            _, original_chrom, position, target_ref, target_alt = target[key]
+            _, _, _, ref_ref, ref_alt = reference[key]
+            if key in switched:
+                switched_found += 1
+            else:
+                sampled_found += 1
+            status = classify_alleles(target_ref, target_alt, ref_ref, ref_alt)
+            counts[status] += 1
+            if status == "SWITCH":
+                out.write(f"{original_chrom}\t{position}\t{target_ref}>{target_alt}|{ref_ref}>{ref_alt}\n")
+
+    print("\nVerification Summary:")
+    print(f"Switched sites checked: {len(switched) - missing_ref} ({switched_found} present in target, "
+          f"{len(switched) - missing_ref - switched_found} removed)")
+    print(f"Untouched sites sampled: {len(reference) - (len(switched) - missing_ref)} "
+          f"({sampled_found} present in target)")
+    for status in ALLELE_STATUSES:
+        print(f"  - {status}: {counts[status]}")
+    print(f"Remaining switches: {counts['SWITCH']}")
+    print(f"Remaining switches written to file: {output_file}")
+
+def update_check(target_vcf, reference_file, output_file, vcf_backend='native', threads=1,
+                 compress_level=bgzf.DEFAULT_LEVEL, previous=None, panel_diff=None):
+    """Bring the outputs of a check against an old legend up to date with a new release, given their diff
+
+    previous is the metrics record of the old check and panel_diff the
+    (header, sites) of panel_diff.read_panel_diff(). Only the changed sites
+    the target holds are looked up and re-classified; the switch results and
+    extracted legend are rewritten in place as a full check against the new
+    legend would write them, and the updated record is returned. Inputs are
+    matched by checksum: the target must be the file the previous check read,
+    and the previous and new legends the two releases the diff was made from.
+    """
+    header, diff_sites = panel_diff
+    old_name = header["old_legend"]["file"]
+    new_name = header["new_legend"]["file"]
+    if previous["mode"] == 'fused':
+        raise ValueError("the previous check corrected the target in the same pass; the corrected VCF cannot be "
+                         "updated from a panel diff, rerun the full check")
+    if not previous.get("target_sha256") or not previous.get("reference_sha256"):
+        raise ValueError("the previous metrics record has no input checksums (target_sha256, reference_sha256); "
+                         "rerun the full check")
+    if previous["reference_sha256"] != header["old_legend"]["sha256"]:
+        raise ValueError(f"the previous check used {os.path.basename(previous['reference_file'])}, "
+                         f"but the panel diff starts from another legend ({old_name})")
+    reference_sha256 = profile_input.file_sha256(reference_file)
+    if reference_sha256 != header["new_legend"]["sha256"]:
+        raise ValueError(f"{reference_file} is not the {new_name} the panel diff leads to (checksum differs)")
+    target_sha256 = profile_input.file_sha256(target_vcf, 'vcf')
+    if target_sha256 != previous["target_sha256"]:
+        raise ValueError(f"{target_vcf} is not the target the previous check read (checksum differs); "
+                         f"rerun the full check")
+
+    print(f"Updating the check of {target_vcf} from {old_name} to {new_name} "
+          f"({len(diff_sites)} sites changed between the releases)")
+    with run_trace.phase("build_detection"):
+        check_genome_builds(target_vcf, reference_file, output_file)
+
+    region = shards.parse_region(previous["region"]) if previous.get("region") else None
+    if region is not None:
+        diff_sites = {key: site for key, site in diff_sites.items() if shards.in_region(region, key[0], key[1])}
+    changes = {"ADDED": 0, "REMOVED": 0, "CHANGED": 0}
+    for _, change, _, _ in diff_sites.values():
+        changes[change] += 1
+
+    with run_trace.phase("target_extraction"):
+        target = lookup_target_sites(target_vcf, diff_sites, vcf_backend, threads)
+        run_trace.count("target_records", len(target))
+    print(f"Target holds {len(target)} of the changed sites")
+
+    # Take each changed site the target holds out of the old classification and into the new one
+    counts = dict(previous["counts"])
+    num_common = previous["totals"]["common"]
+    switch_rows = {}
+    legend_rows = {}
+    with run_trace.phase("classification"):
+        for key, record in target.items():
+            _, original_chrom, position, target_ref, target_alt = record
+            _, _, old, new = diff_sites[key]
+            if old is not None:
+                counts[classify_alleles(target_ref, target_alt, old[0], old[1])] -= 1
+                num_common -= 1
+            switch_rows[key] = None
+            legend_rows[key] = None
+            if new is not None:
+                status = classify_alleles(target_ref, target_alt, new[0], new[1])
+                counts[status] += 1
+                num_common += 1
+                legend_rows[key] = (original_chrom, position, new[0], new[1])
+                if status == "SWITCH":
+                    switch_rows[key] = f"{original_chrom}\t{position}\t{target_ref}>{target_alt}|{new[0]}>{new[1]}\n"
+
+    old_panel_file = extracted_legend_name(previous["reference_file"])
+    ref_panel_file = extracted_legend_name(reference_file)
+    if not os.path.exists(old_panel_file):
+        raise ValueError(f"extracted legend {old_panel_file} of the previous check not found")
+    tmp_panel_file = f"{ref_panel_file}.tmp{os.getpid()}"
+    if legend_rows:
+        # Unchanged rows are copied in order, the new ones merged in at their positions
+        added = sorted((key for key, row in legend_rows.items() if row is not None), key=site_order)
+        expected = sum(1 for key in target if diff_sites[key][2] is not None)
+        found = 0
+        i = 0
+        changed_positions = {pos.encode() for _, pos in legend_rows}
+        chrom_keys = {}
+        with run_trace.phase("write_extracted_legend"), gzip.open(old_panel_file, 'rb') as f, \
+                ExtractedLegendWriter(tmp_panel_file, compress_level, threads) as ref_out:
+            next(f, None)
+            # Rows are copied as they are; only the changed positions and the merge points are decoded
+            for line in f:
+                cols = line.split(b'\t', 4)
+                if len(cols) < 5:
+                    continue
+                names = chrom_keys.get(cols[1])
+                if names is None:
+                    original_chrom = cols[1].decode()
+                    names = chrom_keys[cols[1]] = (original_chrom, chrom_sort_key(original_chrom.lstrip('chr')))
+                original_chrom, chrom_key = names
+                while i < len(added) and site_order(added[i]) < (chrom_key, int(cols[2])):
+                    ref_out.add(*legend_rows[added[i]])
+                    i += 1
+                if cols[2] in changed_positions:
+                    key = (original_chrom.lstrip('chr'), cols[2].decode())
+                    if key in legend_rows:
+                        found += diff_sites[key][2] == (cols[3].decode(), cols[4].rstrip(b'\r\n').decode())
+                        continue
+                ref_out.add_line(original_chrom, cols[2], line)
+            for key in added[i:]:
+                ref_out.add(*legend_rows[key])
+        if found != expected or ref_out.count != num_common:
+            os.remove(tmp_panel_file)
+            os.remove(f"{tmp_panel_file}.tbi")
+            raise ValueError(f"{old_panel_file} does not hold the {old_name} alleles the panel diff lists; "
+                             f"the previous check was not run against that legend")
+
+    rows = []
+    with open(output_file) as f:
+        next(f, None)
+        for line in f:
+            cols = line.split('\t')
+            if len(cols) < 2 or line.startswith('#'):
+                continue
+            key = (cols[0].lstrip('chr'), cols[1].strip())
+            if key not in switch_rows:
+                rows.append((key, line))
+    rows.extend((key, line) for key, line in switch_rows.items() if line is not None)
+    rows.sort(key=lambda row: site_order(row[0]))
+    tmp_output_file = f"{output_file}.tmp{os.getpid()}"
+    with open(tmp_output_file, "w") as out:
+        out.write("CHROM\tPOS\tALLELE_SWITCH\n")
+        out.writelines(line for _, line in rows)
+
+    # Publish: the extracted legend takes the new release's name, as a full check would write it
+    if legend_rows:
+        os.replace(tmp_panel_file, ref_panel_file)
+        os.replace(f"{tmp_panel_file}.tbi", f"{ref_panel_file}.tbi")
+    elif old_panel_file != ref_panel_file:
+        os.replace(old_panel_file, ref_panel_file)
+        if os.path.exists(f"{old_panel_file}.tbi"):
+            os.replace(f"{old_panel_file}.tbi", f"{ref_panel_file}.tbi")
+    if legend_rows and old_panel_file != ref_panel_file:
+        os.remove(old_panel_file)
+        if os.path.exists(f"{old_panel_file}.tbi"):
+            os.remove(f"{old_panel_file}.tbi")
+    os.replace(tmp_output_file, output_file)
+
+    num_ref = previous["totals"]["reference"] + changes["ADDED"] - changes["REMOVED"]
+    print(f"Re-classified {len(target)} sites: {changes['ADDED']} added, {changes['REMOVED']} removed and "
+          f"{changes['CHANGED']} changed in the panel")
+    print(f"Successfully created reference legend file: {ref_panel_file}")
+    print_results_summary(output_file, ref_panel_file, previous["totals"]["target"], num_ref, num_common, counts)
+    record = metrics.build_record(target_vcf, reference_file, previous["mode"], previous["chroms"],
+                                  previous["totals"]["target"], num_ref, num_common, counts)
+    for key in ("region", "shards"):
+        if key in previous:
+            record[key] = previous[key]
+    record["target_sha256"] = target_sha256
+    record["reference_sha256"] = reference_sha256
+    record["previous_reference_file"] = previous["reference_file"]
+    record["incremental"] = dict({change.lower(): count for change, count in changes.items()},
+                                 target_sites=len(target))
+    return record
+
+COMPLEMENTS = {'A': 'T', 'T': 'A', 'C': 'G', 'G': 'C'}
 
 def is_complement(allele1, allele2):
     """Check if alleles are complementary (A↔T, C↔G)"""
-    complements = {'A': 'T', 'T': 'A', 'C': 'G', 'G': 'C'}
-    
     if len(allele1) != len(allele2):
         return False
     
     for i in range(len(allele1)):
-        if i >= len(allele2) or allele2[i] != complements.get(allele1[i], 'X'):
+        if allele2[i] != COMPLEMENTS.get(allele1[i], 'X'):
             return False
     
     return True
 
 if __name__ == "__main__":
+    # All three import this module, so they are only needed when it runs as a script
+    import check_service
+    import panel_diff
+    import result_cache
+
     parser = argparse.ArgumentParser(description='Check allele switches between VCF files')
     parser.add_argument('target_vcf', help='Target VCF file')
     parser.add_argument('reference_file', help='Reference file (VCF or legend)')
     parser.add_argument('output_file', help='Output file to write results in 1-based coordinates')
     parser.add_argument('--legend', action='store_true', help='Use legend file format for reference')
+    parser.add_argument('--catalog', help='Compiled reference catalog (reference_catalog.py compile); '
+                                          'used in place of parsing the legend while its checksum still matches')
+    parser.add_argument('--vcf-reader', choices=['native', 'bcftools'], default='native',
+                        help='native: decode VCF/BGZF in-process (default); bcftools: pipe through bcftools view/query')
+    parser.add_argument('--engine', choices=['memory', 'streaming', 'columnar'], default='memory',
+                        help='memory: load both inputs into dicts (any order); '
+                             'streaming: single merge-join pass over position-sorted inputs in constant memory; '
+                             'columnar: NumPy position/allele-code arrays with vectorized classification (any order)')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='Worker processes for decompressing and parsing BGZF inputs, and threads for '
+                             'compressing BGZF outputs; above 1, inputs are also read in background threads '
+                             'that overlap with classification and output writing (default: 1)')
+    parser.add_argument('--compress-level', type=int, choices=range(10), default=bgzf.DEFAULT_LEVEL,
+                        metavar='0-9', help=f'Deflate level for BGZF outputs (default: {bgzf.DEFAULT_LEVEL})')
+    parser.add_argument('--correct-output', metavar='VCF_GZ',
+                        help='Also write the target with switched sites corrected (BGZF + .tbi) in the same pass; '
+                             'needs a position-sorted target, replaces --engine')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='Write a versioned metrics record (totals, per-class counts, overlap, timings) '
+                             'as JSON, or as TSV if FILE ends in .tsv')
+    parser.add_argument('--verify-sites', metavar='SWITCH_TSV',
+                        help='Verify a fixed target: re-check only the sites in this allele switch results file '
+                             'plus a random sample of other reference sites, via the target .tbi when present')
+    parser.add_argument('--verify-sample', type=int, default=1000,
+                        help='Untouched reference sites to re-check in --verify-sites mode (default: 1000)')
+    parser.add_argument('--verify-seed', type=int, default=1,
+                        help='Random seed for the --verify-sites sample (default: 1)')
+    parser.add_argument('--panel-diff', metavar='DIFF_TSV',
+                        help='Update the results of a check against an older legend release (output_file, --metrics '
+                             'and the extracted legend, in place) by re-classifying only the sites in this '
+                             'panel_diff.py diff')
+    parser.add_argument('--region', metavar='CHROM[:START-END]',
+                        help='Check only the sites starting in this region, reading the target (and a BGZF '
+                             'legend) through its .tbi when there is one')
+    parser.add_argument('--shard', metavar='I/N',
+                        help='Check shard I of N of a single-chromosome target; shards hold about equal numbers '
+                             'of target records (planned from the target profile or .tbi); merge with shards.py')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='Write a JSON trace of the run: wall/CPU time, peak RSS and records/s or MB/s per '
+                             'phase, plus Trace Event Format events for chrome://tracing or Perfetto')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='Profile the main process for hot-loop analysis and write the profile to FILE')
+    parser.add_argument('--profile-mode', choices=['cprofile', 'sample'], default='cprofile',
+                        help='cprofile: pstats data, or a text report if FILE ends in .txt (default); '
+                             'sample: low-overhead stack sampling written as folded stacks for flame graphs')
+    parser.add_argument('--cache-dir', metavar='DIR',
+                        help='Content-addressed result cache: reuse the outputs of an earlier check of identical '
+                             'target and reference bytes, or store this check\'s outputs for later runs')
+    parser.add_argument('--cache-max-size', default=result_cache.DEFAULT_MAX_SIZE, metavar='SIZE',
+                        help='Evict least recently used results once the cache outgrows this size, e.g. 500M or '
+                             f'20G (default: {result_cache.DEFAULT_MAX_SIZE})')
+    parser.add_argument('--server', metavar='SOCKET',
+                        help='Run the check on a warm-reference service (check_service.py serve) at this Unix '
+                             'socket path; runs locally if the service cannot be reached')
 
     args = parser.parse_args()
+    if args.metrics and args.verify_sites:
+        parser.error("--metrics describes a full check and cannot be combined with --verify-sites")
+    if args.server and (args.engine != 'memory' or args.correct_output or args.verify_sites):
+        parser.error("--server runs the in-memory check only; drop --engine/--correct-output/--verify-sites")
+    if args.server and (args.trace or args.profile):
+        parser.error("--trace/--profile instrument a local run; drop --server")
+    if args.cache_dir and (args.server or args.verify_sites):
+        parser.error("--cache-dir caches local checks; drop --server/--verify-sites")
+    if args.region and args.shard:
+        parser.error("--region and --shard cannot be combined")
+    if args.panel_diff and not (args.legend and args.metrics):
+        parser.error("--panel-diff updates a legend check in place and needs --legend and the previous --metrics")
+    if args.panel_diff and (args.server or args.correct_output or args.verify_sites or args.cache_dir or args.region
+                            or args.shard):
+        parser.error("--panel-diff updates previous results; drop --server/--correct-output/--verify-sites/"
+                     "--cache-dir/--region/--shard")
+    if (args.region or args.shard) and (args.server or args.correct_output or args.verify_sites):
+        parser.error("--region/--shard check a slice of the target; drop --server/--correct-output/--verify-sites "
+                     "(fix_switched_sites.py corrects the whole target from the merged results)")
+
+    region = None
+    try:
+        if args.region:
+            region = shards.parse_region(args.region)
+        elif args.shard:
+            shard, shard_count = shards.parse_shard(args.shard)
+            region = shards.shard_region(args.target_vcf, shard, shard_count)
+            print(f"Shard {shard}/{shard_count} of {args.target_vcf}: {shards.format_region(region)}")
+    except (OSError, ValueError) as e:
+        print(f"ERROR: {e}")
+        sys.exit(1)
+
+    cache = None
+    if args.cache_dir and args.correct_output:
+        # The corrected VCF is not cached, so a fused check always runs in full
+        print("Result cache not used with --correct-output")
+    elif args.cache_dir:
+        try:
+            cache = result_cache.ResultCache(args.cache_dir, check_service.parse_size(args.cache_max_size))
+        except (OSError, ValueError) as e:
+            print(f"ERROR: result cache {args.cache_dir}: {e}")
+            sys.exit(1)
+
+    previous = None
+    if args.panel_diff:
+        try:
+            previous = metrics.read_metrics(args.metrics)
+            diff = panel_diff.read_panel_diff(args.panel_diff)
+        except (OSError, ValueError) as e:
+            print(f"ERROR: {e}")
+            sys.exit(1)
+
+    check_args = (args.target_vcf, args.reference_file, args.output_file, args.legend, args.catalog, args.vcf_reader,
+                  max(1, args.threads), args.compress_level)
+
+    start_wall = time.perf_counter()
+    start_cpu = sum(os.times()[:4])
+    record = None
+
+    if args.server:
+        try:
+            sys.exit(check_service.submit(args.server, *check_args, metrics_file=args.metrics))
+        except (OSError, RuntimeError) as e:
+            print(f"WARNING: check service at {args.server} unavailable ({e}); running locally")
+
+    tracer = run_trace.start() if args.trace else None
+    profiler = run_trace.Profiler(args.profile, args.profile_mode) if args.profile else None
+    if profiler is not None:
+        profiler.start()
+    # Early exits (build mismatch, unsorted input) still write the trace and profile
+    try:
+        cache_key = None
+        builds = None
+        if cache is not None:
+            with run_trace.phase("cache_lookup"):
+                # A mismatch stops the run exactly as an uncached check would, before hashing the inputs;
+                # on a miss the engine reuses these builds instead of detecting them again (a catalog
+                # records the build detect_legend_build() gave for the same legend)
+                builds = check_genome_builds(args.target_vcf, args.reference_file, args.output_file)
+                cache_key, cache_components = cache.key(args.target_vcf, args.reference_file, args.legend,
+                                                        shards.format_region(region) if region else None)
+                record = restore_cached_check(cache, cache_key, args.target_vcf, args.reference_file,
+                                              args.output_file)
+
+        cache_hit = record is not None
+        if not cache_hit:
+            if args.panel_diff:
+                try:
+                    record = update_check(args.target_vcf, args.reference_file, args.output_file, args.vcf_reader,
+                                          max(1, args.threads), args.compress_level, previous=previous,
+                                          panel_diff=diff)
+                except (OSError, ValueError) as e:
+                    print(f"ERROR: {e}")
+                    sys.exit(1)
+            elif args.verify_sites:
+                verify_corrections(args.target_vcf, args.reference_file, args.output_file, args.legend,
+                                   args.vcf_reader, max(1, args.threads), switch_results=args.verify_sites,
+                                   sample_size=args.verify_sample, seed=args.verify_seed)
+            elif args.correct_output:
+                try:
+                    record = check_and_correct(*check_args, corrected_vcf=args.correct_output)
+                except UnsortedInputError as e:
+                    print(f"ERROR: {e}")
+                    print("--correct-output writes an indexed VCF in input order, so the target must be position-sorted.")
+                    print("Sort the target (e.g. bcftools sort) and rerun.")
+                    sys.exit(UNSORTED_EXIT_CODE)
+            elif args.engine == 'streaming':
+                try:
+                    record = check_allele_switch_streaming(*check_args, region=region, builds=builds)
+                except UnsortedInputError as e:
+                    print(f"ERROR: {e}")
+                    print("The streaming engine needs both inputs sorted by chromosome (1-22, X, Y, MT) and position.")
+                    print("Sort the input (e.g. bcftools sort) or rerun with --engine memory.")
+                    sys.exit(UNSORTED_EXIT_CODE)
+            elif args.engine == 'columnar':
+                record = check_allele_switch_columnar(*check_args, region=region, builds=builds)
+            else:
+                record = check_allele_switch(*check_args, region=region, builds=builds)
+
+        if region is not None and record is not None:
+            record["region"] = shards.format_region(region)
+
+        if cache_key is not None and record is not None:
+            record["cache"] = {"key": cache_key, "hit": cache_hit}
+            if not cache_hit:
+                with run_trace.phase("cache_store"):
+                    if cache.store(cache_key, cache_components, args.output_file,
+                                   extracted_legend_name(args.reference_file), dict(record, timings={})):
+                        print(f"Stored results in the result cache ({cache_key[:16]})")
 
-    check_allele_switch(args.target_vcf, args.reference_file, args.output_file, args.legend)
\ No newline at end of file
+        if args.metrics and record is not None:
+            if "target_sha256" not in record:
+                # Input checksums identify the files a record describes (e.g. for --panel-diff); profile
+                # sidecars and the result cache's memo spare rereading them
+                file_digest = cache.file_digest if cache is not None else profile_input.file_sha256
+                with run_trace.phase("input_checksums"):
+                    record["target_sha256"] = file_digest(args.target_vcf, 'vcf')
+                    record["reference_sha256"] = file_digest(args.reference_file)
+            # CPU time includes the BGZF worker processes
+            record["timings"] = {"wall_seconds": round(time.perf_counter() - start_wall, 3),
+                                 "cpu_seconds": round(sum(os.times()[:4]) - start_cpu, 3),
+                                 "peak_rss_mb": run_trace.peak_rss_mb()}
+            with run_trace.phase("write_metrics"):
+                metrics.write_metrics(args.metrics, record)
+    finally:
+        if profiler is not None:
+            profiler.stop()
+            print(f"Profile ({args.profile_mode}) written to: {args.profile}")
+        if tracer is not None:
+            run_trace.stop().write(args.trace)
+            print(f"Trace written to: {args.trace}")
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+Cohort batch mode for CheckRef.
+
+Checks many target VCFs against one reference. The reference is loaded
+once, packed into sorted position / allele-code arrays (the reference
+catalog layout) in a read-only shared memory segment, and a process pool
+runs the in-memory check for each target against views of those arrays.
+Peak memory is one compact reference plus each worker's target sites,
+instead of one full site dict per target. With a valid --catalog the
+workers map the catalog file directly and nothing is parsed.
+
+Each target gets its own directory, <outdir>/<prefix>/, holding the same
+files a single check_allele_switch.py run writes: the results TSV, the
+summary (the checker's stdout), a metrics record and the extracted legend.
+
+Usage:
+    check_batch.py <reference_file> <target_vcf>... [--legend] [--catalog FILE] [--workers N] [--outdir DIR]
+"""
+
+import argparse
+import contextlib
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+import check_allele_switch as checker
+import metrics
+import reference_catalog
+import run_trace
+
+# Set in each worker by attach_reference()
+_shared = None
+_reference = None
+
+
+def target_prefix(target_vcf):
+    """Output prefix of a target: its file name up to the first dot, like Nextflow's simpleName"""
+    return os.path.basename(target_vcf).split('.')[0]
+
+
+def share_reference(records):
+    """Pack reference records into a new shared memory segment; returns (segment, chroms metadata)"""
+    blobs = []
+    size = 0
+
+    def add_blob(data):
+        nonlocal size
+        offset = size
+        blobs.append((offset, data))
+        size = reference_catalog.align8(size + len(data))
+        return offset
+
+    chroms = reference_catalog.pack_reference(records, add_blob)
+    segment = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    for offset, data in blobs:
+        segment.buf[offset:offset + len(data)] = data
+    return segment, chroms
+
+
+def attach_reference(segment_name, chroms, catalog_path, legend_build):
+    """Worker initializer: map the shared reference (or the catalog file) read-only"""
+    global _shared, _reference
+    if segment_name is not None:
+        _shared = shared_memory.SharedMemory(name=segment_name)
+        data = _shared.buf
+        tables = {chrom: reference_catalog.CatalogChrom(chrom, meta, data) for chrom, meta in chroms.items()}
+    else:
+        _shared = reference_catalog.ReferenceCatalog(catalog_path)
+        tables = {chrom: _shared.chrom(chrom) for chrom in chroms}
+    ref_chroms = {chrom: table.original_chrom for chrom, table in tables.items()}
+    _reference = (reference_catalog.CatalogSites(tables), ref_chroms, legend_build)
+
+
+def check_target(target_vcf, reference_file, outdir, use_legend, catalog_path, vcf_backend, threads):
+    """Worker: run the in-memory check for one target in its own directory; returns (target, exit status)"""
+    prefix = target_prefix(target_vcf)
+    workdir = os.path.join(outdir, prefix)
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+
+    start_wall = time.perf_counter()
+    start_cpu = sum(os.times()[:4])
+    record = None
+    exit_code = 0
+    with open(f"{prefix}_allele_switch_summary.txt", 'w') as summary, contextlib.redirect_stdout(summary):
+        try:
+            record = checker.check_allele_switch(target_vcf, reference_file, f"{prefix}_allele_switch_results.tsv",
+                                                 use_legend, catalog_path, vcf_backend, threads,
+                                                 reference=_reference)
+        except SystemExit as e:
+            # A build mismatch exits 0 after writing its marker file, as in a single run
+            exit_code = e.code if isinstance(e.code, int) else 1
+        except Exception as e:
+            print(f"ERROR: {e}")
+            exit_code = 1
+    if record is not None:
+        # Workers are reused across targets, so the peak is the worker's so far
+        record["timings"] = {"wall_seconds": round(time.perf_counter() - start_wall, 3),
+                             "cpu_seconds": round(sum(os.times()[:4]) - start_cpu, 3),
+                             "peak_rss_mb": run_trace.peak_rss_mb()}
+        metrics.write_metrics(f"{prefix}_allele_switch_metrics.json", record)
+    return target_vcf, exit_code, record
+
+
+def run_batch(reference_file, target_vcfs, outdir='.', use_legend=False, catalog_path=None, vcf_backend='native',
+              workers=None, threads=1):
+    """Check every target against one shared reference; returns the number of failed targets"""
+    reference_file = os.path.abspath(reference_file)
+    target_vcfs = [os.path.abspath(target) for target in target_vcfs]
+    outdir = os.path.abspath(outdir)
+    prefixes = [target_prefix(target) for target in target_vcfs]
+    duplicates = sorted({prefix for prefix in prefixes if prefixes.count(prefix) > 1})
+    if duplicates:
+        print(f"ERROR: target file names must differ before the first dot; repeated: {', '.join(duplicates)}")
+        sys.exit(1)
+    workers = max(1, min(workers or os.cpu_count() or 1, len(target_vcfs)))
+
+    catalog, source = checker.open_catalog_source(catalog_path, reference_file) if use_legend else (None, None)
+    segment = None
+    start = time.perf_counter()
+    if catalog is not None:
+        # The catalog is already a read-only mapping shared through the page cache
+        init_args = (None, source['chroms'], catalog_path, source['build'])
+    else:
+        if use_legend:
+            print(f"Parsing reference legend file {reference_file}...")
+            records = checker.iter_legend_records(reference_file, threads)
+        else:
+            print(f"Extracting variants from reference VCF {reference_file}...")
+            records = checker.iter_vcf_snps(reference_file, vcf_backend, threads)
+        segment, chroms = share_reference(records)
+        print(f"Shared reference: {sum(meta['count'] for meta in chroms.values()):,} sites in "
+              f"{segment.size / 1e6:.1f} MB ({time.perf_counter() - start:.1f}s)")
+        init_args = (segment.name, chroms, None, None)
+
+    print(f"Checking {len(target_vcfs)} target VCF(s) with {workers} worker(s)...")
+    failed = 0
+    # fork keeps the already-imported checker modules available to workers
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=attach_reference,
+                                 initargs=init_args) as pool:
+            futures = [pool.submit(check_target, target, reference_file, outdir, use_legend, catalog_path,
+                                   vcf_backend, threads) for target in target_vcfs]
+            for future in as_completed(futures):
+                target_vcf, exit_code, record = future.result()
+                if exit_code != 0:
+                    failed += 1
+                    print(f"  {target_vcf}: FAILED (exit {exit_code}), see {target_prefix(target_vcf)}_allele_switch_summary.txt")
+                elif record is None:
+                    print(f"  {target_vcf}: stopped (genome build mismatch)")
+                else:
+                    print(f"  {target_vcf}: {record['totals']['common']:,} compared, "
+                          f"{record['counts']['SWITCH']:,} switched")
+    finally:
+        if segment is not None:
+            segment.close()
+            segment.unlink()
+    print(f"Batch finished in {time.perf_counter() - start:.1f}s: {len(target_vcfs) - failed} succeeded, {failed} failed")
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check many target VCFs against one shared reference')
+    parser.add_argument('reference_file', help='Reference file (VCF or legend)')
+    parser.add_argument('target_vcfs', nargs='+', help='Target VCF files')
+    parser.add_argument('--legend', action='store_true', help='Use legend file format for reference')
+    parser.add_argument('--catalog', help='Compiled reference catalog; mapped directly while its checksum still matches')
+    parser.add_argument('--vcf-reader', choices=['native', 'bcftools'], default='native',
+                        help='native: decode VCF/BGZF in-process (default); bcftools: pipe through bcftools view/query')
+    parser.add_argument('--workers', type=int, help='Targets checked at once (default: number of CPUs)')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='Worker processes for parsing each BGZF input (default: 1)')
+    parser.add_argument('--outdir', default='.', help='Directory for the per-target output directories (default: .)')
+    args = parser.parse_args()
+
+    failed = run_batch(args.reference_file, args.target_vcfs, args.outdir, args.legend, args.catalog,
+                       args.vcf_reader, args.workers, max(1, args.threads))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+"""
+Warm-reference check service for CheckRef.
+
+A long-lived process that keeps parsed reference panels in memory and runs
+the in-memory allele switch check for each submitted target VCF, so only
+the target has to be read per job. Parsed references are held in an LRU
+cache bounded by an estimated memory cap; an entry is reloaded when its
+source file changes.
+
+The service speaks a small JSON-over-HTTP protocol on a Unix socket that
+only its owner may connect to: a job names a working directory and output
+paths that the service writes as its own user, so there is deliberately no
+TCP listener, which any local user could reach. Each request is handled in
+its own thread, so status and stop requests are answered while checks run.
+A job loads its reference into the cache in the service, then runs in a
+forked child process that shares the loaded reference copy-on-write: the
+child works in the client's working directory with its stdout captured and
+returned, so outputs and logs match a local run. Up to --jobs checks run at
+once. check_allele_switch.py --server SOCKET submits a job.
+
+Usage:
+    check_service.py serve --socket PATH [--memory-cap 8G] [--threads N] [--jobs N]
+    check_service.py status SOCKET
+    check_service.py stop SOCKET
+"""
+
+import argparse
+import contextlib
+import http.client
+import http.server
+import io
+import json
+import multiprocessing
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import bgzf
+import check_allele_switch as checker
+import metrics
+import run_trace
+
+PROTOCOL_VERSION = 1
+SIZE_SAMPLE = 1000
+
+
+def parse_size(text):
+    """Parse a byte size such as 512M, 8G or 1073741824"""
+    multipliers = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in multipliers:
+        return int(float(text[:-1]) * multipliers[text[-1]])
+    return int(text)
+
+
+def estimate_reference_bytes(ref_variants):
+    """Approximate memory held by a site dict, from a sample of its entries"""
+    total = sys.getsizeof(ref_variants)
+    if not ref_variants:
+        return total
+    sample = 0
+    sample_bytes = 0
+    for (chrom, pos), alleles in ref_variants.items():
+        # Chromosome names are shared; single-base allele strings are interned by CPython
+        sample_bytes += sys.getsizeof((chrom, pos)) + sys.getsizeof(pos) + sys.getsizeof(alleles)
+        sample_bytes += sum(sys.getsizeof(allele) for allele in alleles if len(allele) > 1)
+        sample += 1
+        if sample == SIZE_SAMPLE:
+            break
+    return total + sample_bytes * len(ref_variants) // sample
+
+
+class ThreadStdout:
+    """sys.stdout stand-in that sends the output of a capturing thread to its own buffer"""
+
+    def __init__(self, default):
+        self.default = default
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def capture(self, buffer):
+        self.local.buffer = buffer
+        try:
+            yield buffer
+        finally:
+            del self.local.buffer
+
+    def write(self, text):
+        return getattr(self.local, 'buffer', self.default).write(text)
+
+    def flush(self):
+        getattr(self.local, 'buffer', self.default).flush()
+
+
+class ReferenceCache:
+    """LRU cache of loaded references, bounded by their estimated size; safe to share between threads"""
+
+    def __init__(self, memory_cap, threads=1):
+        self.memory_cap = memory_cap
+        self.threads = threads
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # lock guards the entries; loading lets one reference load at a time, so concurrent
+        # jobs on a new reference parse it once while status and cache hits go ahead
+        self.lock = threading.Lock()
+        self.loading = threading.Lock()
+
+    def _evict(self, key):
+        entry = self.entries.pop(key)
+        self.total_bytes -= entry['bytes']
+        print(f"Evicted {key[0]} ({entry['bytes'] / 1e6:.1f} MB)", file=sys.stderr)
+
+    def get(self, reference_file, use_legend, catalog_path, vcf_backend):
+        """Return ((ref_variants, ref_chroms, legend_build), hit) for a reference, loading it on a miss"""
+        key = (os.path.realpath(reference_file), use_legend,
+               os.path.realpath(catalog_path) if catalog_path else None, vcf_backend)
+        stat = os.stat(reference_file)
+        stamp = (stat.st_size, stat.st_mtime_ns)
+        reference = self._lookup(key, stamp)
+        if reference is not None:
+            return reference, True
+        with self.loading:
+            # Another job may have loaded it while this one waited
+            reference = self._lookup(key, stamp)
+            if reference is not None:
+                return reference, True
+            with self.lock:
+                self.misses += 1
+            catalog, source = checker.open_catalog_source(catalog_path, reference_file) if use_legend else (None, None)
+            ref_variants, ref_chroms = checker.load_reference(reference_file, use_legend, catalog, source,
+                                                              vcf_backend, self.threads)
+        reference = (ref_variants, ref_chroms, source['build'] if source else None)
+        size = estimate_reference_bytes(ref_variants)
+        if size > self.memory_cap:
+            print(f"Reference {key[0]} ({size / 1e6:.1f} MB) exceeds the memory cap; not cached", file=sys.stderr)
+            return reference, False
+        with self.lock:
+            if key in self.entries:
+                self._evict(key)
+            while self.entries and self.total_bytes + size > self.memory_cap:
+                self._evict(next(iter(self.entries)))
+            self.entries[key] = {'reference': reference, 'stamp': stamp, 'bytes': size, 'sites': len(ref_variants)}
+            self.total_bytes += size
+        return reference, False
+
+    def _lookup(self, key, stamp):
+        """The cached reference for key if it is still current, else None (dropping a stale entry)"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry['stamp'] == stamp:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry['reference']
+            if entry is not None:
+                print(f"Reference {key[0]} changed on disk; reloading", file=sys.stderr)
+                self._evict(key)
+        return None
+
+    def status(self):
+        with self.lock:
+            return self._status()
+
+    def _status(self):
+        return {
+            'memory_cap': self.memory_cap,
+            'bytes': self.total_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': [{'reference_file': key[0], 'legend': key[1], 'sites': entry['sites'], 'bytes': entry['bytes']}
+                        for key, entry in self.entries.items()],
+        }
+
+
+def run_job(job, reference, start_wall, start_cpu, conn):
+    """Child process: run one check in the client's working directory and send back (exit status, log)"""
+    log = io.StringIO()
+    exit_code = 0
+    os.chdir(job['cwd'])
+    with contextlib.redirect_stdout(log):
+        try:
+            record = checker.check_allele_switch(
+                job['target_vcf'], job['reference_file'], job['output_file'], job['use_legend'],
+                job.get('catalog_path'), job['vcf_backend'], job['threads'],
+                job.get('compress_level', bgzf.DEFAULT_LEVEL), reference=reference)
+            if job.get('metrics'):
+                record["timings"] = {"wall_seconds": round(time.perf_counter() - start_wall, 3),
+                                     "cpu_seconds": round(sum(os.times()[:4]) - start_cpu, 3),
+                                     "peak_rss_mb": run_trace.peak_rss_mb()}
+                metrics.write_metrics(job['metrics'], record)
+        except SystemExit as e:
+            exit_code = e.code if isinstance(e.code, int) else 1
+        except Exception as e:
+            print(f"ERROR: {e}")
+            exit_code = 1
+    conn.send((exit_code, log.getvalue()))
+    conn.close()
+
+
+def run_check(server, job):
+    """Run one check job: load its reference in the service, check in a forked child; returns the response dict"""
+    log = io.StringIO()
+    exit_code = 0
+    hit = None
+    start_wall = time.perf_counter()
+    start_cpu = sum(os.times()[:4])
+    with server.job_slots:
+        try:
+            with server.stdout.capture(log):
+                reference, hit = server.cache.get(job['reference_file'], job['use_legend'], job.get('catalog_path'),
+                                                  job['vcf_backend'])
+        except Exception as e:
+            log.write(f"ERROR: {e}\n")
+            exit_code = 1
+        if exit_code == 0:
+            # fork hands the child the loaded reference without copying it; the child's cwd and
+            # stdout are its own, so jobs never see each other's
+            receiver, sender = server.context.Pipe(duplex=False)
+            child = server.context.Process(target=run_job, args=(job, reference, start_wall, start_cpu, sender))
+            child.start()
+            sender.close()
+            try:
+                exit_code, job_log = receiver.recv()
+                log.write(job_log)
+            except EOFError:
+                exit_code = None
+            child.join()
+            if exit_code is None:
+                log.write(f"ERROR: check process died (exit {child.exitcode})\n")
+                exit_code = 1
+    print(f"{job['target_vcf']}: exit {exit_code}, reference {'cached' if hit else 'loaded'}, "
+          f"{time.perf_counter() - start_wall:.2f}s", file=sys.stderr)
+    return {'exit_code': exit_code, 'log': log.getvalue(), 'reference_cached': bool(hit)}
+
+
+class CheckRequestHandler(http.server.BaseHTTPRequestHandler):
+    """POST /check runs a job, GET /status reports the cache, POST /shutdown stops the service"""
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/status':
+            self._reply(200, dict(self.server.cache.status(), protocol=PROTOCOL_VERSION))
+        else:
+            self._reply(404, {'error': f"unknown path {self.path}"})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self._reply(400, {'error': 'request body is not JSON'})
+            return
+        if self.path == '/check':
+            if body.get('protocol') != PROTOCOL_VERSION:
+                self._reply(400, {'error': f"protocol {body.get('protocol')} not supported, expected {PROTOCOL_VERSION}"})
+                return
+            self._reply(200, run_check(self.server, body))
+        elif self.path == '/shutdown':
+            self._reply(200, {'stopping': True})
+            self.server.stopping = True
+        else:
+            self._reply(404, {'error': f"unknown path {self.path}"})
+
+    def address_string(self):
+        # Unix socket peers have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """HTTP over a Unix domain socket, one thread per request"""
+
+
+def serve(socket_path, memory_cap=8 << 30, threads=1, jobs=1):
+    """Serve check jobs until a shutdown request arrives"""
+    if os.path.exists(socket_path):
+        # A leftover socket from a previous run blocks bind(); refuse to steal a live one
+        try:
+            with socket.socket(socket.AF_UNIX) as probe:
+                probe.connect(socket_path)
+            print(f"ERROR: a service is already listening on {socket_path}")
+            sys.exit(1)
+        except ConnectionRefusedError:
+            os.unlink(socket_path)
+    # Jobs run as the service's user, so only that user may connect: create the socket
+    # owner-only rather than leave a window between bind() and chmod()
+    old_umask = os.umask(0o177)
+    try:
+        server = UnixHTTPServer(socket_path, CheckRequestHandler)
+    finally:
+        os.umask(old_umask)
+    os.chmod(socket_path, 0o600)
+    server.cache = ReferenceCache(memory_cap, threads)
+    server.job_slots = threading.BoundedSemaphore(jobs)
+    server.context = multiprocessing.get_context('fork')
+    server.stdout = ThreadStdout(sys.stdout)
+    server.stopping = False
+    # Wake up between requests to notice a shutdown handled in another thread
+    server.timeout = 0.5
+    print(f"CheckRef service listening on {socket_path} (memory cap {memory_cap / 1e6:.1f} MB, "
+          f"{jobs} concurrent job(s))", file=sys.stderr)
+    sys.stdout = server.stdout
+    try:
+        while not server.stopping:
+            server.handle_request()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sys.stdout = server.stdout.default
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+    print("CheckRef service stopped", file=sys.stderr)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path):
+        super().__init__('localhost')
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+def request(address, method, path, body=None):
+    """Send one request and return the decoded JSON reply; raises OSError if the service is unreachable"""
+    conn = UnixHTTPConnection(address)
+    try:
+        conn.request(method, path, body=json.dumps(body) if body is not None else None,
+                     headers={'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        reply = json.loads(response.read())
+    finally:
+        conn.close()
+    if response.status != 200:
+        raise RuntimeError(reply.get('error', f"HTTP {response.status}"))
+    return reply
+
+
+def submit(address, target_vcf, reference_file, output_file, use_legend=False, catalog_path=None,
+           vcf_backend='native', threads=1, compress_level=bgzf.DEFAULT_LEVEL,
+           metrics_file=None):
+    """Run a check on the service, echoing its log; returns the job's exit status"""
+    job = {
+        'protocol': PROTOCOL_VERSION,
+        'cwd': os.getcwd(),
+        'target_vcf': target_vcf,
+        'reference_file': reference_file,
+        'output_file': output_file,
+        'use_legend': use_legend,
+        'catalog_path': catalog_path,
+        'vcf_backend': vcf_backend,
+        'threads': threads,
+        'compress_level': compress_level,
+        'metrics': metrics_file,
+    }
+    reply = request(address, 'POST', '/check', job)
+    sys.stdout.write(reply['log'])
+    return reply['exit_code']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Warm-reference CheckRef check service')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve', help='Run the service in the foreground')
+    serve_parser.add_argument('--socket', required=True,
+                              help='Unix socket path to listen on (created accessible to its owner only)')
+    serve_parser.add_argument('--memory-cap', default='8G',
+                              help='Estimated memory for cached references before LRU eviction (default: 8G)')
+    serve_parser.add_argument('--threads', type=int, default=1,
+                              help='Worker processes for parsing BGZF references (default: 1)')
+    serve_parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                              help='Checks run at once (default: number of CPUs)')
+
+    for name, help_text in (('status', 'Print the cached references'), ('stop', 'Stop a running service')):
+        sub = subparsers.add_parser(name, help=help_text)
+        sub.add_argument('address', help='Unix socket path of the service')
+
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args.socket, parse_size(args.memory_cap), max(1, args.threads), max(1, args.jobs))
+        return
+    try:
+        if args.command == 'status':
+            status = request(args.address, 'GET', '/status')
+            print(f"Cached references: {len(status['entries'])} "
+                  f"({status['bytes'] / 1e6:.1f} of {status['memory_cap'] / 1e6:.1f} MB), "
+                  f"hits={status['hits']} misses={status['misses']}")
+            for entry in status['entries']:
+                print(f"  {entry['reference_file']}: {entry['sites']:,} sites, {entry['bytes'] / 1e6:.1f} MB")
+        else:
+            request(args.address, 'POST', '/shutdown', {})
+            print(f"Stopped service at {args.address}")
+    except (OSError, RuntimeError) as e:
+        print(f"ERROR: could not reach service at {args.address}: {e}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""
+Block-copy fixer for switched sites in an indexed BGZF target VCF.
+
+Looks up the sites of an allele switch results file through the target's
+.tbi, copies every BGZF block that holds none of them byte-for-byte and
+recompresses only the blocks that do, then writes the index with its
+virtual offsets shifted to the new blocks. With a few thousand switches in
+a multi-gigabyte VCF, the fix is a sequential copy instead of a full
+decompress/recompress.
+
+remove drops every record starting at a switched site, as
+`bcftools view -T ^sites.bed` does. correct swaps REF/ALT of the switched
+records, flips their genotype, dosage and AF/AC values (genotype_flip.py)
+and flags them SWITCHED, as check_allele_switch.py --correct-output does.
+
+Usage:
+    fix_switched_sites.py remove <target.vcf.gz> <switch_results.tsv> <output.vcf.gz>
+    fix_switched_sites.py correct <target.vcf.gz> <switch_results.tsv> <output.vcf.gz>
+
+Exits with status 4 when the target is not BGZF or has no up-to-date .tbi,
+so callers can fall back to a full rewrite.
+"""
+
+import argparse
+import bisect
+import os
+import sys
+
+import bgzf
+import genotype_flip
+import tabix_index
+import vcf_reader
+from check_allele_switch import SWITCHED_INFO_HEADER
+
+UNINDEXED_EXIT_CODE = 4
+COPY_SIZE = 8 << 20
+
+
+def read_switched_sites(switch_results):
+    """Return [(chrom, pos, (target_ref, target_alt))] from an allele switch results file, in file order"""
+    sites = []
+    with open(switch_results) as f:
+        next(f, None)
+        for line in f:
+            cols = line.rstrip('\n').split('\t')
+            if len(cols) < 2 or line.startswith('#'):
+                continue
+            alleles = None
+            if len(cols) > 2 and '>' in cols[2]:
+                alleles = tuple(cols[2].split('|', 1)[0].split('>', 1))
+            sites.append((cols[0], int(cols[1]), alleles))
+    return sites
+
+
+def find_edits(target_vcf, index, sites, mode):
+    """Return ({vstart: (vstart, vend, replacement)}, per-chromosome removed counts, fixed, failed)"""
+    edits = {}
+    removed = {}
+    fixed = 0
+    failed = 0
+    with bgzf.BgzfReader(target_vcf) as reader:
+        if mode == 'correct':
+            # Declare the SWITCHED flag ahead of the #CHROM line, as the fused correction does
+            reader.seek(0)
+            while True:
+                vstart = reader.tell()
+                line = reader.readline()
+                if not line.startswith(b'#'):
+                    break
+                if line.startswith(b'##INFO=<ID=SWITCHED,'):
+                    break
+                if line.startswith(b'#CHROM'):
+                    edits[vstart] = (vstart, vstart, SWITCHED_INFO_HEADER)
+                    break
+
+        for chrom, pos, alleles in sites:
+            for vstart, vend, line in index.fetch_spans(reader, chrom, pos - 1, pos):
+                fields = line.split(b'\t', 8)
+                # -T style: only records starting at the site, not ones overlapping it
+                if int(fields[1]) != pos or vstart in edits:
+                    continue
+                if mode == 'remove':
+                    edits[vstart] = (vstart, vend, b'')
+                    removed[chrom] = removed.get(chrom, 0) + 1
+                    continue
+                if alleles is not None and vcf_reader.snp_alleles(fields[3], fields[4].rstrip(b'\r\n')) != alleles:
+                    continue
+                corrected = genotype_flip.flip_record(line)
+                if corrected is None:
+                    failed += 1
+                else:
+                    edits[vstart] = (vstart, vend, corrected)
+                    fixed += 1
+    return edits, removed, fixed, failed
+
+
+def copy_bytes(src, dst, length):
+    """Copy length bytes from the current position of src to dst"""
+    while length > 0:
+        chunk = src.read(min(length, COPY_SIZE))
+        if not chunk:
+            break
+        dst.write(chunk)
+        length -= len(chunk)
+
+
+class RewrittenRun:
+    """A run of touched blocks: where it sat in the input and where its recompressed blocks landed"""
+
+    def __init__(self, old_starts, old_end, ustarts, edits, new_starts, new_end, new_length):
+        self.old_starts = old_starts  # compressed start of each input block
+        self.old_end = old_end
+        self.ustarts = ustarts        # uncompressed start of each input block within the run
+        self.edits = edits            # (start, end, replacement) in run-relative uncompressed bytes
+        self.new_starts = new_starts  # compressed start of each output block
+        self.new_end = new_end
+        self.new_length = new_length
+
+    def to_run_offset(self, voffset):
+        """Uncompressed offset within the run of an input virtual offset"""
+        coffset = voffset >> 16
+        if coffset >= self.old_end:
+            return self.ustarts[-1]
+        return self.ustarts[bisect.bisect_right(self.old_starts, coffset) - 1] + (voffset & 0xffff)
+
+    def remap(self, voffset):
+        offset = self.to_run_offset(voffset)
+        shifted = offset
+        for start, end, replacement in self.edits:
+            if end <= offset:
+                shifted += len(replacement) - (end - start)
+            elif start < offset:
+                # Inside an edited line: land on its start
+                shifted -= offset - start
+        if shifted >= self.new_length:
+            return self.new_end << 16
+        return (self.new_starts[shifted // bgzf.BLOCK_DATA_SIZE] << 16) | (shifted % bgzf.BLOCK_DATA_SIZE)
+
+
+def edit_blocks_end(edit):
+    """Bound just past the compressed start of the last block an edit touches"""
+    vstart, vend, _ = edit
+    return max((vend >> 16) + (1 if vend & 0xffff else 0), (vstart >> 16) + 1)
+
+
+def rewrite_run(src, dst, edits, level):
+    """Recompress the run of blocks holding edits (sorted, overlapping blocks); returns the RewrittenRun"""
+    old_starts = []
+    texts = []
+    coffset = edits[0][0] >> 16
+    run_end = max(edit_blocks_end(edit) for edit in edits)
+    while coffset < run_end:
+        src.seek(coffset)
+        buf = src.read(bgzf.MAX_BLOCK_SIZE)
+        if len(buf) < bgzf.HEADER_SIZE + 6:
+            break
+        bsize = bgzf.block_size(buf, 0)
+        old_starts.append(coffset)
+        texts.append(bgzf.inflate_block(buf, 0, bsize))
+        coffset += bsize
+
+    ustarts = [0]
+    for text in texts:
+        ustarts.append(ustarts[-1] + len(text))
+    run = RewrittenRun(old_starts, coffset, ustarts, [], [], 0, 0)
+    run.edits = sorted((run.to_run_offset(vstart), run.to_run_offset(vend), replacement)
+                       for vstart, vend, replacement in edits)
+
+    data = b''.join(texts)
+    parts = []
+    position = 0
+    for start, end, replacement in run.edits:
+        parts.append(data[position:start])
+        parts.append(replacement)
+        position = end
+    parts.append(data[position:])
+    data = b''.join(parts)
+
+    new_offset = dst.tell()
+    for start in range(0, len(data), bgzf.BLOCK_DATA_SIZE):
+        run.new_starts.append(new_offset)
+        block = bgzf.compress_block(data[start:start + bgzf.BLOCK_DATA_SIZE], level)
+        dst.write(block)
+        new_offset += len(block)
+    run.new_end = new_offset
+    run.new_length = len(data)
+    return run
+
+
+def fix_blocks(target_vcf, edits, output_vcf, level=bgzf.DEFAULT_LEVEL):
+    """Write output_vcf from target_vcf with the edits applied; returns (runs, blocks rewritten, bytes copied)"""
+    ordered = sorted(edits.values(), key=lambda edit: edit[0])
+    runs = []
+    copied = 0
+    with open(target_vcf, 'rb') as src, open(output_vcf, 'wb') as dst:
+        position = 0
+        i = 0
+        while i < len(ordered):
+            first_block = ordered[i][0] >> 16
+            src.seek(position)
+            copy_bytes(src, dst, first_block - position)
+            copied += first_block - position
+            # Edits starting in a block the run already covers are rewritten with it
+            run_edits = [ordered[i]]
+            run_end = edit_blocks_end(ordered[i])
+            i += 1
+            while i < len(ordered) and ordered[i][0] >> 16 < run_end:
+                run_edits.append(ordered[i])
+                run_end = max(run_end, edit_blocks_end(ordered[i]))
+                i += 1
+            run = rewrite_run(src, dst, run_edits, level)
+            runs.append(run)
+            position = run.old_end
+        src.seek(position)
+        tail = os.fstat(src.fileno()).st_size - position
+        copy_bytes(src, dst, tail)
+        copied += tail
+    return runs, sum(len(run.old_starts) for run in runs), copied
+
+
+def make_remap(runs):
+    """Map input virtual offsets to output ones, given the rewritten runs in file order"""
+    run_starts = [run.old_starts[0] if run.old_starts else run.old_end for run in runs]
+
+    def remap(voffset):
+        coffset = voffset >> 16
+        i = bisect.bisect_right(run_starts, coffset) - 1
+        if i < 0:
+            return voffset
+        run = runs[i]
+        if coffset < run.old_end:
+            return run.remap(voffset)
+        return ((coffset + run.new_end - run.old_end) << 16) | (voffset & 0xffff)
+
+    return remap
+
+
+def fix_switched_sites(mode, target_vcf, switch_results, output_vcf, index_path=None, level=bgzf.DEFAULT_LEVEL):
+    """Remove or correct the switched sites of an indexed BGZF VCF by rewriting only the blocks that hold them"""
+    index_path = index_path or tabix_index.find_index(target_vcf)
+    if not bgzf.is_bgzf(target_vcf) or not index_path or not os.path.exists(index_path):
+        print(f"ERROR: {target_vcf} is not a BGZF file with a .tbi index; block-copy fixing needs both")
+        sys.exit(UNINDEXED_EXIT_CODE)
+    if os.path.getmtime(index_path) < os.path.getmtime(target_vcf):
+        print(f"ERROR: {index_path} is older than {target_vcf}; reindex it before block-copy fixing")
+        sys.exit(UNINDEXED_EXIT_CODE)
+
+    index = tabix_index.TabixIndex(index_path)
+    sites = read_switched_sites(switch_results)
+    print(f"Read {len(sites)} switched sites from {switch_results}")
+
+    edits, removed, fixed, failed = find_edits(target_vcf, index, sites, mode)
+    runs, rewritten, copied = fix_blocks(target_vcf, edits, output_vcf, level)
+    tabix_index.remap_index(index_path, f"{output_vcf}.tbi", make_remap(runs), removed)
+
+    print(f"Rewrote {rewritten} BGZF blocks in {len(runs)} runs; copied {copied:,} compressed bytes unchanged")
+    if mode == 'remove':
+        print(f"Removed {sum(removed.values())} records at switched sites")
+    else:
+        print(f"Corrected switched sites: {fixed}")
+        print(f"Switched sites left uncorrected (multi-allelic or non-ACGT): {failed}")
+    print(f"Fixed VCF written to: {output_vcf} (indexed)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Remove or correct switched sites of an indexed BGZF VCF, '
+                                                 'recompressing only the blocks that hold them')
+    parser.add_argument('mode', choices=['remove', 'correct'],
+                        help='remove: drop records at switched sites; correct: swap their REF/ALT')
+    parser.add_argument('target_vcf', help='Target VCF (BGZF, with a .tbi index)')
+    parser.add_argument('switch_results', help='Allele switch results file from check_allele_switch.py')
+    parser.add_argument('output_vcf', help='Fixed VCF to write (BGZF); its .tbi is written next to it')
+    parser.add_argument('--index', help='Index of the target (default: <target_vcf>.tbi, also looked for '
+                                        'next to the file a symlinked target points at)')
+    parser.add_argument('--compress-level', type=int, choices=range(10), default=bgzf.DEFAULT_LEVEL,
+                        metavar='0-9', help=f'Deflate level for rewritten blocks (default: {bgzf.DEFAULT_LEVEL})')
+    args = parser.parse_args()
+
+    fix_switched_sites(args.mode, args.target_vcf, args.switch_results, args.output_vcf, args.index,
+                       args.compress_level)
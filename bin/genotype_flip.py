@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""
+Genotype-aware REF/ALT flipping for CheckRef corrections.
+
+Swapping REF and ALT of a switched biallelic site also swaps what its
+values refer to: genotype allele indices (0|1 becomes 1|0), the ALT dosage
+(DS becomes ploidy - DS), per-genotype terms (GP, GL and PL reverse, as do
+the AD depths) and the INFO allele frequency and count (AF becomes 1 - AF,
+AC becomes AN - AC). Other values are copied as they are.
+
+Cohorts hold tens of thousands of samples per line, so a record is split
+only into its nine fixed columns and the sample columns are rewritten in
+bulk. With FORMAT GT alone, the whole sample text goes through one
+bytes.translate. Imputation output usually writes every sample with the
+same byte width (0|1:0.998:0.001,0.999,0.000), so with NumPy the sample
+text is viewed as a byte matrix with one row per sample: GT columns go
+through a lookup table, DS digits are complemented as integers and GP
+terms are swapped as column ranges, with no Python object per sample.
+Samples that share a layout but not a width are split once into tokens,
+and each key's tokens are moved with list slices. Any other record is
+handled per FORMAT key with map() over builtins.
+"""
+
+import operator
+from itertools import repeat
+
+try:
+    import numpy as np
+except ImportError:  # numbers are then complemented as text
+    np = None
+
+GT_FLIP = bytes.maketrans(b'01', b'10')
+GT_FLIP_TABLE = None if np is None else np.frombuffer(GT_FLIP, dtype=np.uint8)
+REVERSED_KEYS = (b'GP', b'GL', b'PL', b'AD')
+FLIPPED_KEYS = frozenset((b'GT', b'DS') + REVERSED_KEYS)
+NOT_SEPARATORS = bytes(sorted(set(range(256)) - set(b'\t:,')))
+NOT_PLOIDY_MARKS = bytes(sorted(set(range(256)) - set(b'\t/|')))
+MISSING_AS_NAN = {b'.': b'nan'}
+NAN = float('nan')
+NAN_AS_MISSING = {'nan': '.'}
+EXPONENT_FORMAT = '{:.6g}'
+
+
+def complement_digits(matrix, totals):
+    """total - value for a matrix of unsigned numbers, one per row, that share their width and decimal point
+
+    Returns the new matrix, whose numbers keep the width (0.998 -> 1.002
+    with total 2), or None if the rows do not fit that shape.
+    """
+    width = matrix.shape[1]
+    point = bytes(matrix[0]).find(b'.')
+    if point >= 0 and not (matrix[:, point] == ord('.')).all():
+        return None
+    digit_columns = [column for column in range(width) if column != point]
+    digits = matrix[:, digit_columns].astype(np.int64) - ord('0')
+    if not digit_columns or not ((digits >= 0) & (digits <= 9)).all():
+        return None
+    weights = 10 ** np.arange(len(digit_columns) - 1, -1, -1, dtype=np.int64)
+    scale = 10 ** (width - point - 1 if point >= 0 else 0)
+    results = np.asarray(totals, dtype=np.int64) * scale - digits @ weights
+    if (results < 0).any() or (results >= 10 * weights[0]).any():
+        return None
+    out = matrix.copy()
+    out[:, digit_columns] = (results[:, None] // weights) % 10 + ord('0')
+    return out
+
+
+def complement_text(values, totals):
+    """total - value for each number, written with the value's own decimal places; missing values stay '.'
+
+    A value above its total has no valid complement and becomes missing.
+    """
+    values = list(map(MISSING_AS_NAN.get, values, values))
+    numbers = [number if number >= 0 else NAN for number in map(operator.sub, totals, map(float, values))]
+    joined = b' '.join(values)
+    if b'e' in joined or b'E' in joined:
+        texts = list(map(EXPONENT_FORMAT.format, numbers))
+    else:
+        places = map(len, map(operator.itemgetter(2), map(bytes.partition, values, repeat(b'.'))))
+        texts = list(map('{:.{}f}'.format, numbers, places))
+    return list(map(str.encode, map(NAN_AS_MISSING.get, texts, texts)))
+
+
+def complement(values, totals):
+    """total - value for each number; totals is one integer for all values or a list with one per value"""
+    text = b''.join(values)
+    width = len(values[0])
+    if np is not None and len(values) > 1 and width and len(text) == width * len(values):
+        flipped = complement_digits(np.frombuffer(text, dtype=np.uint8).reshape(len(values), width), totals)
+        if flipped is not None:
+            return flipped.view(f'S{width}').ravel().tolist()
+    return complement_text(values, repeat(totals) if isinstance(totals, int) else totals)
+
+
+def ploidies(genotypes, joined):
+    """Allele count of each GT value (1 + its separators), as one integer when all share it
+
+    A GT with no allele index (., ./.) says nothing about ploidy and counts as diploid.
+    """
+    marks = joined.translate(None, NOT_PLOIDY_MARKS).replace(b'|', b'/')
+    if marks == b'/\t' * (len(genotypes) - 1) + b'/':
+        return 2
+    if b'/' not in marks and b'.' not in joined:
+        return 1
+    counts = map(operator.add, map(bytes.count, genotypes, repeat(b'/')), map(bytes.count, genotypes, repeat(b'|')))
+    return [count + 1 if genotype.strip(b'./|') else 2 for count, genotype in zip(counts, genotypes)]
+
+
+def reverse_terms(values):
+    """Reverse the comma-separated terms of each value: per-genotype (GP, GL, PL) or per-allele (AD) lists"""
+    return list(map(b','.join, map(reversed, map(bytes.split, values, repeat(b',')))))
+
+
+def flip_matrix(keys, samples):
+    """Flip sample columns that all have one byte width and layout as a byte matrix; None if they do not"""
+    width = samples.find(b'\t') + 1 or len(samples) + 1
+    if (len(samples) + 1) % width:
+        return None
+    matrix = np.frombuffer(samples + b'\t', dtype=np.uint8).reshape(-1, width)
+    separators = (matrix == ord('\t')) | (matrix == ord(':')) | (matrix == ord(','))
+    if not (separators == separators[0]).all() or not (matrix[:, separators[0]] == matrix[0, separators[0]]).all():
+        return None
+
+    # Byte ranges of each key's terms, from the separators of the first sample
+    bounds = [-1] + np.flatnonzero(separators[0]).tolist()
+    tokens = [(start + 1, end) for start, end in zip(bounds, bounds[1:])]
+    spans = [[]]
+    for token, separator in zip(tokens, matrix[0, bounds[1:]].tobytes()):
+        spans[-1].append(token)
+        if separator != ord(','):
+            spans.append([])
+    spans.pop()
+    if len(spans) != len(keys):
+        return None
+
+    out = matrix.copy()
+    genotypes = None
+    if b'GT' in keys:
+        start, end = spans[keys.index(b'GT')][0]
+        out[:, start:end] = GT_FLIP_TABLE[matrix[:, start:end]]
+        genotypes = out[:, start:end]
+    for key, terms in zip(keys, spans):
+        if key == b'DS' and len(terms) == 1:
+            start, end = terms[0]
+            # Haploid calls (e.g. male chrX) have dosages out of 1; a GT with no allele index counts as diploid
+            totals = 2
+            if genotypes is not None:
+                called = ((genotypes >= ord('0')) & (genotypes <= ord('9'))).any(axis=1)
+                totals = np.where(called, ((genotypes == ord('/')) | (genotypes == ord('|'))).sum(axis=1) + 1, 2)
+            flipped = complement_digits(matrix[:, start:end], totals)
+            if flipped is None:
+                return None
+            out[:, start:end] = flipped
+        elif key in REVERSED_KEYS and len(terms) > 1:
+            comma = matrix[:, terms[0][1]:terms[0][1] + 1]
+            pieces = []
+            for start, end in reversed(terms):
+                pieces += [matrix[:, start:end], comma]
+            out[:, terms[0][0]:terms[-1][1]] = np.concatenate(pieces[:-1], axis=1)
+    return out.tobytes()[:-1], None if genotypes is None else genotypes.tobytes()
+
+
+def sample_layout(keys, samples):
+    """Terms per FORMAT key and the separators of one sample, if every sample is laid out alike; else None"""
+    parts = samples.partition(b'\t')[0].split(b':')
+    if len(parts) != len(keys):
+        return None
+    terms = [part.count(b',') + 1 for part in parts]
+    separators = b':'.join(b',' * (count - 1) for count in terms) + b'\t'
+    if samples.translate(None, NOT_SEPARATORS) != (separators * (samples.count(b'\t') + 1))[:-1]:
+        return None
+    return terms, separators
+
+
+def flip_tokens(keys, samples, terms, separators):
+    """Flip sample columns that share one layout, moving whole columns of tokens at a time"""
+    tokens = samples.replace(b'\t', b',').replace(b':', b',').split(b',')
+    width = len(separators)
+    starts = [sum(terms[:k]) for k in range(len(keys))]
+
+    genotypes = None
+    if b'GT' in keys:
+        start = starts[keys.index(b'GT')]
+        genotypes = b'\t'.join(tokens[start::width]).translate(GT_FLIP)
+        tokens[start::width] = genotypes.split(b'\t')
+    for key, start, count in zip(keys, starts, terms):
+        if key == b'DS' and count == 1:
+            # Haploid calls (e.g. male chrX) have dosages out of 1
+            totals = ploidies(tokens[starts[keys.index(b'GT')]::width], genotypes) if genotypes is not None else 2
+            tokens[start::width] = complement(tokens[start::width], totals)
+        elif key in REVERSED_KEYS:
+            columns = [tokens[start + j::width] for j in range(count)]
+            for j, column in enumerate(reversed(columns)):
+                tokens[start + j::width] = column
+
+    out = [b''] * (2 * len(tokens))
+    out[0::2] = tokens
+    out[1::2] = [separators[i:i + 1] for i in range(width)] * (len(tokens) // width)
+    return b''.join(out[:-1]), genotypes
+
+
+def flip_columns(keys, columns):
+    """Flip sample columns of any layout, one FORMAT key at a time; returns the new columns and their GT text"""
+    width = len(keys)
+    values = b'\t'.join(columns).replace(b'\t', b':').split(b':')
+    if len(values) != width * len(columns):
+        # Some samples drop trailing keys, as VCF allows; pad them so every key lines up
+        columns = [column + b':.' * (width - 1 - column.count(b':')) for column in columns]
+        values = b'\t'.join(columns).replace(b'\t', b':').split(b':')
+
+    genotypes = None
+    if b'GT' in keys:
+        k = keys.index(b'GT')
+        genotypes = b'\t'.join(values[k::width]).translate(GT_FLIP)
+        values[k::width] = genotypes.split(b'\t')
+    for k, key in enumerate(keys):
+        if key == b'DS':
+            totals = ploidies(values[keys.index(b'GT')::width], genotypes) if genotypes is not None else 2
+            values[k::width] = complement(values[k::width], totals)
+        elif key in REVERSED_KEYS:
+            values[k::width] = reverse_terms(values[k::width])
+
+    return list(map(b':'.join, zip(*(values[k::width] for k in range(width))))), genotypes
+
+
+def flip_samples(format_column, samples):
+    """Flip the sample columns (tab-joined) of a switched record; returns (new samples, GT text or None)"""
+    keys = format_column.split(b':')
+    if keys == [b'GT']:
+        samples = samples.translate(GT_FLIP)
+        return samples, samples
+    if FLIPPED_KEYS.isdisjoint(keys):
+        return samples, None
+    if np is not None:
+        flipped = flip_matrix(keys, samples)
+        if flipped is not None:
+            return flipped
+    layout = sample_layout(keys, samples)
+    if layout is not None:
+        return flip_tokens(keys, samples, *layout)
+    columns, genotypes = flip_columns(keys, samples.split(b'\t'))
+    return b'\t'.join(columns), genotypes
+
+
+def flip_info(info, genotypes=None):
+    """Flip AF and AC of a switched record's INFO column and flag it SWITCHED"""
+    if info == b'.':
+        return b'SWITCHED=1'
+    entries = info.split(b';')
+    keys = [entry.partition(b'=')[0] for entry in entries]
+    if b'AF' in keys:
+        k = keys.index(b'AF')
+        entries[k] = b'AF=' + complement_text([entries[k][3:]], [1])[0]
+    if b'AC' in keys and entries[keys.index(b'AC')] != b'AC=.':
+        k = keys.index(b'AC')
+        if b'AN' in keys:
+            an = entries[keys.index(b'AN')][3:]
+        elif genotypes is not None:
+            # No AN: count the called alleles, as bcftools +fill-tags does
+            an = b'%d' % (genotypes.count(b'0') + genotypes.count(b'1'))
+        else:
+            an = b''
+        if an.isdigit() and entries[k][3:].isdigit() and int(an) >= int(entries[k][3:]):
+            entries[k] = b'AC=%d' % (int(an) - int(entries[k][3:]))
+        else:
+            # Cannot be flipped; drop it rather than leave a count of the wrong allele
+            del entries[k]
+    entries.append(b'SWITCHED=1')
+    return b';'.join(entries)
+
+
+def flip_record(line):
+    """Swap REF/ALT of a biallelic single-base record, flip its genotype and INFO values and flag it SWITCHED
+
+    Returns None if the record cannot be corrected (multi-allelic or non-ACGT).
+    """
+    fields = line.rstrip(b'\r\n').split(b'\t', 9)
+    if len(fields) < 8:
+        return None
+    ref, alt = fields[3], fields[4]
+    if len(ref) != 1 or len(alt) != 1 or ref not in b'ACGT' or alt not in b'ACGT':
+        return None
+    fields[3], fields[4] = alt, ref
+    genotypes = None
+    if len(fields) == 10:
+        fields[9], genotypes = flip_samples(fields[8], fields[9])
+    fields[7] = flip_info(fields[7], genotypes)
+    return b'\t'.join(fields) + b'\n'
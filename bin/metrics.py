@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Machine-readable run metrics for CheckRef.
+
+check_allele_switch.py writes one versioned record per run (per chromosome
+in the pipeline) as JSON or as a one-row TSV with dotted column names, e.g.
+`counts.SWITCH`. aggregate_metrics.py merges many records in one process.
+"""
+
+import json
+import os
+
+METRICS_SCHEMA = "checkref-allele-switch-metrics"
+METRICS_VERSION = 1
+
+# Value types of the flattened TSV columns, by top-level key
+INT_SECTIONS = ("totals", "counts", "corrections", "incremental")
+FLOAT_SECTIONS = ("overlap", "timings")
+
+
+def percent(part, whole):
+    return round(part / whole * 100, 4) if whole else None
+
+
+def build_record(target_vcf, reference_file, mode, chroms, num_target, num_ref, num_common, counts,
+                 corrections=None):
+    """Metrics record of one allele switch check"""
+    record = {
+        "schema": METRICS_SCHEMA,
+        "version": METRICS_VERSION,
+        "target_vcf": target_vcf,
+        "reference_file": reference_file,
+        "mode": mode,
+        "chroms": list(chroms),
+        "totals": {"target": num_target, "reference": num_ref, "common": num_common},
+        "counts": dict(counts),
+        "overlap": {"target_pct": percent(num_common, num_target),
+                    "reference_pct": percent(num_common, num_ref)},
+        "timings": {},
+    }
+    if corrections is not None:
+        record["corrections"] = dict(corrections)
+    return record
+
+
+def flatten(record):
+    """Dotted-key view of a record, for TSV output"""
+    flat = {}
+    for key, value in record.items():
+        if isinstance(value, dict):
+            for sub_key, sub_value in value.items():
+                flat[f"{key}.{sub_key}"] = sub_value
+        elif isinstance(value, list):
+            flat[key] = ",".join(value)
+        else:
+            flat[key] = value
+    return flat
+
+
+def unflatten(flat):
+    """Inverse of flatten() for string values read from a TSV"""
+    record = {}
+    for key, value in flat.items():
+        section, _, sub_key = key.partition(".")
+        if not sub_key:
+            if section in ("chroms", "shards"):
+                record[section] = value.split(",") if value else []
+            elif section == "version":
+                record[section] = int(value)
+            else:
+                record[section] = value
+            continue
+        if value in ("", "None"):
+            value = None
+        elif section in INT_SECTIONS:
+            value = int(value)
+        elif section in FLOAT_SECTIONS:
+            value = float(value)
+        record.setdefault(section, {})[sub_key] = value
+    return record
+
+
+def write_metrics(path, record):
+    """Write a record as JSON, or as a one-row TSV when path ends in .tsv"""
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "w") as out:
+        if path.endswith(".tsv"):
+            flat = flatten(record)
+            out.write("\t".join(flat) + "\n")
+            out.write("\t".join("" if value is None else str(value) for value in flat.values()) + "\n")
+        else:
+            json.dump(record, out, indent=2)
+            out.write("\n")
+    os.replace(tmp_path, path)
+
+
+def read_metrics(path):
+    """Read a JSON or TSV metrics record, checking its schema and version"""
+    with open(path) as f:
+        if path.endswith(".tsv"):
+            header = f.readline().rstrip("\n").split("\t")
+            values = f.readline().rstrip("\n").split("\t")
+            record = unflatten(dict(zip(header, values)))
+        else:
+            record = json.load(f)
+    if record.get("schema") != METRICS_SCHEMA:
+        raise ValueError(f"{path} is not a CheckRef metrics record")
+    if record.get("version") != METRICS_VERSION:
+        raise ValueError(f"{path} has metrics version {record.get('version')}, expected {METRICS_VERSION}")
+    return record
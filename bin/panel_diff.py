@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Site-level diff of two reference legend releases for CheckRef.
+
+Compares an old and a new legend of the same panel and lists every site
+that was added, removed or given other alleles, per chromosome. Sites are
+(chromosome, position) pairs with the last row at a position winning, as
+when check_allele_switch.py loads a legend, so the diff holds exactly the
+sites whose classification can change between the two releases. Sorted
+legends are compared in one merge pass; unsorted ones are loaded.
+
+check_allele_switch.py --panel-diff applies a diff to the results of a
+check against the old legend, re-classifying only the listed sites that the
+target holds, instead of re-checking the target against the whole new legend.
+
+Output (TSV, genomic order):
+    ##old_legend=<file>,size=<bytes>,sha256=<hex>
+    ##new_legend=<file>,size=<bytes>,sha256=<hex>
+    CHROM  POS  CHANGE  OLD  NEW
+    chr22  16050115  CHANGED  G>A  G>T
+    chr22  16050213  ADDED  .  C>T
+
+Usage:
+    panel_diff.py <old.legend.gz> <new.legend.gz> <diff.tsv>
+"""
+
+import argparse
+import os
+import sys
+
+import profile_input
+from check_allele_switch import (UnsortedInputError, chrom_sort_key, iter_legend_records, iter_unique_sites,
+                                 parse_legend_file)
+
+CHANGES = ("ADDED", "REMOVED", "CHANGED")
+DIFF_HEADER = "CHROM\tPOS\tCHANGE\tOLD\tNEW\n"
+
+
+def alleles_text(alleles):
+    return '.' if alleles is None else f"{alleles[0]}>{alleles[1]}"
+
+
+def parse_alleles(text):
+    return None if text == '.' else tuple(text.split('>', 1))
+
+
+def merge_sites(old_sites, new_sites):
+    """Walk two sorted unique-site streams together, yielding (old record, new record) with None on the side missing"""
+    old_iter = iter(old_sites)
+    new_iter = iter(new_sites)
+    old = next(old_iter, None)
+    new = next(new_iter, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old[0] < new[0]):
+            yield old[1], None
+            old = next(old_iter, None)
+        elif old is None or new[0] < old[0]:
+            yield None, new[1]
+            new = next(new_iter, None)
+        else:
+            yield old[1], new[1]
+            old = next(old_iter, None)
+            new = next(new_iter, None)
+
+
+def diff_streaming(old_legend, new_legend):
+    """Yield (chrom, original_chrom, pos, change, old alleles, new alleles) from two sorted legends"""
+    old_sites = iter_unique_sites(iter_legend_records(old_legend), "Old legend")
+    new_sites = iter_unique_sites(iter_legend_records(new_legend), "New legend")
+    for old, new in merge_sites(old_sites, new_sites):
+        if new is None:
+            yield old[0], old[1], old[2], "REMOVED", (old[3], old[4]), None
+        elif old is None:
+            yield new[0], new[1], new[2], "ADDED", None, (new[3], new[4])
+        elif (old[3], old[4]) != (new[3], new[4]):
+            yield new[0], new[1], new[2], "CHANGED", (old[3], old[4]), (new[3], new[4])
+
+
+def diff_loaded(old_legend, new_legend):
+    """Like diff_streaming, for legends that are not position-sorted"""
+    old_variants, old_chroms = parse_legend_file(old_legend)
+    new_variants, new_chroms = parse_legend_file(new_legend)
+    changes = []
+    for key, new in new_variants.items():
+        old = old_variants.get(key)
+        if old is None:
+            changes.append((key, new_chroms, "ADDED", None, new))
+        elif old != new:
+            changes.append((key, new_chroms, "CHANGED", old, new))
+    for key, old in old_variants.items():
+        if key not in new_variants:
+            changes.append((key, old_chroms, "REMOVED", old, None))
+    changes.sort(key=lambda change: (chrom_sort_key(change[0][0]), int(change[0][1])))
+    for (chrom, pos), chroms, change, old, new in changes:
+        yield chrom, chroms.get(chrom, f"chr{chrom}"), pos, change, old, new
+
+
+def diff_panels(old_legend, new_legend, diff_file):
+    """Write the site diff of two legends; returns {chrom: {change: count}}"""
+    summary = {}
+    tmp_path = f"{diff_file}.tmp{os.getpid()}"
+    # The checksums tie the diff to both releases, so --panel-diff can refuse any other legend
+    header = "".join(f"##{label}={os.path.basename(path)},size={os.path.getsize(path)},"
+                     f"sha256={profile_input.file_sha256(path)}\n"
+                     for label, path in (("old_legend", old_legend), ("new_legend", new_legend)))
+    for attempt in (diff_streaming, diff_loaded):
+        try:
+            with open(tmp_path, 'w') as out:
+                out.write(header)
+                out.write(DIFF_HEADER)
+                summary = {}
+                for chrom, original_chrom, pos, change, old, new in attempt(old_legend, new_legend):
+                    out.write(f"{original_chrom}\t{pos}\t{change}\t{alleles_text(old)}\t{alleles_text(new)}\n")
+                    chrom_summary = summary.setdefault(original_chrom, dict.fromkeys(CHANGES, 0))
+                    chrom_summary[change] += 1
+            break
+        except UnsortedInputError as e:
+            print(f"{e}; loading both legends instead")
+    os.replace(tmp_path, diff_file)
+    return summary
+
+
+def read_panel_diff(diff_file):
+    """Return (header, {(chrom, pos): (original_chrom, change, old alleles, new alleles)}) from a panel diff"""
+    header = {}
+    sites = {}
+    with open(diff_file) as f:
+        for line in f:
+            if line.startswith('##'):
+                label, _, value = line[2:].rstrip('\n').partition('=')
+                name, *fields = value.split(',')
+                header[label] = dict(field.split('=', 1) for field in fields)
+                header[label]["file"] = name
+                continue
+            cols = line.rstrip('\n').split('\t')
+            if cols[0] == 'CHROM' or len(cols) < 5:
+                continue
+            if cols[2] not in CHANGES:
+                raise ValueError(f"{diff_file}: unknown change {cols[2]!r} at {cols[0]}:{cols[1]}")
+            sites[(cols[0].lstrip('chr'), cols[1])] = (cols[0], cols[2], parse_alleles(cols[3]),
+                                                      parse_alleles(cols[4]))
+    if "old_legend" not in header or "new_legend" not in header:
+        raise ValueError(f"{diff_file} is not a panel diff (no ##old_legend/##new_legend lines)")
+    if "sha256" not in header["old_legend"] or "sha256" not in header["new_legend"]:
+        raise ValueError(f"{diff_file} records no legend checksums; rerun panel_diff.py to regenerate it")
+    return header, sites
+
+
+def main():
+    parser = argparse.ArgumentParser(description='List the sites added, removed or changed between two releases '
+                                                 'of a reference legend')
+    parser.add_argument('old_legend', help='Legend of the previous panel release')
+    parser.add_argument('new_legend', help='Legend of the new panel release')
+    parser.add_argument('diff_file', help='Diff to write (TSV), for check_allele_switch.py --panel-diff')
+    args = parser.parse_args()
+
+    try:
+        summary = diff_panels(args.old_legend, args.new_legend, args.diff_file)
+    except (OSError, ValueError) as e:
+        print(f"ERROR: {e}")
+        sys.exit(1)
+
+    print("\nPanel Diff Summary:")
+    for chrom in sorted(summary, key=lambda name: chrom_sort_key(name.lstrip('chr'))):
+        counts = summary[chrom]
+        print(f"{chrom}: " + ", ".join(f"{change.lower()} {counts[change]}" for change in CHANGES))
+    total = sum(sum(counts.values()) for counts in summary.values())
+    print(f"Sites changed between releases: {total}")
+    print(f"Panel diff written to: {args.diff_file}")
+
+
+if __name__ == '__main__':
+    main()
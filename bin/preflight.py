@@ -0,0 +1,447 @@
+#!/usr/bin/env python3
+"""
+Sampled preflight check for CheckRef.
+
+Compares a few thousand target sites with the reference before anything
+loads either file in full, so a build, chromosome or strand mismatch fails
+in seconds instead of after the whole legend has been parsed and intersected.
+
+The target is cut into strata of equal compressed size, and a run of
+consecutive SNP records is read from each after a seek to the next BGZF
+block. The reference windows holding those runs come through its .tbi, or
+through a bisection of its BGZF blocks by position when it has none.
+A plain-gzip target is streamed instead, never holding more than the
+sample in memory. A reference that cannot be seeked into (plain gzip, or
+BGZF but not position-sorted) is not read at all: the preflight would
+cost as much as the full parse it is meant to spare, so it returns
+inconclusive and leaves the pair to the check.
+
+From the sample come the overlap (sampled target sites present in the
+reference) and the shares of MATCH, SWITCH, COMPLEMENT, COMPLEMENT_SWITCH
+and OTHER among the common sites, each with a 95% Wilson interval. The
+preflight fails only when an interval rules out a usable pairing:
+
+    CHROMOSOME_MISMATCH  none of the sampled target contigs is in the reference
+    BUILD_MISMATCH       most common sites carry other alleles
+    STRAND_MISMATCH      most common sites carry the complementary alleles
+
+A low overlap alone is inconclusive: a target and legend of the same build
+can share few positions, and the full check then reports them.
+
+Usage:
+    preflight.py <target.vcf.gz> <reference.legend.gz> --legend [--sites N] [--strata S] [--json FILE]
+
+Exits with status 5 when the preflight fails, after writing the report.
+"""
+
+import argparse
+import gzip
+import json
+import math
+import os
+import random
+import sys
+import time
+
+import bgzf
+import profile_input
+import tabix_index
+import vcf_reader
+from check_allele_switch import (ALLELE_STATUSES, chrom_sort_key, classify_alleles, legend_layout,
+                                 parse_legend_row)
+
+PREFLIGHT_SCHEMA = "checkref-preflight"
+PREFLIGHT_VERSION = 1
+FAILED_EXIT_CODE = 5
+DEFAULT_SITES = 2000
+DEFAULT_STRATA = 50
+Z_95 = 1.959964
+MIN_SITES = 50         # fewer sampled target sites than this can not support a verdict
+MIN_COMMON = 30        # nor can fewer common sites support one on their alleles
+MIN_OVERLAP = 0.02     # upper bound of the overlap below which the sample says nothing of the build
+MIN_CONCORDANCE = 0.6  # upper bound of the non-OTHER share below which alleles do not line up
+MAX_STRAND_FLIP = 0.5  # lower bound of the complement share above which the strands differ
+SCAN_SIZE = 4 * bgzf.MAX_BLOCK_SIZE
+
+
+def wilson_interval(k, n, z=Z_95):
+    """Wilson score interval of a proportion k/n"""
+    if n == 0:
+        return 0.0, 1.0
+    p = k / n
+    centre = (p + z * z / (2 * n)) / (1 + z * z / n)
+    half = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / (1 + z * z / n)
+    return max(0.0, centre - half), min(1.0, centre + half)
+
+
+def proportion(k, n):
+    low, high = wilson_interval(k, n)
+    return {"count": k, "total": n, "estimate": round(k / n, 4) if n else None,
+            "low": round(low, 4), "high": round(high, 4)}
+
+
+def site_key(chrom, pos):
+    return chrom_sort_key(chrom), pos
+
+
+def data_end(path):
+    """Offset just before the BGZF EOF marker block, if the file ends with one"""
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        f.seek(max(0, size - len(bgzf.EOF_BLOCK)))
+        tail = f.read()
+    return size - len(bgzf.EOF_BLOCK) if tail == bgzf.EOF_BLOCK else size
+
+
+def next_block(f, coffset, end):
+    """Compressed offset of the first BGZF block starting at or after coffset, or None"""
+    while coffset < end:
+        f.seek(coffset)
+        buf = f.read(SCAN_SIZE)
+        i = buf.find(bgzf.BGZF_MAGIC)
+        while 0 <= i <= len(buf) - bgzf.HEADER_SIZE - 6:
+            try:
+                bsize = bgzf.block_size(buf, i)
+            except ValueError:
+                bsize = None
+            # Deflate data can hold the magic bytes too; a real block is followed by another or by the end
+            if bsize is not None and (coffset + i + bsize >= end or buf[i + bsize:i + bsize + 4] == bgzf.BGZF_MAGIC
+                                      or i + bsize + 4 > len(buf)):
+                return coffset + i
+            i = buf.find(bgzf.BGZF_MAGIC, i + 1)
+        if len(buf) < SCAN_SIZE:
+            return None
+        coffset += len(buf) - bgzf.HEADER_SIZE - 6
+    return None
+
+
+def lines_from(reader, coffset):
+    """Yield the complete lines from the block at coffset on, skipping the tail of one begun before it"""
+    reader.seek(coffset << 16)
+    if coffset:
+        reader.readline()
+    while True:
+        line = reader.readline()
+        if not line:
+            return
+        yield line
+
+
+class Window:
+    """A run of consecutive sampled target sites on one contig"""
+
+    def __init__(self, chrom):
+        self.chrom = chrom
+        self.start = None
+        self.end = None
+
+    def add(self, pos):
+        self.start = pos if self.start is None else min(self.start, pos)
+        self.end = pos if self.end is None else max(self.end, pos)
+
+
+def add_site(sites, windows, record):
+    """Record a sampled target SNP, extending the window of its contig"""
+    chrom, original_chrom, pos, ref, alt = record
+    pos = int(pos)
+    # The last record at a position wins, as when the checker loads the target
+    sites[(chrom, pos)] = (original_chrom, ref, alt)
+    if not windows or windows[-1].chrom != chrom:
+        windows.append(Window(chrom))
+    windows[-1].add(pos)
+
+
+def sample_target_blocks(target_vcf, strata, per_stratum):
+    """Sample per_stratum consecutive SNPs after each of strata evenly spaced BGZF seeks"""
+    sites = {}
+    windows = []
+    end = data_end(target_vcf)
+    with open(target_vcf, 'rb') as f, bgzf.BgzfReader(target_vcf) as reader:
+        last_block = -1
+        for i in range(strata):
+            coffset = next_block(f, end * i // strata, end)
+            if coffset is None or coffset <= last_block:
+                continue
+            last_block = coffset
+            taken = 0
+            stratum = []
+            for line in lines_from(reader, coffset):
+                record = vcf_reader.parse_snp_line(line)
+                if record is None:
+                    continue
+                add_site(sites, stratum, record)
+                taken += 1
+                if taken >= per_stratum:
+                    break
+            windows.extend(stratum)
+    return sites, windows
+
+
+def sample_target_stream(target_vcf, strata, per_stratum, seed):
+    """Reservoir-sample strata runs of per_stratum consecutive SNPs from a streamed target"""
+    rng = random.Random(seed)
+    runs = []
+    run = []
+    seen = 0
+    for record in vcf_reader.iter_snp_records(target_vcf):
+        run.append(record)
+        if len(run) < per_stratum:
+            continue
+        if len(runs) < strata:
+            runs.append(run)
+        else:
+            j = rng.randrange(seen + 1)
+            if j < strata:
+                runs[j] = run
+        seen += 1
+        run = []
+    if run and len(runs) < strata:
+        runs.append(run)
+    sites = {}
+    windows = []
+    for run in runs:
+        stratum = []
+        for record in run:
+            add_site(sites, stratum, record)
+        windows.extend(stratum)
+    return sites, windows
+
+
+def reference_parser(reference_file, use_legend):
+    """Return a parse_line(bytes) for reference records; legend rows are laid out from the first line"""
+    if not use_legend:
+        return vcf_reader.parse_snp_line
+    open_func = gzip.open if reference_file.endswith('.gz') else open
+    with open_func(reference_file, 'rt') as f:
+        header = f.readline()
+    layout = legend_layout(header, reference_file)
+
+    def parse_line(line):
+        record = parse_legend_row(layout, line.decode('utf-8', 'replace'))
+        # The header row, and anything else without a numeric position
+        if record is None or not record[2].isdigit():
+            return None
+        return record
+
+    return parse_line
+
+
+class ReferenceSample:
+    """Reference records in the sampled windows, keyed by (chrom, pos)"""
+
+    def __init__(self):
+        self.records = {}
+        self.contigs = set()
+        self.unsorted = False
+
+    def add(self, record):
+        chrom, _, pos, ref, alt = record
+        self.contigs.add(chrom)
+        # The last record at a position wins, as when the checker loads the reference
+        self.records[(chrom, int(pos))] = (ref, alt)
+
+
+def fetch_indexed(reference_file, index_path, windows, parse_line, sample):
+    """Read the reference records in each window through the reference .tbi"""
+    index = tabix_index.TabixIndex(index_path)
+    names = {name.lstrip('chr'): name for name in index.names}
+    sample.contigs.update(names)
+    with bgzf.BgzfReader(reference_file) as reader:
+        for window in windows:
+            name = names.get(window.chrom)
+            if name is None:
+                continue
+            for line in index.fetch(reader, name, window.start - 1, window.end):
+                record = parse_line(line)
+                if record is not None and record[0] == window.chrom and window.start <= int(record[2]) <= window.end:
+                    sample.add(record)
+
+
+def first_key_after(f, reader, coffset, end, parse_line, sample):
+    """(block, key of its first complete record) for the first block at or after coffset"""
+    block = next_block(f, coffset, end)
+    if block is None:
+        return None, None
+    for line in lines_from(reader, block):
+        record = parse_line(line)
+        if record is not None:
+            sample.contigs.add(record[0])
+            return block, site_key(record[0], int(record[2]))
+    return block, None
+
+
+def fetch_bisected(reference_file, windows, parse_line, sample):
+    """Read the reference records in each window of a sorted, unindexed BGZF reference by bisecting its blocks"""
+    end = data_end(reference_file)
+    with open(reference_file, 'rb') as f, bgzf.BgzfReader(reference_file) as reader:
+        first_key_after(f, reader, 0, end, parse_line, sample)
+        for window in windows:
+            start_key = site_key(window.chrom, window.start)
+            end_key = site_key(window.chrom, window.end)
+            # Narrow to the last block whose first complete record sorts before the window
+            lo, hi = 0, end
+            while hi - lo > bgzf.MAX_BLOCK_SIZE:
+                mid = (lo + hi) // 2
+                block, key = first_key_after(f, reader, mid, end, parse_line, sample)
+                if block is None or block >= hi or key is None or key >= start_key:
+                    hi = mid
+                else:
+                    lo = block
+            last_key = None
+            for line in lines_from(reader, lo):
+                record = parse_line(line)
+                if record is None:
+                    continue
+                key = site_key(record[0], int(record[2]))
+                if last_key is not None and key < last_key:
+                    sample.unsorted = True
+                    return
+                last_key = key
+                if key > end_key:
+                    break
+                if key >= start_key:
+                    sample.add(record)
+
+
+def sample_reference(reference_file, use_legend, windows):
+    """Return (ReferenceSample, method) for the sampled target windows; (None, "none") if it is not seekable"""
+    if not bgzf.is_bgzf(reference_file):
+        return None, "none"
+    parse_line = reference_parser(reference_file, use_legend)
+    sample = ReferenceSample()
+    index_path = tabix_index.current_index(reference_file)
+    if index_path:
+        fetch_indexed(reference_file, index_path, windows, parse_line, sample)
+        return sample, "tabix"
+    profile = profile_input.cached_profile(reference_file, 'legend' if use_legend else 'vcf')
+    if profile is not None and not profile["sorted"]:
+        return None, "none"
+    fetch_bisected(reference_file, windows, parse_line, sample)
+    if sample.unsorted:
+        return None, "none"
+    return sample, "bisect"
+
+
+def assess(sites, reference):
+    """Classify the sampled sites and return (report fields, verdict, code, reason)"""
+    counts = {status: 0 for status in ALLELE_STATUSES}
+    for key, (_, ref, alt) in sites.items():
+        alleles = reference.records.get(key)
+        if alleles is not None:
+            counts[classify_alleles(ref, alt, alleles[0], alleles[1])] += 1
+    sampled = len(sites)
+    common = sum(counts.values())
+    target_contigs = sorted({chrom for chrom, _ in sites}, key=chrom_sort_key)
+    reference_contigs = sorted(reference.contigs, key=chrom_sort_key)
+    overlap = proportion(common, sampled)
+    concordance = proportion(common - counts["OTHER"], common)
+    strand_flip = proportion(counts["COMPLEMENT"] + counts["COMPLEMENT_SWITCH"], common)
+    fields = {
+        "sample": {"sites": sampled, "common": common},
+        "contigs": {"target": target_contigs, "reference": reference_contigs},
+        "overlap": overlap,
+        "concordance": concordance,
+        "strand_flip": strand_flip,
+        "statuses": {status: proportion(count, common) for status, count in counts.items()},
+    }
+
+    if sampled < MIN_SITES:
+        return fields, "inconclusive", None, f"only {sampled} target SNPs sampled (need {MIN_SITES})"
+    if reference_contigs and not set(target_contigs) & set(reference_contigs):
+        return fields, "fail", "CHROMOSOME_MISMATCH", (
+            f"target covers {', '.join(target_contigs)} but the reference covers {', '.join(reference_contigs)}")
+    # A target and legend of the same build may simply not share positions, so
+    # a low overlap alone leaves the verdict to the check
+    if overlap["high"] < MIN_OVERLAP:
+        return fields, "inconclusive", None, (
+            f"at most {overlap['high']:.1%} of target positions are in the reference "
+            f"({common} of {sampled} sampled); too few to judge the build")
+    if common < MIN_COMMON:
+        return fields, "inconclusive", None, f"only {common} sampled sites in common (need {MIN_COMMON})"
+    if concordance["high"] < MIN_CONCORDANCE:
+        return fields, "fail", "BUILD_MISMATCH", (
+            f"at most {concordance['high']:.1%} of common sites share alleles with the reference "
+            f"({common - counts['OTHER']} of {common}); the positions belong to another build")
+    if strand_flip["low"] > MAX_STRAND_FLIP:
+        return fields, "fail", "STRAND_MISMATCH", (
+            f"at least {strand_flip['low']:.1%} of common sites carry the complementary alleles "
+            f"({strand_flip['count']} of {common}); the target is on the opposite strand")
+    return fields, "pass", None, "sample is consistent with the reference"
+
+
+def preflight(target_vcf, reference_file, use_legend=False, sites=DEFAULT_SITES, strata=DEFAULT_STRATA, seed=1):
+    """Sample target and reference, print the estimates and return the preflight report"""
+    started = time.perf_counter()
+    per_stratum = max(1, math.ceil(sites / strata))
+    if bgzf.is_bgzf(target_vcf):
+        target_sites, windows = sample_target_blocks(target_vcf, strata, per_stratum)
+        target_method = "bgzf-seek"
+    else:
+        target_sites, windows = sample_target_stream(target_vcf, strata, per_stratum, seed)
+        target_method = "stream"
+    reference, reference_method = sample_reference(reference_file, use_legend, windows)
+    if reference is None:
+        fields = assess(target_sites, ReferenceSample())[0]
+        verdict, code, reason = "inconclusive", None, (
+            "reference not seekable (plain gzip, or not position-sorted); the full check reads it instead")
+    else:
+        fields, verdict, code, reason = assess(target_sites, reference)
+
+    report = {
+        "schema": PREFLIGHT_SCHEMA,
+        "version": PREFLIGHT_VERSION,
+        "target": os.path.basename(target_vcf),
+        "reference": os.path.basename(reference_file),
+        "method": {"target": target_method, "reference": reference_method, "windows": len(windows)},
+    }
+    report.update(fields)
+    report.update({"verdict": verdict, "code": code, "reason": reason,
+                   "seconds": round(time.perf_counter() - started, 3)})
+
+    def interval(p):
+        if p["estimate"] is None:
+            return "n/a"
+        return f"{p['estimate']:.1%} [{p['low']:.1%}, {p['high']:.1%}]"
+
+    print(f"Sampled {len(target_sites)} target SNPs in {len(windows)} windows ({target_method}; "
+          f"reference read by {reference_method})")
+    print(f"Overlap with reference: {interval(fields['overlap'])}")
+    for status in ALLELE_STATUSES:
+        print(f"  {status}: {interval(fields['statuses'][status])}")
+    print(f"Preflight {verdict.upper()}{' ' + code if code else ''}: {reason}")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Estimate target/reference concordance from a sample and fail '
+                                                 'fast on a build, chromosome or strand mismatch')
+    parser.add_argument('target_vcf', help='Target VCF file')
+    parser.add_argument('reference_file', help='Reference VCF or legend file')
+    parser.add_argument('--legend', action='store_true', help='Reference is a legend file')
+    parser.add_argument('--sites', type=int, default=DEFAULT_SITES,
+                        help=f'Target SNPs to sample (default: {DEFAULT_SITES})')
+    parser.add_argument('--strata', type=int, default=DEFAULT_STRATA,
+                        help=f'Evenly spaced strata the sample is drawn from (default: {DEFAULT_STRATA})')
+    parser.add_argument('--seed', type=int, default=1, help='Seed for sampling a target that cannot be seeked')
+    parser.add_argument('--json', help='Write the preflight report as JSON')
+    args = parser.parse_args()
+
+    if args.sites < 1 or args.strata < 1:
+        parser.error("--sites and --strata must be positive")
+    try:
+        report = preflight(args.target_vcf, args.reference_file, args.legend, args.sites, args.strata, args.seed)
+    except (OSError, ValueError, vcf_reader.UnsupportedVcfError) as e:
+        print(f"ERROR: {e}")
+        sys.exit(1)
+    if args.json:
+        tmp_path = f"{args.json}.tmp{os.getpid()}"
+        with open(tmp_path, 'w') as out:
+            json.dump(report, out, indent=2)
+            out.write("\n")
+        os.replace(tmp_path, args.json)
+    if report["verdict"] == "fail":
+        sys.exit(FAILED_EXIT_CODE)
+
+
+if __name__ == '__main__':
+    main()
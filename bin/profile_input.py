@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+"""
+Single-scan input profiler for CheckRef.
+
+Reads a target VCF or reference legend once, checking the compressed bytes
+and the gzip CRCs as it goes, and writes a JSON sidecar
+(<file>.profile.json) with everything the pipeline used to rescan the file
+for. That covers the validation verdict, record and SNP counts, contigs,
+sortedness, build evidence and the file's SHA-256.
+
+Later stages read the sidecar instead of decompressing the file again.
+check_allele_switch.py picks up a sidecar found next to an input or in the
+working directory, as long as the file's size and mtime still match.
+
+Usage:
+    profile_input.py profile <file> [--kind vcf|legend] [--output FILE]
+    profile_input.py get <profile> <field>      (e.g. first_chrom, verdict, records.total)
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import zlib
+
+import bgzf
+
+PROFILE_SCHEMA = "checkref-input-profile"
+PROFILE_VERSION = 1
+PROFILE_SUFFIX = ".profile.json"
+READ_SIZE = 1 << 20
+INFLATE_SLICE = 1 << 16
+MIN_FILE_SIZE = 100  # smaller files are treated as empty or truncated, as in VALIDATE_VCF_FILES
+LEGEND_BUILD_SAMPLE = 10  # legend rows detect_legend_build() looks at
+CHECKPOINT_INTERVAL = 10000  # records between contig position checkpoints, used to plan shards
+
+
+class Profiler:
+    """Accumulates per-line statistics while the input is streamed once"""
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.header_lines = 0
+        self.header = {"fileformat": None, "has_chrom_line": False, "samples": 0, "contigs": []}
+        self.build_markers = {"hg38": False, "hg19": False}
+        self.records = {"total": 0, "snps": 0, "multiallelic": 0, "malformed": 0}
+        self.contigs = {}
+        self.first_chrom = None
+        self.sorted = True
+        self.legend_build = 'unknown'
+        self._current = None
+        self._last_key = None
+        self._legend_rows = 0
+
+    def line(self, line):
+        if self.kind == 'legend':
+            self._legend_line(line)
+        elif line.startswith(b'#'):
+            self._header_line(line)
+        elif line:
+            self._record(line.split(b'\t', 5))
+
+    def _header_line(self, line):
+        self.header_lines += 1
+        text = line.decode('utf-8', 'replace')
+        # Same markers as detect_genome_build(), which searched the whole header text
+        if 'GRCh38' in text or 'hg38' in text:
+            self.build_markers["hg38"] = True
+        if 'GRCh37' in text or 'hg19' in text:
+            self.build_markers["hg19"] = True
+        if text.startswith('##fileformat='):
+            self.header["fileformat"] = text[len('##fileformat='):].strip()
+        elif text.startswith('##contig=<ID='):
+            self.header["contigs"].append(text[len('##contig=<ID='):].split(',')[0].rstrip('>\r\n'))
+        elif text.startswith('#CHROM'):
+            self.header["has_chrom_line"] = True
+            self.header["samples"] = max(0, len(text.rstrip('\r\n').split('\t')) - 9)
+
+    def _record(self, fields):
+        from vcf_reader import snp_alleles
+
+        self.records["total"] += 1
+        if self.first_chrom is None:
+            # EXTRACT_VCF_INFO reported column 1 of the first record, well-formed or not
+            self.first_chrom = fields[0].decode()
+        if len(fields) < 5:
+            self.records["malformed"] += 1
+            return
+        alts = fields[4].rstrip(b'\r\n')
+        if b',' in alts:
+            self.records["multiallelic"] += 1
+        if snp_alleles(fields[3], alts) is not None:
+            self.records["snps"] += 1
+        self._site(fields[0].decode(), fields[1])
+
+    def _legend_line(self, line):
+        from vcf_reader import is_snp
+
+        if self.header_lines == 0:
+            self.header_lines = 1
+            self.header["columns"] = line.decode('utf-8', 'replace').split()
+            return
+        fields = line.split()
+        self._legend_rows += 1
+        # Same rule as detect_legend_build(): a large position among the first rows suggests hg38
+        if self._legend_rows <= LEGEND_BUILD_SAMPLE and len(fields) >= 3 and fields[2].isdigit() \
+                and int(fields[2]) > 50000000:
+            self.legend_build = 'likely_hg38'
+        if not fields:
+            return
+        self.records["total"] += 1
+        if len(fields) < 5:
+            self.records["malformed"] += 1
+            return
+        if is_snp(fields[3].decode(), fields[4].decode()):
+            self.records["snps"] += 1
+        self._site(fields[1].decode(), fields[2])
+
+    def _site(self, chrom, pos):
+        from check_allele_switch import chrom_sort_key
+
+        try:
+            pos = int(pos)
+        except ValueError:
+            self.records["malformed"] += 1
+            return
+        if self.first_chrom is None:
+            self.first_chrom = chrom
+        if chrom != self._current:
+            if chrom in self.contigs:
+                # Re-entering a contig means records are not grouped by chromosome
+                self.sorted = False
+            else:
+                self.contigs[chrom] = {"name": chrom, "records": 0, "first": pos, "last": pos, "checkpoints": []}
+            self._current = chrom
+        contig = self.contigs[chrom]
+        if contig["records"] % CHECKPOINT_INTERVAL == 0:
+            contig["checkpoints"].append(pos)
+        contig["records"] += 1
+        contig["last"] = pos
+        key = (chrom_sort_key(chrom.lstrip('chr')), pos)
+        if self._last_key is not None and key < self._last_key:
+            self.sorted = False
+        self._last_key = key
+
+
+def iter_lines(path, digest, state):
+    """Yield the lines of a plain, gzip or BGZF file, hashing the raw bytes; sets state['error'] on corruption"""
+    with open(path, 'rb') as f:
+        magic = f.read(2)
+        f.seek(0)
+        compressed = magic == b'\x1f\x8b'
+        inflater = zlib.decompressobj(31) if compressed else None
+        member_started = False
+        carry = b''
+        try:
+            for raw in iter(lambda: f.read(READ_SIZE), b''):
+                digest.update(raw)
+                # Inflate in slices so the lines before a corrupt spot are still profiled
+                for start in range(0, len(raw), INFLATE_SLICE):
+                    data = raw[start:start + INFLATE_SLICE]
+                    if not compressed:
+                        text = data
+                    else:
+                        parts = []
+                        while data:
+                            member_started = True
+                            parts.append(inflater.decompress(data))
+                            if inflater.eof:
+                                # Concatenated gzip members (every BGZF block is one)
+                                data = inflater.unused_data
+                                inflater = zlib.decompressobj(31)
+                                member_started = False
+                            else:
+                                data = b''
+                        text = b''.join(parts)
+                    if not text:
+                        continue
+                    lines = (carry + text).split(b'\n')
+                    carry = lines.pop()
+                    yield from lines
+            if compressed and member_started:
+                state["error"] = "gzip stream is truncated"
+            state["scanned"] = True
+        except zlib.error as e:
+            state["error"] = f"gzip data is corrupted ({e})"
+            # Keep hashing so the checksum still describes the file on disk
+            for raw in iter(lambda: f.read(READ_SIZE), b''):
+                digest.update(raw)
+            state["scanned"] = True
+        if carry and "error" not in state:
+            yield carry
+
+
+def profile_file(path, kind=None):
+    """Profile an input in one pass and return the profile dict"""
+    if kind is None:
+        kind = 'legend' if '.legend' in os.path.basename(path) else 'vcf'
+    stat = os.stat(path)
+    profile = {
+        "schema": PROFILE_SCHEMA,
+        "version": PROFILE_VERSION,
+        "kind": kind,
+        "file": os.path.basename(path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "compression": 'bgzf' if bgzf.is_bgzf(path) else 'none',
+        "problems": [],
+        "warnings": [],
+    }
+    profiler = Profiler(kind)
+    digest = hashlib.sha256()
+    state = {}
+
+    with open(path, 'rb') as f:
+        head = f.read(4)
+    if profile["compression"] == 'none' and head[:2] == b'\x1f\x8b':
+        profile["compression"] = 'gzip'
+    if stat.st_size < MIN_FILE_SIZE:
+        profile["problems"].append(f"file is too small ({stat.st_size} bytes; likely empty or corrupted)")
+    elif head[:3] == b'BCF' or (profile["compression"] == 'bgzf' and bgzf.inflate_run(_first_block(path))[:3] == b'BCF'):
+        profile["problems"].append("file is BCF; convert it to VCF (bcftools view -Oz) before running CheckRef")
+    else:
+        for line in iter_lines(path, digest, state):
+            profiler.line(line)
+        if "error" in state:
+            profile["problems"].append(state["error"])
+        elif kind == 'vcf' and not profiler.header["has_chrom_line"]:
+            profile["problems"].append("no #CHROM header line; not a valid VCF")
+        if profiler.records["total"] == 0 and not profile["problems"]:
+            profile["warnings"].append("no variant records")
+    if not state.get("scanned"):
+        # The size and BCF checks skip the scan; hash the raw bytes on their own
+        with open(path, 'rb') as f:
+            for raw in iter(lambda: f.read(READ_SIZE), b''):
+                digest.update(raw)
+
+    header_build = 'hg38' if profiler.build_markers["hg38"] else 'hg19' if profiler.build_markers["hg19"] else 'unknown'
+    profile.update({
+        "sha256": digest.hexdigest(),
+        "verdict": "FAILED" if profile["problems"] else "PASSED",
+        "header": dict(profiler.header, lines=profiler.header_lines),
+        "records": profiler.records,
+        "first_chrom": profiler.first_chrom,
+        "contigs": list(profiler.contigs.values()),
+        "sorted": profiler.sorted,
+        "build": {
+            # header: what detect_genome_build() reads from a VCF header
+            "header": header_build if kind == 'vcf' else 'unknown',
+            # content: what detect_legend_build() infers from the first legend positions
+            "content": profiler.legend_build if kind == 'legend' else 'unknown',
+            # chrom_style: the b37/b38 call EXTRACT_VCF_INFO makes from the chromosome prefix
+            "chrom_style": None if profiler.first_chrom is None else
+                           'b38' if profiler.first_chrom.startswith('chr') else 'b37',
+        },
+    })
+    return profile
+
+
+def _first_block(path):
+    with open(path, 'rb') as f:
+        buf = f.read(bgzf.MAX_BLOCK_SIZE)
+    return buf[:bgzf.block_size(buf, 0)]
+
+
+def write_profile(path, profile):
+    """Write a profile atomically"""
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, 'w') as out:
+        json.dump(profile, out, indent=2)
+        out.write("\n")
+    os.replace(tmp_path, path)
+
+
+def read_profile(path):
+    """Load a profile sidecar, checking its schema and version"""
+    with open(path) as f:
+        profile = json.load(f)
+    if profile.get("schema") != PROFILE_SCHEMA or profile.get("version") != PROFILE_VERSION:
+        raise ValueError(f"{path} is not a version {PROFILE_VERSION} CheckRef input profile")
+    return profile
+
+
+def cached_profile(path, kind=None):
+    """Return the sidecar profile of path if one exists and still matches the file, else None.
+
+    Looks next to the file first, then in the working directory, where a
+    workflow stages the sidecar alongside the file.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    for candidate in (path + PROFILE_SUFFIX, os.path.basename(path) + PROFILE_SUFFIX):
+        if not os.path.exists(candidate):
+            continue
+        try:
+            profile = read_profile(candidate)
+        except (OSError, ValueError):
+            continue
+        if (profile["size"] == stat.st_size and profile["mtime_ns"] == stat.st_mtime_ns
+                and (kind is None or profile["kind"] == kind)):
+            return profile
+    return None
+
+
+def file_sha256(path, kind=None):
+    """SHA-256 of a file's raw bytes, from its sidecar profile while that still matches, else by reading it"""
+    profile = cached_profile(path, kind)
+    if profile is not None:
+        return profile["sha256"]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for raw in iter(lambda: f.read(READ_SIZE), b''):
+            digest.update(raw)
+    return digest.hexdigest()
+
+
+def get_field(profile, field):
+    """Value of a dotted field such as records.total"""
+    value = profile
+    for part in field.split('.'):
+        value = value[part]
+    return value
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Profile a CheckRef input file in a single pass')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    profile_parser = subparsers.add_parser('profile', help='Scan a VCF or legend and write its profile sidecar')
+    profile_parser.add_argument('input_file', help='Target VCF or reference legend')
+    profile_parser.add_argument('--kind', choices=['vcf', 'legend'],
+                                help='Input type (default: legend if the name contains .legend, else vcf)')
+    profile_parser.add_argument('--output', help='Profile path (default: <input name>.profile.json in the working directory)')
+
+    get_parser = subparsers.add_parser('get', help='Print one field of a profile')
+    get_parser.add_argument('profile', help='Profile sidecar')
+    get_parser.add_argument('field', help='Dotted field name, e.g. verdict or records.total')
+
+    args = parser.parse_args()
+
+    if args.command == 'get':
+        try:
+            value = get_field(read_profile(args.profile), args.field)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"ERROR: {e}", file=sys.stderr)
+            sys.exit(1)
+        # stdout carries only the value, for capture in shell scripts
+        if isinstance(value, (dict, list)):
+            value = json.dumps(value)
+        elif isinstance(value, bool):
+            value = str(value).lower()
+        sys.stdout.write("" if value is None else str(value))
+        return
+
+    output = args.output or os.path.basename(args.input_file) + PROFILE_SUFFIX
+    profile = profile_file(args.input_file, args.kind)
+    write_profile(output, profile)
+    records = profile["records"]
+    print(f"{profile['file']}: {profile['verdict']}, {records['total']:,} records "
+          f"({records['snps']:,} SNPs), {len(profile['contigs'])} contig(s), "
+          f"{'sorted' if profile['sorted'] else 'unsorted'}, compression={profile['compression']}")
+    for problem in profile["problems"]:
+        print(f"  problem: {problem}")
+    for warning in profile["warnings"]:
+        print(f"  warning: {warning}")
+    print(f"Wrote {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+"""
+Memory-mapped reference catalog for CheckRef.
+
+Compiles a directory of reference legend files into a single binary file
+holding, per chromosome, sorted int32 positions and packed REF/ALT allele
+codes (see variant_table.py), plus metadata such as the original chromosome
+notation, detected build and the checksum of each source legend.
+
+The checker maps the catalog read-only, so opening it needs no parsing and
+concurrent tasks share the same page-cache pages. A catalog entry is only
+used while its source legend is unchanged; otherwise callers fall back to
+parsing the legend itself.
+
+Usage:
+    reference_catalog.py compile <reference_dir> <catalog> [--pattern '*.legend.gz']
+    reference_catalog.py info <catalog>
+    reference_catalog.py chrom <catalog> <legend_file>
+"""
+
+import argparse
+import bisect
+import glob
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+from collections.abc import Mapping
+
+from variant_table import CODE_BASES, NUM_CODES, OTHER_CODE, pack_pair
+
+MAGIC = b'CHKREFC1'
+CATALOG_VERSION = 1
+PREAMBLE = struct.Struct('<8sQ')  # magic, header length
+
+
+def align8(offset):
+    return (offset + 7) & ~7
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    """SHA-256 of a file's raw (compressed) bytes"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def sort_unique(positions, pairs, extra):
+    """Sort one chromosome by position, keeping the last record at repeated positions"""
+    if all(positions[i] < positions[i + 1] for i in range(len(positions) - 1)):
+        return positions, pairs, extra
+    order = sorted(range(len(positions)), key=positions.__getitem__)
+    kept = [row for i, row in enumerate(order)
+            if i + 1 == len(order) or positions[order[i + 1]] != positions[row]]
+    new_extra = {}
+    for new_row, old_row in enumerate(kept):
+        if old_row in extra:
+            new_extra[new_row] = extra[old_row]
+    return (array('i', (positions[row] for row in kept)),
+            array('B', (pairs[row] for row in kept)),
+            new_extra)
+
+
+def pack_reference(records, add_blob, known_chroms=()):
+    """Pack (chrom, original_chrom, pos, ref, alt) records into sorted per-chromosome blobs.
+
+    add_blob(data) stores a blob and returns its offset; the returned dict
+    maps each chromosome to the metadata CatalogChrom reads back. Raises
+    ValueError if a chromosome is already in known_chroms.
+    """
+    from check_allele_switch import chrom_sort_key
+
+    positions = {}
+    pairs = {}
+    extras = {}
+    originals = {}
+    for chrom, original_chrom, pos, ref, alt in records:
+        if chrom not in positions:
+            if chrom in known_chroms:
+                raise ValueError(f"chromosome {original_chrom} appears in more than one legend file")
+            positions[chrom] = array('i')
+            pairs[chrom] = array('B')
+            extras[chrom] = {}
+        pair = pack_pair(ref, alt)
+        if pair // NUM_CODES == OTHER_CODE or pair % NUM_CODES == OTHER_CODE:
+            extras[chrom][len(positions[chrom])] = (ref, alt)
+        positions[chrom].append(int(pos))
+        pairs[chrom].append(pair)
+        originals[chrom] = original_chrom
+
+    chroms = {}
+    for chrom in sorted(positions, key=chrom_sort_key):
+        chrom_positions, chrom_pairs, chrom_extra = sort_unique(positions[chrom], pairs[chrom], extras[chrom])
+        extra_rows = array('i', sorted(chrom_extra))
+        extra_offsets = array('I', [0])
+        extra_blob = bytearray()
+        for row in extra_rows:
+            ref, alt = chrom_extra[row]
+            extra_blob += f"{ref}\t{alt}".encode()
+            extra_offsets.append(len(extra_blob))
+        chroms[chrom] = {
+            'original': originals[chrom],
+            'count': len(chrom_positions),
+            'positions': add_blob(chrom_positions.tobytes()),
+            'pairs': add_blob(chrom_pairs.tobytes()),
+            'extra_count': len(extra_rows),
+            'extra_rows': add_blob(extra_rows.tobytes()),
+            'extra_offsets': add_blob(extra_offsets.tobytes()),
+            'extra_blob': add_blob(bytes(extra_blob)),
+            'extra_blob_len': len(extra_blob),
+        }
+        print(f"  {originals[chrom]}: {len(chrom_positions):,} sites ({len(extra_rows):,} non-SNP)")
+    return chroms
+
+
+def compile_catalog(reference_dir, catalog_path, pattern='*.legend.gz'):
+    """Parse every legend in reference_dir once and write the binary catalog"""
+    from check_allele_switch import detect_legend_build, iter_legend_records
+
+    legend_files = sorted(glob.glob(os.path.join(reference_dir, pattern)))
+    if not legend_files:
+        print(f"ERROR: no legend files match {os.path.join(reference_dir, pattern)}")
+        sys.exit(1)
+
+    sources = []
+    chroms = {}
+    blobs = []
+    data_size = 0
+
+    def add_blob(data):
+        nonlocal data_size
+        offset = data_size
+        blobs.append((offset, data))
+        data_size = align8(data_size + len(data))
+        return offset
+
+    for legend_file in legend_files:
+        print(f"Compiling {legend_file}...")
+        stat = os.stat(legend_file)
+        try:
+            legend_chroms = pack_reference(iter_legend_records(legend_file), add_blob, chroms)
+        except ValueError as e:
+            print(f"ERROR: {e}")
+            sys.exit(1)
+        for meta in legend_chroms.values():
+            meta['source'] = os.path.basename(legend_file)
+        chroms.update(legend_chroms)
+
+        sources.append({
+            'file': os.path.basename(legend_file),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'sha256': file_sha256(legend_file),
+            'build': detect_legend_build(legend_file),
+            'chroms': list(legend_chroms),
+        })
+
+    header = json.dumps({
+        'version': CATALOG_VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'reference_dir': os.path.abspath(reference_dir),
+        'sources': sources,
+        'chroms': chroms,
+    }).encode()
+    data_start = align8(PREAMBLE.size + len(header))
+
+    # Write to a temporary name and rename so readers never see a partial catalog
+    tmp_path = f"{catalog_path}.tmp{os.getpid()}"
+    with open(tmp_path, 'wb') as out:
+        out.write(PREAMBLE.pack(MAGIC, len(header)))
+        out.write(header)
+        for offset, data in blobs:
+            out.seek(data_start + offset)
+            out.write(data)
+        out.truncate(data_start + data_size)
+    os.replace(tmp_path, catalog_path)
+    print(f"Wrote catalog {catalog_path}: {len(sources)} legend file(s), {len(chroms)} chromosome(s)")
+
+
+class CatalogExtras:
+    """Read-only row -> (ref, alt) mapping for non-SNP alleles of one chromosome"""
+
+    def __init__(self, rows, offsets, blob):
+        self.rows = rows
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _find(self, row):
+        i = bisect.bisect_left(self.rows, row)
+        return i if i < len(self.rows) and self.rows[i] == row else -1
+
+    def __contains__(self, row):
+        return self._find(row) >= 0
+
+    def __getitem__(self, row):
+        i = self._find(row)
+        if i < 0:
+            raise KeyError(row)
+        ref, alt = bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode().split('\t')
+        return ref, alt
+
+
+class CatalogChrom:
+    """Zero-copy view of one chromosome in a mapped catalog"""
+
+    def __init__(self, chrom, meta, data):
+        self.chrom = chrom
+        self.original_chrom = meta['original']
+        count = meta['count']
+        extra_count = meta['extra_count']
+        self.positions = data[meta['positions']:meta['positions'] + 4 * count].cast('i')
+        self.pairs = data[meta['pairs']:meta['pairs'] + count]
+        self.extra = CatalogExtras(
+            data[meta['extra_rows']:meta['extra_rows'] + 4 * extra_count].cast('i'),
+            data[meta['extra_offsets']:meta['extra_offsets'] + 4 * (extra_count + 1)].cast('I'),
+            data[meta['extra_blob']:meta['extra_blob'] + meta['extra_blob_len']])
+
+    def __len__(self):
+        return len(self.positions)
+
+    def alleles(self, row):
+        """Return the (ref, alt) strings of a row"""
+        if row in self.extra:
+            return self.extra[row]
+        pair = self.pairs[row]
+        return CODE_BASES[pair // NUM_CODES], CODE_BASES[pair % NUM_CODES]
+
+
+class CatalogSites(Mapping):
+    """Read-only (chrom, pos) -> (ref, alt) view over catalog chromosomes, shaped like the checker's site dict"""
+
+    def __init__(self, chroms):
+        self.chroms = chroms
+
+    def _row(self, key):
+        """(table, row) of a site, or (None, -1) if absent"""
+        chrom, pos = key
+        table = self.chroms.get(chrom)
+        if table is None:
+            return None, -1
+        try:
+            value = int(pos)
+        except (TypeError, ValueError):
+            return None, -1
+        # Site dict keys are position strings; '0100' never matched '100' there either
+        if str(value) != pos:
+            return None, -1
+        row = bisect.bisect_left(table.positions, value)
+        if row < len(table.positions) and table.positions[row] == value:
+            return table, row
+        return None, -1
+
+    def __contains__(self, key):
+        return self._row(key)[0] is not None
+
+    def __getitem__(self, key):
+        table, row = self._row(key)
+        if table is None:
+            raise KeyError(key)
+        return table.alleles(row)
+
+    def __len__(self):
+        return sum(len(table) for table in self.chroms.values())
+
+    def __iter__(self):
+        for chrom, table in self.chroms.items():
+            for pos in table.positions:
+                yield chrom, str(pos)
+
+
+class ReferenceCatalog:
+    """Read-only memory-mapped reference catalog"""
+
+    def __init__(self, catalog_path):
+        self.path = catalog_path
+        with open(catalog_path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, header_len = PREAMBLE.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{catalog_path} is not a CheckRef reference catalog")
+        self.meta = json.loads(self._mm[PREAMBLE.size:PREAMBLE.size + header_len])
+        if self.meta['version'] != CATALOG_VERSION:
+            raise ValueError(f"{catalog_path} has catalog version {self.meta['version']}, expected {CATALOG_VERSION}")
+        self._data = memoryview(self._mm)[align8(PREAMBLE.size + header_len):]
+
+    def source_for(self, legend_file, log=print):
+        """Return source metadata for a legend if the catalog is still valid for it, else None"""
+        name = os.path.basename(legend_file)
+        source = next((s for s in self.meta['sources'] if s['file'] == name), None)
+        if source is None:
+            log(f"Reference catalog has no entry for {name}")
+            return None
+        stat = os.stat(legend_file)
+        if stat.st_size == source['size'] and stat.st_mtime == source['mtime']:
+            return source
+        # Size/mtime differ (e.g. the legend was copied); only the checksum is authoritative
+        if stat.st_size == source['size'] and file_sha256(legend_file) == source['sha256']:
+            return source
+        log(f"Reference catalog entry for {name} is stale (checksum no longer matches)")
+        return None
+
+    def chrom(self, chrom):
+        return CatalogChrom(chrom, self.meta['chroms'][chrom], self._data)
+
+    def iter_records(self, source):
+        """Yield (chrom, original_chrom, pos, ref, alt) in position order, like iter_legend_records"""
+        for chrom_name in source['chroms']:
+            chrom = self.chrom(chrom_name)
+            original_chrom = chrom.original_chrom
+            extra = chrom.extra
+            pairs = chrom.pairs
+            # Walk the sorted non-SNP rows in lockstep instead of searching per row
+            next_extra = 0
+            for row, pos in enumerate(chrom.positions):
+                if next_extra < len(extra) and extra.rows[next_extra] == row:
+                    ref, alt = extra[row]
+                    next_extra += 1
+                else:
+                    pair = pairs[row]
+                    ref, alt = CODE_BASES[pair // NUM_CODES], CODE_BASES[pair % NUM_CODES]
+                yield chrom_name, original_chrom, str(pos), ref, alt
+
+def main():
+    parser = argparse.ArgumentParser(description='Compile or inspect a CheckRef reference catalog')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    compile_parser = subparsers.add_parser('compile', help='Compile a reference directory into a catalog')
+    compile_parser.add_argument('reference_dir', help='Directory containing reference legend files')
+    compile_parser.add_argument('catalog', help='Output catalog file')
+    compile_parser.add_argument('--pattern', default='*.legend.gz', help='Legend file pattern (default: *.legend.gz)')
+
+    info_parser = subparsers.add_parser('info', help='Print catalog metadata')
+    info_parser.add_argument('catalog', help='Catalog file')
+
+    chrom_parser = subparsers.add_parser('chrom', help='Print the original chromosome name of a legend')
+    chrom_parser.add_argument('catalog', help='Catalog file')
+    chrom_parser.add_argument('legend_file', help='Legend file compiled into the catalog')
+
+    args = parser.parse_args()
+
+    if args.command == 'compile':
+        compile_catalog(args.reference_dir, args.catalog, args.pattern)
+    elif args.command == 'info':
+        catalog = ReferenceCatalog(args.catalog)
+        print(f"Catalog: {args.catalog} (version {catalog.meta['version']}, created {catalog.meta['created']})")
+        for source in catalog.meta['sources']:
+            print(f"{source['file']}: build={source['build']} sha256={source['sha256']}")
+            for chrom in source['chroms']:
+                meta = catalog.meta['chroms'][chrom]
+                print(f"  {meta['original']}: {meta['count']:,} sites")
+    else:
+        catalog = ReferenceCatalog(args.catalog)
+        # stdout carries only the chromosome name (captured by EXTRACT_LEGEND_INFO)
+        source = catalog.source_for(args.legend_file, log=lambda msg: print(msg, file=sys.stderr))
+        if source is None or not source['chroms']:
+            sys.exit(1)
+        sys.stdout.write(catalog.meta['chroms'][source['chroms'][0]]['original'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+Content-addressed result cache for CheckRef.
+
+A check's outputs depend only on the bytes of the target and the reference,
+the checker code and a couple of options, so check_allele_switch.py
+--cache-dir keys its results on exactly those: the SHA-256 of both inputs,
+a digest of the checker sources (any code change starts a fresh key space),
+whether the reference is a legend, and the region checked. A hit copies the
+switch results, extracted legend (+ .tbi) and metrics out of the cache
+without loading the reference or reading the target past its header.
+
+Input checksums come from the profile sidecar when there is one; otherwise
+they are computed once and remembered in the cache, keyed by path, size and
+mtime, as profile sidecars are. Entries are built in tmp/ and renamed into
+place, so readers never see a partial entry. Every hit refreshes an entry,
+and the least recently used entries are evicted once the cache outgrows its
+size limit. Unlike Nextflow's -resume, the cache outlives the run directory.
+
+Usage:
+    result_cache.py list <cache_dir>
+    result_cache.py evict <cache_dir> --max-size SIZE
+    result_cache.py clear <cache_dir>
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+
+import profile_input
+from check_service import parse_size
+from reference_catalog import file_sha256
+
+CACHE_VERSION = 1
+DEFAULT_MAX_SIZE = '50G'
+ENTRY_FILE = "entry.json"
+DIGESTS_FILE = "digests.json"
+# Modules whose code decides what a check writes, with any engine
+CHECKER_MODULES = ("check_allele_switch.py", "vcf_reader.py", "bgzf.py", "tabix_index.py", "shards.py",
+                   "variant_table.py", "reference_catalog.py", "metrics.py")
+ENTRY_OUTPUTS = {"results": "results.tsv", "legend": "extracted.legend.gz", "legend_index": "extracted.legend.gz.tbi"}
+
+
+def checker_version():
+    """Digest of the checker sources, so results of other code never match"""
+    digest = hashlib.sha256()
+    bin_dir = os.path.dirname(os.path.abspath(__file__))
+    for name in CHECKER_MODULES:
+        with open(os.path.join(bin_dir, name), 'rb') as f:
+            digest.update(name.encode() + b'\0' + f.read())
+    return digest.hexdigest()[:16]
+
+
+def write_json(path, data):
+    """Write JSON atomically"""
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, 'w') as out:
+        json.dump(data, out, indent=2)
+        out.write("\n")
+    os.replace(tmp_path, path)
+
+
+class ResultCache:
+    """On-disk cache of check outputs, addressed by the checksums of the inputs"""
+
+    def __init__(self, root, max_size=parse_size(DEFAULT_MAX_SIZE)):
+        self.root = root
+        self.max_size = max_size
+        self.entries_dir = os.path.join(root, "entries")
+        self.tmp_dir = os.path.join(root, "tmp")
+        os.makedirs(self.entries_dir, exist_ok=True)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def _entry_dir(self, key):
+        return os.path.join(self.entries_dir, key[:2], key)
+
+    def file_digest(self, path, kind=None):
+        """SHA-256 of a file, from its profile sidecar or the cache's digest memo when they still match it"""
+        profile = profile_input.cached_profile(path, kind)
+        if profile is not None:
+            return profile["sha256"]
+        stat = os.stat(path)
+        memo_path = os.path.join(self.root, DIGESTS_FILE)
+        try:
+            with open(memo_path) as f:
+                memo = json.load(f)
+        except (OSError, ValueError):
+            memo = {}
+        real_path = os.path.realpath(path)
+        known = memo.get(real_path)
+        if known and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns:
+            return known["sha256"]
+        print(f"Computing SHA-256 of {path} for the result cache...")
+        sha256 = file_sha256(path)
+        # Drop files that are gone, so the memo does not grow without bound
+        memo = {name: entry for name, entry in memo.items() if os.path.exists(name)}
+        memo[real_path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha256}
+        write_json(memo_path, memo)
+        return sha256
+
+    def key(self, target_vcf, reference_file, use_legend=False, region=None):
+        """Return (key, components) for a check of target_vcf against reference_file"""
+        components = {
+            "cache_version": CACHE_VERSION,
+            "checker": checker_version(),
+            "target_sha256": self.file_digest(target_vcf, 'vcf'),
+            "reference_sha256": self.file_digest(reference_file, 'legend' if use_legend else 'vcf'),
+            "legend": bool(use_legend),
+            "region": region,
+        }
+        key = hashlib.sha256(json.dumps(components, sort_keys=True).encode()).hexdigest()
+        return key, components
+
+    def restore(self, key, output_file, ref_panel_file):
+        """Copy a cached result into place; returns its metrics record, or None on a miss"""
+        entry_dir = self._entry_dir(key)
+        try:
+            with open(os.path.join(entry_dir, "metrics.json")) as f:
+                record = json.load(f)
+            shutil.copyfile(os.path.join(entry_dir, ENTRY_OUTPUTS["results"]), output_file)
+            shutil.copyfile(os.path.join(entry_dir, ENTRY_OUTPUTS["legend"]), ref_panel_file)
+            shutil.copyfile(os.path.join(entry_dir, ENTRY_OUTPUTS["legend_index"]), f"{ref_panel_file}.tbi")
+            # Most recently used first when evicting
+            os.utime(os.path.join(entry_dir, ENTRY_FILE))
+        except (OSError, ValueError):
+            # Missing, or evicted while it was being read
+            return None
+        return record
+
+    def store(self, key, components, output_file, ref_panel_file, record):
+        """Publish the outputs of a check under key, then evict down to the size limit"""
+        if not os.path.exists(f"{ref_panel_file}.tbi"):
+            # The check fell back to a plain-text legend; only complete BGZF results are cached
+            return False
+        entry_dir = self._entry_dir(key)
+        if os.path.exists(entry_dir):
+            return True
+        staging = os.path.join(self.tmp_dir, f"{key}.{os.getpid()}")
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        try:
+            shutil.copyfile(output_file, os.path.join(staging, ENTRY_OUTPUTS["results"]))
+            shutil.copyfile(ref_panel_file, os.path.join(staging, ENTRY_OUTPUTS["legend"]))
+            shutil.copyfile(f"{ref_panel_file}.tbi", os.path.join(staging, ENTRY_OUTPUTS["legend_index"]))
+            write_json(os.path.join(staging, "metrics.json"), record)
+            size = sum(os.path.getsize(os.path.join(staging, name)) for name in os.listdir(staging))
+            write_json(os.path.join(staging, ENTRY_FILE), dict(components, key=key, bytes=size, created=time.time()))
+            os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+            # The rename publishes the whole entry at once; if another run got there first, keep theirs
+            os.rename(staging, entry_dir)
+        except OSError:
+            shutil.rmtree(staging, ignore_errors=True)
+            return os.path.exists(entry_dir)
+        self.evict()
+        return True
+
+    def entries(self):
+        """Entry metadata, least recently used first"""
+        entries = []
+        for prefix in os.listdir(self.entries_dir):
+            prefix_dir = os.path.join(self.entries_dir, prefix)
+            for key in os.listdir(prefix_dir):
+                entry_path = os.path.join(prefix_dir, key, ENTRY_FILE)
+                try:
+                    with open(entry_path) as f:
+                        entry = json.load(f)
+                    entry["used"] = os.path.getmtime(entry_path)
+                except (OSError, ValueError):
+                    continue
+                entries.append(entry)
+        return sorted(entries, key=lambda entry: entry["used"])
+
+    def remove(self, key):
+        """Remove an entry; it is renamed out of entries/ first, so readers see it whole or not at all"""
+        doomed = os.path.join(self.tmp_dir, f"evict.{key}.{os.getpid()}")
+        try:
+            os.rename(self._entry_dir(key), doomed)
+        except OSError:
+            return
+        shutil.rmtree(doomed, ignore_errors=True)
+
+    def evict(self, max_size=None):
+        """Remove least recently used entries until the cache fits max_size; returns the entries removed"""
+        max_size = self.max_size if max_size is None else max_size
+        entries = self.entries()
+        total = sum(entry["bytes"] for entry in entries)
+        removed = []
+        for entry in entries:
+            if total <= max_size:
+                break
+            self.remove(entry["key"])
+            total -= entry["bytes"]
+            removed.append(entry)
+        return removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect and trim a CheckRef result cache')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    list_parser = subparsers.add_parser('list', help='List cached results, least recently used first')
+    list_parser.add_argument('cache_dir', help='Result cache directory')
+
+    evict_parser = subparsers.add_parser('evict', help='Evict least recently used results down to a size')
+    evict_parser.add_argument('cache_dir', help='Result cache directory')
+    evict_parser.add_argument('--max-size', default=DEFAULT_MAX_SIZE,
+                              help=f'Size to trim the cache to, e.g. 500M or 20G (default: {DEFAULT_MAX_SIZE})')
+
+    clear_parser = subparsers.add_parser('clear', help='Remove every cached result')
+    clear_parser.add_argument('cache_dir', help='Result cache directory')
+
+    args = parser.parse_args()
+
+    try:
+        cache = ResultCache(args.cache_dir)
+        if args.command == 'list':
+            entries = cache.entries()
+            for entry in entries:
+                used = time.strftime('%Y-%m-%d %H:%M', time.localtime(entry["used"]))
+                print(f"{entry['key'][:16]}  {entry['bytes'] / 1e6:8.1f} MB  last used {used}  "
+                      f"target {entry['target_sha256'][:12]}  reference {entry['reference_sha256'][:12]}"
+                      f"{'  region ' + str(entry['region']) if entry['region'] else ''}")
+            print(f"{len(entries)} cached results, {sum(e['bytes'] for e in entries) / 1e6:.1f} MB")
+        elif args.command == 'evict':
+            removed = cache.evict(parse_size(args.max_size))
+            print(f"Evicted {len(removed)} cached results ({sum(e['bytes'] for e in removed) / 1e6:.1f} MB)")
+        else:
+            removed = cache.evict(0)
+            print(f"Removed {len(removed)} cached results")
+    except (OSError, ValueError) as e:
+        print(f"ERROR: {e}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
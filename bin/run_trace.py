@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+Run tracing and profiling for CheckRef.
+
+With a trace active (check_allele_switch.py --trace FILE) the checker times
+each phase of a run in wall and CPU seconds, counts the records and
+decompressed bytes each phase reads, and samples its resident set size from
+a background thread. The trace is one JSON file: a per-phase summary with
+records/s and MB/s rates, plus the same run as Trace Event Format events
+(traceEvents) that chrome://tracing and Perfetto open directly, one track
+per thread. CPU time is process-wide, so phases running side by side in
+different threads each include the other's. With no trace active every hook
+is a cheap no-op, so the hooks stay in the hot path.
+
+Profiler adds opt-in hot-loop analysis on top: cProfile call statistics,
+or a low-overhead sampling profiler writing folded stacks for flame graphs.
+Both see the main process only, not BGZF worker processes.
+"""
+
+import contextlib
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+TRACE_SCHEMA = "checkref-trace"
+TRACE_VERSION = 1
+RSS_INTERVAL = 0.2     # seconds between RSS samples
+STACK_INTERVAL = 0.005  # seconds between stack samples of the sampling profiler
+MB = 1 << 20
+
+_tracer = None  # active Tracer, if any
+
+
+def cpu_seconds():
+    """User + system CPU time of this process and its reaped children (BGZF workers)"""
+    return sum(os.times()[:4])
+
+
+def current_rss():
+    """Resident set size of this process in bytes, or None where /proc is unavailable"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def peak_rss():
+    """Peak resident set size in bytes: (this process, largest reaped child), or (None, None)"""
+    if resource is None:
+        return None, None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+
+def peak_rss_mb():
+    """Peak resident set size of the run so far in MB (the largest of this process and any child)"""
+    own, children = peak_rss()
+    if own is None:
+        return None
+    return round(max(own, children) / MB, 1)
+
+
+class Tracer:
+    """Collect phase timings, counters and RSS samples of one run"""
+
+    def __init__(self, rss_interval=RSS_INTERVAL):
+        self.rss_interval = rss_interval
+        self.counters = Counter()
+        self.events = []          # finished phases, in the order they ended
+        self.rss_samples = []     # (seconds since start, bytes)
+        self._open = []           # open phases of every thread
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._main_stack = self._stack()
+        self._start_wall = time.perf_counter()
+        self._start_cpu = cpu_seconds()
+        self._end_wall = None
+        self._end_cpu = None
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample_rss, name='trace-rss', daemon=True)
+
+    def _stack(self):
+        """Open phases of the calling thread, innermost last"""
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _now(self):
+        return time.perf_counter() - self._start_wall
+
+    def _sample_rss(self):
+        while True:
+            rss = current_rss()
+            if rss is not None:
+                self.rss_samples.append((self._now(), rss))
+                for phase in list(self._open):
+                    phase["peak_rss"] = max(phase["peak_rss"], rss)
+            if self._stop.wait(self.rss_interval):
+                break
+
+    def start(self):
+        self._sampler.start()
+
+    def stop(self):
+        if self._end_wall is not None:
+            return
+        self._stop.set()
+        self._sampler.join()
+        self._end_wall = self._now()
+        self._end_cpu = cpu_seconds() - self._start_cpu
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        rss = current_rss() or 0
+        thread = threading.current_thread()
+        phase = {"name": name, "start": self._now(), "cpu": cpu_seconds(), "peak_rss": rss, "counters": Counter(),
+                 "tid": thread.native_id, "thread": thread.name}
+        stack = self._stack()
+        stack.append(phase)
+        self._open.append(phase)
+        try:
+            yield
+        finally:
+            stack.pop()
+            self._open.remove(phase)
+            phase["wall_seconds"] = self._now() - phase["start"]
+            phase["cpu_seconds"] = cpu_seconds() - phase["cpu"]
+            phase["peak_rss"] = max(phase["peak_rss"], current_rss() or 0)
+            self.events.append(phase)
+
+    def count(self, name, n):
+        # Counts belong to the innermost phase of the thread, which sets their rate; producer threads
+        # without a phase of their own count towards the phase the main thread is in
+        stack = self._stack() or self._main_stack
+        with self._lock:
+            self.counters[name] += n
+            if stack:
+                stack[-1]["counters"][name] += n
+
+    def summary(self):
+        """Per-phase totals (phases entered several times are added up), in first-entered order"""
+        phases = {}
+        for event in sorted(self.events, key=lambda e: e["start"]):
+            phase = phases.setdefault(event["name"], {"name": event["name"], "calls": 0, "wall_seconds": 0.0,
+                                                      "cpu_seconds": 0.0, "peak_rss_mb": 0.0,
+                                                      "counters": Counter()})
+            phase["calls"] += 1
+            phase["wall_seconds"] += event["wall_seconds"]
+            phase["cpu_seconds"] += event["cpu_seconds"]
+            phase["peak_rss_mb"] = max(phase["peak_rss_mb"], round(event["peak_rss"] / MB, 1))
+            phase["counters"].update(event["counters"])
+        for phase in phases.values():
+            phase["rates"] = rates(phase["counters"], phase["wall_seconds"])
+            phase["counters"] = dict(phase["counters"])
+            phase["wall_seconds"] = round(phase["wall_seconds"], 4)
+            phase["cpu_seconds"] = round(phase["cpu_seconds"], 4)
+        return list(phases.values())
+
+    def trace_events(self):
+        """The run in Trace Event Format: one complete event per phase, RSS as a counter track"""
+        pid = os.getpid()
+        events = [{"name": "process_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": "check_allele_switch"}}]
+        threads = {event["tid"]: event["thread"] for event in self.events}
+        for tid, thread in threads.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": thread}})
+        for event in self.events:
+            events.append({"name": event["name"], "cat": "phase", "ph": "X", "pid": pid, "tid": event["tid"],
+                           "ts": round(event["start"] * 1e6), "dur": round(event["wall_seconds"] * 1e6),
+                           "args": {"cpu_seconds": round(event["cpu_seconds"], 4),
+                                    "peak_rss_mb": round(event["peak_rss"] / MB, 1),
+                                    **event["counters"]}})
+        for seconds, rss in self.rss_samples:
+            events.append({"name": "rss", "ph": "C", "pid": pid, "tid": 0, "ts": round(seconds * 1e6),
+                           "args": {"rss_mb": round(rss / MB, 1)}})
+        return events
+
+    def to_dict(self, argv=None):
+        own, children = peak_rss()
+        wall = self._end_wall if self._end_wall is not None else self._now()
+        return {
+            "schema": TRACE_SCHEMA,
+            "version": TRACE_VERSION,
+            "command": list(sys.argv if argv is None else argv),
+            "wall_seconds": round(wall, 4),
+            "cpu_seconds": round(self._end_cpu if self._end_cpu is not None else cpu_seconds() - self._start_cpu, 4),
+            "peak_rss_mb": None if own is None else round(own / MB, 1),
+            "children_peak_rss_mb": None if children is None else round(children / MB, 1),
+            "counters": dict(self.counters),
+            "rates": rates(self.counters, wall),
+            "phases": self.summary(),
+            "displayTimeUnit": "ms",
+            "traceEvents": self.trace_events(),
+        }
+
+    def write(self, path, argv=None):
+        """Write the trace as JSON (atomically, like metrics records)"""
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        with open(tmp_path, 'w') as out:
+            json.dump(self.to_dict(argv), out, indent=1)
+            out.write("\n")
+        os.replace(tmp_path, path)
+
+
+def rates(counters, seconds):
+    """Per-second rates of counters over a duration; bytes as MB/s, everything else per second"""
+    if seconds <= 0:
+        return {}
+    result = {}
+    for name, value in counters.items():
+        if name.startswith("bytes_"):
+            result[f"{name[len('bytes_'):]}_mb_per_second"] = round(value / MB / seconds, 2)
+        else:
+            result[f"{name}_per_second"] = round(value / seconds, 1)
+    return result
+
+
+def start(rss_interval=RSS_INTERVAL):
+    """Start tracing this run; the hooks below record into the returned Tracer until stop()"""
+    global _tracer
+    _tracer = Tracer(rss_interval)
+    _tracer.start()
+    return _tracer
+
+
+def stop():
+    """Stop tracing; returns the Tracer (or None if none was active)"""
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is not None:
+        tracer.stop()
+    return tracer
+
+
+def phase(name):
+    """Context manager timing a phase of the active trace (a no-op without one)"""
+    if _tracer is None:
+        return contextlib.nullcontext()
+    return _tracer.phase(name)
+
+
+def count(name, n=1):
+    """Add n to a counter of the active trace, e.g. target_records or bytes_decompressed"""
+    if _tracer is not None:
+        _tracer.count(name, n)
+
+
+class Profiler:
+    """Opt-in hot-loop profiler: 'cprofile' (deterministic call statistics) or 'sample' (folded stacks)
+
+    cprofile writes pstats data (python -m pstats FILE, snakeviz), or a text
+    report sorted by cumulative time when FILE ends in .txt. sample counts
+    the main thread's call stacks every few milliseconds and writes them in
+    folded form (flamegraph.pl, speedscope, inferno) at a few percent of the
+    overhead of cProfile.
+    """
+
+    def __init__(self, path, mode='cprofile', interval=STACK_INTERVAL):
+        self.path = path
+        self.mode = mode
+        self.interval = interval
+        self._profile = None
+        self._stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.mode == 'cprofile':
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+            return
+        main_id = threading.main_thread().ident
+        self._thread = threading.Thread(target=self._sample, args=(main_id,), name='profile-sampler', daemon=True)
+        self._thread.start()
+
+    def _sample(self, thread_id):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self._stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        """Stop profiling and write the profile"""
+        if self._profile is not None:
+            self._profile.disable()
+            if self.path.endswith('.txt'):
+                report = io.StringIO()
+                pstats.Stats(self._profile, stream=report).sort_stats('cumulative').print_stats(50)
+                with open(self.path, 'w') as out:
+                    out.write(report.getvalue())
+            else:
+                self._profile.dump_stats(self.path)
+            self._profile = None
+        elif self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            with open(self.path, 'w') as out:
+                for stack, samples in self._stacks.most_common():
+                    out.write(f"{stack} {samples}\n")
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+Region sharding for CheckRef.
+
+A large chromosome can be checked as several shards, each reading only its
+slice of the target VCF and of the legend (through their .tbi when there is
+one). check_allele_switch.py --shard I/N plans the shards from the position
+checkpoints the input profile records every 10,000 records, so each shard
+holds about the same number of target records; without a profile the
+target's .tbi linear index (compressed bytes per 16 kb window) stands in.
+merge joins the shard outputs, in shard order, into the files a single
+check_allele_switch.py run writes.
+
+Usage:
+    shards.py plan <target.vcf.gz> --shards N
+    shards.py merge <target.vcf.gz> <reference_file> <output_file> <shard_dir>... [--metrics FILE]
+"""
+
+import argparse
+import bisect
+import glob
+import gzip
+import os
+import sys
+
+import bgzf
+import metrics
+import profile_input
+import tabix_index
+
+MAX_POSITION = 1 << 29  # largest coordinate a .tbi can index
+SHARD_DIR_FILES = ("_allele_switch_results.tsv", "_allele_switch_metrics.json", "_extracted.legend.gz")
+
+
+def parse_region(text):
+    """Parse CHROM, CHROM:START, CHROM:START- or CHROM:START-END (1-based, inclusive) into (chrom, start, end)"""
+    chrom, _, span = text.strip().partition(':')
+    if not chrom:
+        raise ValueError(f"region {text!r} has no chromosome")
+    if not span:
+        return chrom, 1, None
+    first, dash, last = span.replace(',', '').partition('-')
+    try:
+        start = int(first) if first else 1
+        end = int(last) if last else (None if dash else start)
+    except ValueError:
+        raise ValueError(f"region {text!r} is not CHROM:START-END") from None
+    if start < 1:
+        raise ValueError(f"region {text!r} starts before position 1")
+    return chrom, start, end
+
+
+def format_region(region):
+    chrom, start, end = region
+    return f"{chrom}:{start}-{'' if end is None else end}"
+
+
+def parse_shard(text):
+    """Parse I/N into (shard, count)"""
+    try:
+        shard, count = (int(part) for part in text.split('/'))
+    except ValueError:
+        raise ValueError(f"shard {text!r} is not I/N") from None
+    if not 1 <= shard <= count:
+        raise ValueError(f"shard {text!r} is out of range")
+    return shard, count
+
+
+def in_region(region, chrom, pos):
+    """True if a site (chrom without 'chr' prefix, position text) lies in the region"""
+    region_chrom, start, end = region
+    if chrom != region_chrom.lstrip('chr'):
+        return False
+    pos = int(pos)
+    return start <= pos and (end is None or pos <= end)
+
+
+def filter_records(records, region):
+    """Pass through the (chrom, original_chrom, pos, ref, alt) records that lie in the region"""
+    for record in records:
+        if in_region(region, record[0], record[2]):
+            yield record
+
+
+def fetch_records(path, index_path, region, parse_line):
+    """Yield parse_line(line) records in the region of a BGZF file, reading only the blocks its .tbi points at
+
+    index_path should come from tabix_index.current_index(), so a stale .tbi is never followed.
+    """
+    chrom, start, end = region
+    if end is not None and end < start:
+        return
+    index = tabix_index.TabixIndex(index_path)
+    name = next((name for name in index.names if name.lstrip('chr') == chrom.lstrip('chr')), None)
+    if name is None:
+        return
+    with bgzf.BgzfReader(path) as reader:
+        for line in index.fetch(reader, name, start - 1, MAX_POSITION if end is None else end):
+            record = parse_line(line)
+            # The index returns records overlapping the region; a shard owns the ones starting in it
+            if record is not None and in_region(region, record[0], record[2]):
+                yield record
+
+
+def plan_regions(chrom, points, total, count):
+    """Split a contig into count regions of about equal weight
+
+    points are (position, weight before that position) in position order,
+    e.g. profile checkpoints with record counts. Regions are contiguous,
+    start at position 1 and leave the last one open-ended; a region is
+    empty (start > end) when there are too few points to split further.
+    """
+    positions = [pos for pos, _ in points]
+    weights = [weight for _, weight in points]
+    bounds = []
+    for k in range(1, count):
+        i = min(bisect.bisect_left(weights, total * k / count), len(points) - 1)
+        # Never split at the first point: the first region always reaches position 1
+        bound = positions[max(i, 1)] if len(points) > 1 else MAX_POSITION
+        bounds.append(max(bound, bounds[-1] if bounds else 1))
+    starts = [1] + bounds
+    ends = [bound - 1 for bound in bounds] + [None]
+    return [(chrom, start, end) for start, end in zip(starts, ends)]
+
+
+def shard_region(target_vcf, shard, count):
+    """Region of shard I of N for a single-chromosome target, planned from its profile or .tbi"""
+    profile = profile_input.cached_profile(target_vcf, 'vcf')
+    if profile is not None:
+        contigs = profile["contigs"]
+        if len(contigs) != 1:
+            raise ValueError(f"{target_vcf} holds {len(contigs)} contigs; --shard splits a single-chromosome VCF, "
+                             f"use --region for others")
+        contig = contigs[0]
+        if contig.get("checkpoints"):
+            points = [(pos, i * profile_input.CHECKPOINT_INTERVAL) for i, pos in enumerate(contig["checkpoints"])]
+            return plan_regions(contig["name"], points, contig["records"], count)[shard - 1]
+
+    index_path = tabix_index.current_index(target_vcf)
+    if index_path is None:
+        raise ValueError(f"planning shards needs the profile (profile_input.py profile) or an up-to-date .tbi "
+                         f"of {target_vcf}")
+    index = tabix_index.TabixIndex(index_path)
+    if len(index.names) != 1:
+        raise ValueError(f"{target_vcf} holds {len(index.names)} contigs; --shard splits a single-chromosome VCF, "
+                         f"use --region for others")
+    # Compressed bytes per 16 kb window stand in for record counts
+    offsets = [voffset >> 16 for voffset in index.linear_offsets(index.names[0])]
+    if not offsets:
+        return (index.names[0], 1, None) if shard == 1 else (index.names[0], 1, 0)
+    points = [((window << tabix_index.MIN_SHIFT) + 1, offset - offsets[0]) for window, offset in enumerate(offsets)]
+    return plan_regions(index.names[0], points, offsets[-1] - offsets[0] + 1, count)[shard - 1]
+
+
+def shard_files(shard_dir):
+    """(results, metrics, extracted legend) written by one shard's check"""
+    files = []
+    for suffix in SHARD_DIR_FILES:
+        matches = glob.glob(os.path.join(shard_dir, f"*{suffix}"))
+        if len(matches) != 1:
+            raise ValueError(f"{shard_dir} should hold one *{suffix} file, found {len(matches)}")
+        files.append(matches[0])
+    return files
+
+
+def shard_order(shard_dirs, records):
+    """Indices of the shards in genomic order of the regions their metrics record
+
+    Raises ValueError if a region is missing or the non-empty regions overlap,
+    as they do for shards of different plans.
+    """
+    regions = []
+    for shard_dir, record in zip(shard_dirs, records):
+        if not record.get("region"):
+            raise ValueError(f"the metrics in {shard_dir} record no region; was it checked with --shard?")
+        regions.append(parse_region(record["region"]))
+    order = sorted(range(len(regions)),
+                   key=lambda i: (regions[i][1], MAX_POSITION if regions[i][2] is None else regions[i][2]))
+    previous = None
+    for i in order:
+        chrom, start, end = regions[i]
+        if end is not None and end < start:
+            continue
+        if previous is not None and (chrom != previous[0] or previous[2] is None or start <= previous[2]):
+            raise ValueError(f"shard regions {format_region(previous)} and {format_region(regions[i])} "
+                             f"do not come from one shard plan")
+        previous = regions[i]
+    return order
+
+
+def merge_shards(target_vcf, reference_file, output_file, shard_dirs, metrics_file=None,
+                 level=bgzf.DEFAULT_LEVEL, threads=1):
+    """Merge shard outputs, in the genomic order of their regions, into one run's results, legend and metrics"""
+    from check_allele_switch import (ALLELE_STATUSES, ExtractedLegendWriter, extracted_legend_name,
+                                     print_results_summary)
+
+    mismatched = [d for d in shard_dirs if os.path.exists(os.path.join(d, 'BUILD_MISMATCH_DETECTED'))]
+    if mismatched:
+        print(f"Genome build mismatch detected in {len(mismatched)} shard(s); nothing to merge")
+        with open(output_file, 'w') as f:
+            f.write("CHROM\tPOS\tALLELE_SWITCH\n")
+            f.write("# No results - genome build mismatch detected\n")
+        with open('BUILD_MISMATCH_DETECTED', 'w') as f:
+            f.write("Build mismatch detected - workflow should terminate\n")
+        return None
+
+    shards = [shard_files(d) for d in shard_dirs]
+    records = [metrics.read_metrics(metrics_path) for _, metrics_path, _ in shards]
+    # Directory names need not sort numerically (shard_10 before shard_2); the regions decide
+    order = shard_order(shard_dirs, records)
+    shards = [shards[i] for i in order]
+    records = [records[i] for i in order]
+
+    with open(output_file, 'w') as out:
+        out.write("CHROM\tPOS\tALLELE_SWITCH\n")
+        for results_path, _, _ in shards:
+            with open(results_path) as f:
+                next(f, None)
+                for line in f:
+                    out.write(line)
+
+    # Shards cover consecutive regions, so their legends concatenate in genomic order
+    ref_panel_file = extracted_legend_name(reference_file)
+    with ExtractedLegendWriter(ref_panel_file, level, threads) as ref_out:
+        for _, _, legend_path in shards:
+            with gzip.open(legend_path, 'rt') as f:
+                next(f, None)
+                for line in f:
+                    cols = line.rstrip('\n').split('\t')
+                    ref_out.add(cols[1], cols[2], cols[3], cols[4])
+
+    totals = {"target": 0, "reference": 0, "common": 0}
+    counts = {status: 0 for status in ALLELE_STATUSES}
+    chroms = []
+    for i, record in enumerate(records, 1):
+        for key in totals:
+            totals[key] += record["totals"][key]
+        for status in counts:
+            counts[status] += record["counts"].get(status, 0)
+        chroms.extend(chrom for chrom in record["chroms"] if chrom not in chroms)
+        print(f"Shard {i}/{len(records)} {record.get('region', '')}: {record['totals']['target']} target variants, "
+              f"{record['totals']['common']} common, {record['counts'].get('SWITCH', 0)} switched")
+
+    print(f"Merged {len(shards)} shards")
+    print(f"Successfully created reference legend file: {ref_panel_file}")
+    print(f"Wrote {ref_out.count:,} reference variants at compared positions")
+    print_results_summary(output_file, ref_panel_file, totals["target"], totals["reference"], totals["common"], counts)
+
+    record = metrics.build_record(target_vcf, reference_file, records[0]["mode"] if records else 'memory', chroms,
+                                  totals["target"], totals["reference"], totals["common"], counts)
+    record["shards"] = [shard.get("region", "") for shard in records]
+    for key in ("target_sha256", "reference_sha256"):
+        digests = {shard.get(key) for shard in records}
+        if len(digests) == 1 and None not in digests:
+            record[key] = digests.pop()
+    # Shards run side by side: wall time is the slowest shard, CPU time adds up
+    timings = [shard.get("timings") or {} for shard in records]
+    if all(timings):
+        record["timings"] = {"wall_seconds": max(t["wall_seconds"] for t in timings),
+                             "cpu_seconds": round(sum(t["cpu_seconds"] for t in timings), 3)}
+        if all(t.get("peak_rss_mb") is not None for t in timings):
+            record["timings"]["peak_rss_mb"] = max(t["peak_rss_mb"] for t in timings)
+    if metrics_file:
+        metrics.write_metrics(metrics_file, record)
+    return record
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Plan and merge region shards of an allele switch check')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    plan_parser = subparsers.add_parser('plan', help='Print the regions of a balanced shard plan')
+    plan_parser.add_argument('target_vcf', help='Single-chromosome target VCF (with a profile or .tbi)')
+    plan_parser.add_argument('--shards', type=int, required=True, help='Number of shards')
+
+    merge_parser = subparsers.add_parser('merge', help='Merge shard outputs into one result set')
+    merge_parser.add_argument('target_vcf', help='Target VCF the shards were cut from')
+    merge_parser.add_argument('reference_file', help='Reference legend the shards were checked against')
+    merge_parser.add_argument('output_file', help='Merged allele switch results file')
+    merge_parser.add_argument('shard_dirs', nargs='+', help='One directory of check outputs per shard')
+    merge_parser.add_argument('--metrics', metavar='FILE', help='Write the merged metrics record (JSON or .tsv)')
+    merge_parser.add_argument('--threads', type=int, default=1, help='Threads for compressing the merged legend')
+    merge_parser.add_argument('--compress-level', type=int, choices=range(10), default=bgzf.DEFAULT_LEVEL,
+                              metavar='0-9', help=f'Deflate level for the merged legend (default: {bgzf.DEFAULT_LEVEL})')
+
+    args = parser.parse_args()
+
+    try:
+        if args.command == 'plan':
+            if args.shards < 1:
+                parser.error("--shards must be at least 1")
+            for shard in range(1, args.shards + 1):
+                print(f"{shard}/{args.shards}\t{format_region(shard_region(args.target_vcf, shard, args.shards))}")
+        else:
+            merge_shards(args.target_vcf, args.reference_file, args.output_file, args.shard_dirs, args.metrics,
+                         args.compress_level, max(1, args.threads))
+    except (OSError, ValueError) as e:
+        print(f"ERROR: {e}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
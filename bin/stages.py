@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Overlapping pipeline stages for CheckRef.
+
+A check reads the target and the reference, classifies the shared sites and
+writes its outputs. Run one after another, the CPU idles while a stage waits
+on storage (slow on network filesystems) and the disks idle while it
+computes. prefetch() moves reading, inflating and tokenizing an input into a
+producer thread that runs ahead of its consumer in batches through a bounded
+queue: when the consumer falls behind, the producer blocks, so memory stays
+bounded. start_background() runs a whole stage, e.g. loading the reference,
+alongside the main thread. Python parsing holds the GIL, but file reads,
+zlib and the BGZF worker processes do not, so stages overlap where a run
+spends most of its time waiting.
+"""
+
+import queue
+import threading
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+BATCH_SIZE = 4096  # items handed over per queue operation
+QUEUE_DEPTH = 8    # batches a producer may run ahead of its consumer
+PUT_TIMEOUT = 0.1  # seconds between checks for a consumer that stopped early
+
+_DONE = object()
+
+
+class _Failure:
+    """An exception raised by a producer, re-raised in its consumer"""
+
+    def __init__(self, error):
+        self.error = error
+
+
+def prefetch(items, batch_size=BATCH_SIZE, depth=QUEUE_DEPTH, name='prefetch'):
+    """Yield the items of an iterable, in order, produced by a background thread a bounded number of batches ahead
+
+    Exceptions raised while producing (including SystemExit) are re-raised
+    in the consumer. A consumer that stops early stops the producer, which
+    closes items if it is a generator.
+    """
+    batches = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(batch):
+        while not stop.is_set():
+            try:
+                batches.put(batch, timeout=PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        iterator = iter(items)
+        try:
+            batch = []
+            for item in iterator:
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    if not put(batch):
+                        return
+                    batch = []
+            if batch and not put(batch):
+                return
+            put(_DONE)
+        except BaseException as e:
+            put(_Failure(e))
+        finally:
+            # Generators are closed so their cleanup runs in this thread; files stay open for their owner
+            if isinstance(iterator, types.GeneratorType):
+                iterator.close()
+
+    thread = threading.Thread(target=produce, name=name, daemon=True)
+    thread.start()
+    try:
+        while True:
+            batch = batches.get()
+            if batch is _DONE:
+                return
+            if isinstance(batch, _Failure):
+                raise batch.error
+            yield from batch
+    finally:
+        stop.set()
+        thread.join()
+
+
+def start_background(fn, *args, **kwargs):
+    """Start fn(*args, **kwargs) in a background thread; returns a Future whose result() waits for it"""
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='stage')
+    future = executor.submit(fn, *args, **kwargs)
+    # The worker thread exits once fn returns
+    executor.shutdown(wait=False)
+    return future
+
+
+def split_threads(threads):
+    """Worker counts (first, second) for two inputs read at the same time, sharing threads between them"""
+    second = max(1, threads // 2)
+    return max(1, threads - second), second
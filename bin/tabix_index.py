@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""
+Tabix (.tbi) index construction for CheckRef.
+
+Builds the same binning and linear index that `tabix` / `bcftools index --tbi`
+write, from the virtual offsets recorded while a file is being written with
+bgzf.BgzfWriter. This lets the checker emit an indexed VCF in the same pass
+that produces it. Existing indexes can be loaded to fetch only the records
+overlapping a region, or copied with their offsets remapped after some
+blocks of the indexed file were rewritten.
+"""
+
+import gzip
+import os
+import struct
+
+import bgzf
+
+TBI_MAGIC = b'TBI\x01'
+MIN_SHIFT = 14
+PSEUDO_BIN = 37450
+
+# (format, col_seq, col_beg, col_end, meta char, lines to skip), as in `tabix -p vcf`
+VCF_PRESET = (2, 1, 2, 0, '#', 0)
+# Reference legends (ID CHROM POS REF ALT), as in `tabix -s2 -b3 -e3 -S1`
+LEGEND_PRESET = (0, 2, 3, 3, '#', 1)
+
+
+def find_index(path):
+    """Path of the .tbi for a file, next to it or next to the file a symlink points at; None if there is none"""
+    for candidate in (path, os.path.realpath(path)):
+        if os.path.exists(f"{candidate}.tbi"):
+            return f"{candidate}.tbi"
+    return None
+
+
+def current_index(path):
+    """find_index() of a file, unless the .tbi is older than the file and may point at blocks that moved"""
+    index_path = find_index(path)
+    if index_path is None or os.path.getmtime(index_path) < os.path.getmtime(path):
+        return None
+    return index_path
+
+
+def reg2bin(beg, end):
+    """UCSC/htslib bin of a 0-based half-open interval"""
+    end -= 1
+    if beg >> 14 == end >> 14:
+        return ((1 << 15) - 1) // 7 + (beg >> 14)
+    if beg >> 17 == end >> 17:
+        return ((1 << 12) - 1) // 7 + (beg >> 17)
+    if beg >> 20 == end >> 20:
+        return ((1 << 9) - 1) // 7 + (beg >> 20)
+    if beg >> 23 == end >> 23:
+        return ((1 << 6) - 1) // 7 + (beg >> 23)
+    if beg >> 26 == end >> 26:
+        return ((1 << 3) - 1) // 7 + (beg >> 26)
+    return 0
+
+
+def reg2bins(beg, end):
+    """All bins that may hold records overlapping a 0-based half-open interval"""
+    end -= 1
+    bins = [0]
+    for shift, first_bin in ((26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)):
+        bins.extend(range(first_bin + (beg >> shift), first_bin + (end >> shift) + 1))
+    return bins
+
+
+def vcf_span(pos, ref, info):
+    """0-based half-open interval covered by a VCF record (bytes fields)"""
+    beg = int(pos) - 1
+    end = beg + len(ref)
+    if b'END=' in info:
+        for entry in info.split(b';'):
+            if entry.startswith(b'END='):
+                end = max(end, int(entry[4:]))
+                break
+    return beg, max(end, beg + 1)
+
+
+class _RefIndex:
+    """Bins, linear index and record counts of one sequence"""
+
+    def __init__(self, vstart):
+        self.bins = {}
+        self.linear = []
+        self.mapped = 0
+        self.off_beg = vstart
+        self.off_end = vstart
+        self.last_beg = -1
+
+
+class TabixIndexBuilder:
+    """Accumulate (sequence, interval, virtual offsets) of sorted records and write a .tbi"""
+
+    def __init__(self, preset=VCF_PRESET):
+        self.preset = preset
+        self.names = []
+        self._refs = {}
+        self._current = None
+
+    def add(self, name, beg, end, vstart, vend):
+        ref = self._current
+        if ref is None or name != self.names[-1]:
+            if name in self._refs:
+                raise ValueError(f"records for {name} are not contiguous")
+            ref = self._current = self._refs[name] = _RefIndex(vstart)
+            self.names.append(name)
+        if beg < ref.last_beg:
+            raise ValueError(f"{name}:{beg + 1} is out of order")
+        ref.last_beg = beg
+
+        chunks = ref.bins.setdefault(reg2bin(beg, end), [])
+        if chunks and chunks[-1][1] == vstart:
+            chunks[-1][1] = vend
+        else:
+            chunks.append([vstart, vend])
+
+        linear = ref.linear
+        last_window = (end - 1) >> MIN_SHIFT
+        if len(linear) <= last_window:
+            linear.extend([None] * (last_window + 1 - len(linear)))
+        for window in range(beg >> MIN_SHIFT, last_window + 1):
+            if linear[window] is None:
+                linear[window] = vstart
+        ref.mapped += 1
+        ref.off_end = vend
+
+    def write(self, index_path, resolve=None):
+        """Write the index; resolve maps recorded offsets to real ones (BgzfWriter.resolve with threads)"""
+        if resolve is not None:
+            self._resolve(resolve)
+        fmt, col_seq, col_beg, col_end, meta, skip = self.preset
+        names = b''.join(name.encode() + b'\0' for name in self.names)
+        with bgzf.BgzfWriter(index_path) as out:
+            out.write(TBI_MAGIC + struct.pack('<8i', len(self.names), fmt, col_seq, col_beg, col_end,
+                                              ord(meta), skip, len(names)) + names)
+            for name in self.names:
+                ref = self._refs[name]
+                parts = [struct.pack('<i', len(ref.bins) + 1)]
+                for bin_no in sorted(ref.bins):
+                    chunks = ref.bins[bin_no]
+                    parts.append(struct.pack('<Ii', bin_no, len(chunks)))
+                    parts.extend(struct.pack('<QQ', vstart, vend) for vstart, vend in chunks)
+                # htslib's pseudo-bin: file span and mapped/unmapped counts of the sequence
+                parts.append(struct.pack('<IiQQQQ', PSEUDO_BIN, 2, ref.off_beg, ref.off_end, ref.mapped, 0))
+                # Windows without records point at the previous record start, as htslib fills them
+                linear = []
+                previous = 0
+                for offset in ref.linear:
+                    previous = offset if offset is not None else previous
+                    linear.append(previous)
+                parts.append(struct.pack(f'<i{len(linear)}Q', len(linear), *linear))
+                out.write(b''.join(parts))
+            out.write(struct.pack('<Q', 0))
+
+    def _resolve(self, resolve):
+        for ref in self._refs.values():
+            ref.bins = {bin_no: [[resolve(vstart), resolve(vend)] for vstart, vend in chunks]
+                        for bin_no, chunks in ref.bins.items()}
+            ref.linear = [None if offset is None else resolve(offset) for offset in ref.linear]
+            ref.off_beg = resolve(ref.off_beg)
+            ref.off_end = resolve(ref.off_end)
+
+
+def remap_index(index_path, out_path, remap, removed=None):
+    """Copy a .tbi with every virtual offset passed through remap, for a file whose blocks were rewritten
+
+    removed maps sequence names to the number of records dropped from them,
+    which comes off the mapped-record counts; chunks left empty are dropped.
+    """
+    removed = removed or {}
+    with gzip.open(index_path, 'rb') as f:
+        data = f.read()
+    if data[:4] != TBI_MAGIC:
+        raise ValueError(f"{index_path} is not a tabix index")
+    n_ref, names_len = struct.unpack_from('<i', data, 4)[0], struct.unpack_from('<i', data, 32)[0]
+    offset = 36 + names_len
+    names = [name.decode() for name in data[36:offset].split(b'\0')[:n_ref]]
+    parts = [data[:offset]]
+    for name in names:
+        n_bin = struct.unpack_from('<i', data, offset)[0]
+        offset += 4
+        bins = []
+        for _ in range(n_bin):
+            bin_no, n_chunk = struct.unpack_from('<Ii', data, offset)
+            offset += 8
+            chunks = struct.unpack_from(f'<{2 * n_chunk}Q', data, offset)
+            offset += 16 * n_chunk
+            if bin_no == PSEUDO_BIN:
+                off_beg, off_end, mapped, unmapped = chunks
+                bins.append(struct.pack('<IiQQQQ', PSEUDO_BIN, 2, remap(off_beg), remap(off_end),
+                                        max(0, mapped - removed.get(name, 0)), unmapped))
+                continue
+            pairs = [(remap(vstart), remap(vend)) for vstart, vend in zip(chunks[::2], chunks[1::2])]
+            pairs = [pair for pair in pairs if pair[0] < pair[1]]
+            if pairs:
+                bins.append(struct.pack('<Ii', bin_no, len(pairs)) +
+                            b''.join(struct.pack('<QQ', vstart, vend) for vstart, vend in pairs))
+        n_intv = struct.unpack_from('<i', data, offset)[0]
+        offset += 4
+        linear = [remap(voffset) for voffset in struct.unpack_from(f'<{n_intv}Q', data, offset)]
+        offset += 8 * n_intv
+        parts.append(struct.pack('<i', len(bins)))
+        parts.extend(bins)
+        parts.append(struct.pack(f'<i{n_intv}Q', n_intv, *linear))
+    # Trailing count of records without coordinates, when present
+    parts.append(data[offset:])
+    with bgzf.BgzfWriter(out_path) as out:
+        out.write(b''.join(parts))
+
+
+class TabixIndex:
+    """A loaded .tbi index"""
+
+    def __init__(self, index_path):
+        with gzip.open(index_path, 'rb') as f:
+            data = f.read()
+        if data[:4] != TBI_MAGIC:
+            raise ValueError(f"{index_path} is not a tabix index")
+        n_ref, fmt, col_seq, col_beg, col_end, meta, skip, names_len = struct.unpack_from('<8i', data, 4)
+        self.preset = (fmt, col_seq, col_beg, col_end, chr(meta), skip)
+        offset = 36
+        self.names = [name.decode() for name in data[offset:offset + names_len].split(b'\0')[:n_ref]]
+        offset += names_len
+        self._bins = {}
+        self._linear = {}
+        for name in self.names:
+            n_bin = struct.unpack_from('<i', data, offset)[0]
+            offset += 4
+            bins = {}
+            for _ in range(n_bin):
+                bin_no, n_chunk = struct.unpack_from('<Ii', data, offset)
+                offset += 8
+                chunks = struct.unpack_from(f'<{2 * n_chunk}Q', data, offset)
+                offset += 16 * n_chunk
+                if bin_no != PSEUDO_BIN:
+                    bins[bin_no] = list(zip(chunks[::2], chunks[1::2]))
+            n_intv = struct.unpack_from('<i', data, offset)[0]
+            offset += 4
+            self._linear[name] = struct.unpack_from(f'<{n_intv}Q', data, offset)
+            offset += 8 * n_intv
+            self._bins[name] = bins
+
+    def linear_offsets(self, name):
+        """Virtual offset of the first record in each 16 kb window of a sequence (empty if not indexed)"""
+        return self._linear.get(name, ())
+
+    def chunks(self, name, beg, end):
+        """Merged (start, end) virtual-offset chunks that may hold records overlapping [beg, end)"""
+        bins = self._bins.get(name)
+        if bins is None:
+            return []
+        linear = self._linear[name]
+        min_offset = linear[min(beg >> MIN_SHIFT, len(linear) - 1)] if linear else 0
+        chunks = sorted(chunk for bin_no in reg2bins(beg, end) for chunk in bins.get(bin_no, ())
+                        if chunk[1] > min_offset)
+        merged = []
+        for start, stop in chunks:
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], stop)
+            else:
+                merged.append([start, stop])
+        return merged
+
+    def fetch(self, reader, name, beg, end):
+        """Yield lines (bytes) of a bgzf.BgzfReader that overlap [beg, end) on sequence name"""
+        for _, _, line in self.fetch_spans(reader, name, beg, end):
+            yield line
+
+    def fetch_spans(self, reader, name, beg, end):
+        """Like fetch, but yield (vstart, vend, line) with the virtual offsets around each line"""
+        fmt, col_seq, col_beg, col_end, meta, _ = self.preset
+        meta = meta.encode()
+        for start, stop in self.chunks(name, beg, end):
+            reader.seek(start)
+            while reader.tell() < stop:
+                vstart = reader.tell()
+                line = reader.readline()
+                if not line:
+                    break
+                if line.startswith(meta):
+                    continue
+                fields = line.rstrip(b'\r\n').split(b'\t')
+                if fields[col_seq - 1].decode() != name:
+                    break
+                if fmt & 0xffff == VCF_PRESET[0]:
+                    rec_beg, rec_end = vcf_span(fields[1], fields[3], fields[7] if len(fields) > 7 else b'')
+                else:
+                    rec_beg = int(fields[col_beg - 1]) - 1
+                    rec_end = int(fields[col_end - 1]) if col_end else rec_beg + 1
+                if rec_beg >= end:
+                    break
+                if rec_end > beg:
+                    yield vstart, reader.tell(), line
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Columnar variant tables for CheckRef.
+
+Variants are stored per chromosome as sorted int32 positions plus one uint8
+code per site packing the REF/ALT pair (5 allele codes: A, C, G, T, other).
+Target and reference tables are joined with searchsorted and classified
+through a precomputed status lookup table over whole arrays at once.
+Alleles that do not fit a single-base code keep their original strings in
+a small per-chromosome side table and are classified exactly.
+"""
+
+from array import array
+
+try:
+    import numpy as np
+except ImportError:  # allele-code helpers stay usable without NumPy
+    np = None
+
+# Single-base allele codes; everything else (indels, N, '.') is OTHER_CODE
+ALLELE_CODES = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
+OTHER_CODE = 4
+NUM_CODES = 5
+CODE_BASES = 'ACGT'
+
+# Status codes, in the order of check_allele_switch.ALLELE_STATUSES
+STATUS_CODES = {"MATCH": 0, "SWITCH": 1, "COMPLEMENT": 2, "COMPLEMENT_SWITCH": 3, "OTHER": 4}
+
+
+def pack_pair(ref, alt):
+    """Pack a REF/ALT allele pair into a single code (0..24)"""
+    return ALLELE_CODES.get(ref, OTHER_CODE) * NUM_CODES + ALLELE_CODES.get(alt, OTHER_CODE)
+
+
+def build_status_table(classify):
+    """Precompute the status of every (target pair, reference pair) combination"""
+    # Placeholder strings for OTHER never compare equal or complementary to anything;
+    # sites carrying them are re-classified exactly from their original alleles.
+    target_bases = list(CODE_BASES) + ['<target>']
+    ref_bases = list(CODE_BASES) + ['<reference>']
+    table = np.empty(NUM_CODES ** 4, dtype=np.uint8)
+    for target_pair in range(NUM_CODES ** 2):
+        target_ref = target_bases[target_pair // NUM_CODES]
+        target_alt = target_bases[target_pair % NUM_CODES]
+        for ref_pair in range(NUM_CODES ** 2):
+            ref_ref = ref_bases[ref_pair // NUM_CODES]
+            ref_alt = ref_bases[ref_pair % NUM_CODES]
+            status = classify(target_ref, target_alt, ref_ref, ref_alt)
+            table[target_pair * NUM_CODES ** 2 + ref_pair] = STATUS_CODES[status]
+    return table
+
+
+class ChromTable:
+    """Sorted, de-duplicated sites of one chromosome"""
+
+    def __init__(self, original_chrom, positions, pairs, extra):
+        self.original_chrom = original_chrom
+        self.positions = positions  # int32, ascending, unique
+        self.pairs = pairs          # uint8 packed REF/ALT codes
+        self.extra = extra          # row -> (ref, alt) for pairs containing OTHER_CODE
+
+    def __len__(self):
+        return len(self.positions)
+
+    def alleles(self, row):
+        """Return the (ref, alt) strings of a row"""
+        if row in self.extra:
+            return self.extra[row]
+        pair = int(self.pairs[row])
+        return CODE_BASES[pair // NUM_CODES], CODE_BASES[pair % NUM_CODES]
+
+    @property
+    def nbytes(self):
+        return self.positions.nbytes + self.pairs.nbytes
+
+
+class VariantTableBuilder:
+    """Accumulate parsed records into compact per-chromosome columns"""
+
+    def __init__(self):
+        self._positions = {}
+        self._pairs = {}
+        self._extra = {}
+        self.original_chroms = {}
+
+    def add(self, chrom, original_chrom, pos, ref, alt):
+        positions = self._positions.get(chrom)
+        if positions is None:
+            positions = self._positions[chrom] = array('i')
+            self._pairs[chrom] = array('B')
+            self._extra[chrom] = {}
+        pair = pack_pair(ref, alt)
+        if pair // NUM_CODES == OTHER_CODE or pair % NUM_CODES == OTHER_CODE:
+            self._extra[chrom][len(positions)] = (ref, alt)
+        positions.append(int(pos))
+        self._pairs[chrom].append(pair)
+        self.original_chroms[chrom] = original_chrom
+
+    def build(self):
+        """Sort each chromosome by position, keeping the last record at repeated positions"""
+        tables = {}
+        for chrom, raw_positions in self._positions.items():
+            positions = np.frombuffer(raw_positions, dtype=np.int32)
+            pairs = np.frombuffer(self._pairs[chrom], dtype=np.uint8)
+            order = np.argsort(positions, kind='stable')
+            sorted_positions = positions[order]
+            # Last of each run of equal positions wins, matching dict-assignment semantics
+            keep = np.ones(len(order), dtype=bool)
+            keep[:-1] = sorted_positions[1:] != sorted_positions[:-1]
+            order = order[keep]
+
+            extra = {}
+            raw_extra = self._extra[chrom]
+            if raw_extra:
+                new_rows = np.full(len(positions), -1, dtype=np.int64)
+                new_rows[order] = np.arange(len(order))
+                for old_row, alleles in raw_extra.items():
+                    new_row = int(new_rows[old_row])
+                    if new_row >= 0:
+                        extra[new_row] = alleles
+
+            tables[chrom] = ChromTable(self.original_chroms[chrom], positions[order].copy(),
+                                       pairs[order].copy(), extra)
+        return tables
+
+
+def table_from_catalog(chrom):
+    """Wrap a mapped reference_catalog chromosome as a ChromTable without copying"""
+    return ChromTable(chrom.original_chrom, np.frombuffer(chrom.positions, dtype=np.int32),
+                      np.frombuffer(chrom.pairs, dtype=np.uint8), chrom.extra)
+
+
+def build_tables(records):
+    """Build per-chromosome tables from (chrom, original_chrom, pos, ref, alt) records"""
+    builder = VariantTableBuilder()
+    add = builder.add
+    for record in records:
+        add(*record)
+    return builder.build()
+
+
+def join_sites(target, reference):
+    """Return row indices (target_rows, ref_rows) of positions present in both tables"""
+    idx = np.searchsorted(reference.positions, target.positions)
+    in_range = idx < len(reference.positions)
+    hits = np.zeros(len(target.positions), dtype=bool)
+    hits[in_range] = reference.positions[idx[in_range]] == target.positions[in_range]
+    target_rows = np.nonzero(hits)[0]
+    return target_rows, idx[target_rows]
+
+
+def classify_sites(target, reference, target_rows, ref_rows, status_table, classify):
+    """Vectorized status codes for joined rows, with exact handling of OTHER alleles"""
+    combined = target.pairs[target_rows].astype(np.uint16) * (NUM_CODES ** 2) + reference.pairs[ref_rows]
+    statuses = status_table[combined]
+
+    if target.extra or reference.extra:
+        for i in np.nonzero((target.pairs[target_rows] // NUM_CODES == OTHER_CODE) |
+                            (target.pairs[target_rows] % NUM_CODES == OTHER_CODE) |
+                            (reference.pairs[ref_rows] // NUM_CODES == OTHER_CODE) |
+                            (reference.pairs[ref_rows] % NUM_CODES == OTHER_CODE))[0]:
+            target_ref, target_alt = target.alleles(int(target_rows[i]))
+            ref_ref, ref_alt = reference.alleles(int(ref_rows[i]))
+            statuses[i] = STATUS_CODES[classify(target_ref, target_alt, ref_ref, ref_alt)]
+    return statuses
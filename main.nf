@@ -49,6 +49,17 @@ params.targetVcfs = null
 params.referenceDir = null
 params.legendPattern = "*.legend.gz"
 params.fixMethod = "remove" // 'remove' or 'correct'
+params.referenceCatalog = null // compiled with bin/reference_catalog.py compile
+params.checkEngine = "memory" // 'memory', 'streaming' (needs position-sorted inputs) or 'columnar' (needs numpy)
+params.vcfReader = "native" // 'native' (in-process) or 'bcftools'
+params.compressLevel = 6 // deflate level (0-9) for the BGZF extracted legend and corrected VCF
+params.verifySample = 1000 // untouched sites re-checked by VERIFY_CORRECTIONS besides the switched ones
+params.shardRecords = 0 // target records per CHECK_SHARD task for indexed single-chromosome VCFs; 0 disables sharding
+params.traceChecks = false // write a per-phase time/RSS trace of each check to ${params.logs}/traces
+params.resultCache = null // directory of check results reused for identical target/reference pairs across runs
+params.resultCacheSize = "50G" // least recently used results are evicted beyond this size
+params.preflight = true // sample each target/legend pair and stop on a build, chromosome or strand mismatch before checking
+params.preflightSites = 2000 // target SNPs sampled by PREFLIGHT
 params.help = false
 
 // Output directories (set by Cloudgene or default to subdirectories)
@@ -75,10 +86,79 @@ def helpMessage() {
       --legendPattern       Pattern to match legend files (default: '*.legend.gz')
       --outputDir           Output directory (default: 'results')
       --fixMethod           Method to fix allele switches: 'remove' or 'correct' (default: 'remove')
+      --referenceCatalog    Reference catalog compiled with bin/reference_catalog.py (default: none)
+      --checkEngine         Allele comparison engine: 'memory', 'streaming' or 'columnar' (default: 'memory')
+      --vcfReader           How target VCFs are read: 'native' or 'bcftools' (default: 'native')
+      --compressLevel       Deflate level for BGZF outputs, 0-9 (default: 6)
+      --verifySample        Untouched sites re-checked during verification (default: 1000)
+      --shardRecords        Target records per region shard of an indexed VCF; 0 disables sharding (default: 0)
+      --traceChecks         Write a per-phase time/RSS trace of each check (default: false)
+      --resultCache         Directory caching check results across runs, keyed by input checksums (default: none)
+      --resultCacheSize     Size limit of the result cache, e.g. 500M or 50G (default: 50G)
+      --preflight           Sample each target/legend pair and fail fast on a mismatch (default: true)
+      --preflightSites      Target SNPs sampled by the preflight (default: 2000)
       --help                Display this help message
     """.stripIndent()
 }
 
+// Number of region shards to check a target in: more than one only when sharding is enabled, the
+// target is an indexed single-chromosome VCF and its profile counts more records than one shard holds
+def shardCount(index, profile) {
+    if (!params.shardRecords || params.shardRecords <= 0 || !index) {
+        return 1
+    }
+    def info = new groovy.json.JsonSlurper().parse(profile.toFile())
+    if (info.contigs.size() != 1) {
+        return 1
+    }
+    return Math.max(1, Math.ceil(info.records.total / params.shardRecords) as int)
+}
+
+// Stop the run on failed preflight reports, with the structured error of the first failure
+def preflightFailure(failed) {
+    def reportPath = "${params.logs}/preflight/preflight_failure_report.txt"
+    def lines = failed.collect { "  - ${it.target} vs ${it.reference}: ${it.code} -- ${it.reason}" }
+    def errorMsg = """
+================================================================================
+  PREFLIGHT FAILED -- a sample of your VCF does not fit the reference panel
+================================================================================
+
+${lines.join('\n')}
+
+No allele switch check was started. Per-pair sample estimates: ${params.logs}/preflight/
+"""
+    file("${params.logs}/preflight").mkdirs()
+    file(reportPath).text = errorMsg
+
+    def first = failed[0]
+    def remediation
+    if (first.code == "CHROMOSOME_MISMATCH") {
+        remediation = [
+            kind: "select_panel",
+            hint: "Pick a reference panel whose chromosomes cover ${first.contigs.target.join(', ')}.",
+        ]
+    } else if (first.code == "STRAND_MISMATCH") {
+        remediation = [
+            kind: "retry",
+            hint: "Align your VCF to the forward strand of the reference (e.g. bcftools +fixref), then resubmit.",
+        ]
+    } else {
+        remediation = [
+            kind: "run_workflow",
+            workflow_slug: "vcf-liftover",
+            hint: "Run VCF Liftover on your VCF to the reference panel's build, then resubmit.",
+        ]
+    }
+    emitStructuredError([
+        code: first.code,
+        severity: "user_error",
+        summary: "PREFLIGHT FAILED -- ${first.reason}",
+        detail: errorMsg.trim(),
+        remediation: remediation,
+        report_path: reportPath,
+    ], errorMsg)
+}
+
 // Function to extract chromosome from filename
 def extractChromosome(filename) {
     def chrPatterns = [
@@ -108,10 +188,10 @@ process VALIDATE_VCF_FILES {
     container 'mamana/vcf-processing:latest'
     
     input:
-    tuple val(chr), path(vcf_file)
+    tuple val(chr), path(vcf_file), val(vcf_index), path(vcf_profile)
     
     output:
-    tuple val(chr), path(vcf_file), path("${chr}_validation_status.txt"), emit: validation_results
+    tuple val(chr), path(vcf_file), val(vcf_index), path(vcf_profile), path("${chr}_validation_status.txt"), emit: validation_results
     path "${chr}_validation_report.txt", emit: validation_reports
     
     script:
@@ -149,30 +229,30 @@ process VALIDATE_VCF_FILES {
         exit 0
     fi
     
-    # Check if file is gzipped properly
-    if [[ "${vcf_file}" == *.gz ]]; then
-        if ! gunzip -t "${vcf_file}" 2>/dev/null; then
+    # Integrity, format and record counts come from the single-scan profile written by EXTRACT_VCF_INFO
+    PROFILE="python3 ${projectDir}/bin/profile_input.py get ${vcf_profile}"
+    VERDICT=\$(\$PROFILE verdict)
+    PROBLEMS=\$(\$PROFILE problems)
+
+    if [ "\$VERDICT" != "PASSED" ]; then
+        if echo "\$PROBLEMS" | grep -q "gzip"; then
             echo "❌ VALIDATION FAILED: Gzipped file is corrupted" >> ${chr}_validation_report.txt
             echo "The gzip compression is damaged or incomplete." >> ${chr}_validation_report.txt
             echo "Please recompress the file or obtain a new copy." >> ${chr}_validation_report.txt
-            echo "FAILED" > ${chr}_validation_status.txt
-            exit 0
+        else
+            echo "❌ VALIDATION FAILED: Invalid VCF format or corrupted file" >> ${chr}_validation_report.txt
+            echo "The file could not be read as VCF. This indicates:" >> ${chr}_validation_report.txt
+            echo "  - File corruption" >> ${chr}_validation_report.txt
+            echo "  - Invalid VCF format" >> ${chr}_validation_report.txt
+            echo "  - Incompatible file type" >> ${chr}_validation_report.txt
         fi
-    fi
-    
-    # Use bcftools to validate VCF format
-    if ! bcftools view -h "${vcf_file}" >/dev/null 2>&1; then
-        echo "❌ VALIDATION FAILED: Invalid VCF format or corrupted file" >> ${chr}_validation_report.txt
-        echo "bcftools cannot read this file. This indicates:" >> ${chr}_validation_report.txt
-        echo "  - File corruption" >> ${chr}_validation_report.txt
-        echo "  - Invalid VCF format" >> ${chr}_validation_report.txt
-        echo "  - Incompatible file type" >> ${chr}_validation_report.txt
+        echo "Details: \$PROBLEMS" >> ${chr}_validation_report.txt
         echo "FAILED" > ${chr}_validation_status.txt
         exit 0
     fi
     
     # Check if file contains variant data
-    DATA_LINES=\$(bcftools view -H "${vcf_file}" 2>/dev/null | wc -l || echo 0)
+    DATA_LINES=\$(\$PROFILE records.total)
     echo "Data lines found: \${DATA_LINES}" >> ${chr}_validation_report.txt
     
     if [ "\$DATA_LINES" -eq 0 ]; then
@@ -185,43 +265,133 @@ process VALIDATE_VCF_FILES {
     # If we get here, basic validation passed
     echo "✅ VALIDATION PASSED: File appears to be valid" >> ${chr}_validation_report.txt
     echo "File format: Valid VCF" >> ${chr}_validation_report.txt
-    echo "Compression: \$(file "${vcf_file}" | cut -d: -f2)" >> ${chr}_validation_report.txt
+    echo "Compression: \$(\$PROFILE compression)" >> ${chr}_validation_report.txt
+    echo "Position-sorted: \$(\$PROFILE sorted)" >> ${chr}_validation_report.txt
+    echo "SHA-256: \$(\$PROFILE sha256)" >> ${chr}_validation_report.txt
     echo "Status: Ready for processing" >> ${chr}_validation_report.txt
     echo "PASSED" > ${chr}_validation_status.txt
     """
 }
 
+// Process to compare a sample of each target with its legend before any full check is scheduled
+process PREFLIGHT {
+    publishDir "${params.logs}/preflight", mode: 'copy', pattern: "*_preflight.json"
+    tag "${chr}:${target_vcf.simpleName}"
+
+    input:
+    tuple val(chr), path(target_vcf), path(target_profile), path(reference_legend)
+
+    output:
+    path "${prefix}_preflight.json", emit: report
+
+    script:
+    prefix = "${chr}_${target_vcf.simpleName}"
+    """
+    TARGET_VCF=\$(readlink -f ${target_vcf})
+    REFERENCE_LEGEND=\$(readlink -f ${reference_legend})
+
+    # Exit status 5: the sample shows a mismatch. The report still goes to the workflow, which stops the run
+    STATUS=0
+    python3 ${projectDir}/bin/preflight.py \$TARGET_VCF \$REFERENCE_LEGEND --legend --sites ${params.preflightSites} \
+        --json ${prefix}_preflight.json || STATUS=\$?
+    if [ \$STATUS -ne 0 ] && [ \$STATUS -ne 5 ]; then
+        exit \$STATUS
+    fi
+    """
+}
+
 // Process to check allele switches
 process CHECK_ALLELE_SWITCH {
     publishDir "${params.allele_switch_results}", mode: 'copy', pattern: "*_allele_switch_results.tsv"
     publishDir "${params.summary_files}", mode: 'copy', pattern: "*_allele_switch_summary.txt"
-    publishDir "${params.summary_files}", mode: 'copy', pattern: "*.legend.gz"
+    publishDir "${params.summary_files}", mode: 'copy', pattern: "*_allele_switch_metrics.json"
+    publishDir "${params.summary_files}", mode: 'copy', pattern: "*.legend.gz*"
+    publishDir "${params.fixed_vcfs}", mode: 'copy', pattern: "*.{corrected}.vcf.gz*"
+    publishDir "${params.logs}/traces", mode: 'copy', pattern: "*_allele_switch_trace.json"
     tag "${chr}:${target_vcf.simpleName}"
 
     input:
-    tuple val(chr), path(target_vcf), path(reference_legend)
+    tuple val(chr), path(target_vcf), path(target_index), path(target_profile), path(reference_legend)
 
     output:
     tuple val(chr), path(target_vcf), path("${prefix}_allele_switch_results.tsv"), emit: switch_results
     path "${prefix}_allele_switch_summary.txt", emit: summary
+    path "${prefix}_allele_switch_metrics.json", emit: metrics, optional: true
     path "*.legend.gz", emit: ref_legend, optional: true
     path "BUILD_MISMATCH_DETECTED", emit: build_mismatch, optional: true
+    tuple val(chr), path("${prefix}.corrected.vcf.gz"), path("${prefix}.corrected.vcf.gz.tbi"), emit: corrected_vcf, optional: true
+    tuple val(chr), path("${prefix}_allele_switch_results.tsv"), path("*_extracted.legend.gz"), path("*_extracted.legend.gz.tbi"), emit: verify_inputs, optional: true
+    tuple val(chr), path("fixed_count.txt"), path("failed_count.txt"), emit: correction_stats, optional: true
 
     script:
     prefix = "${chr}_${target_vcf.simpleName}"
     report = "${prefix}_allele_switch_results.tsv"
     summary = "${prefix}_allele_switch_summary.txt"
+    catalog_opt = params.referenceCatalog ? "--catalog ${file(params.referenceCatalog)}" : ""
+    trace_opt = params.traceChecks ? "--trace ${prefix}_allele_switch_trace.json" : ""
+    cache_opt = params.resultCache ? "--cache-dir ${file(params.resultCache)} --cache-max-size ${params.resultCacheSize}" : ""
+    // With fixMethod=correct the checker also writes the corrected, indexed VCF in the same pass
+    correct_opt = params.fixMethod == 'correct' ? "--correct-output ${prefix}.corrected.vcf.gz" : ""
     """
-    # Get the absolute paths of input files
-    TARGET_VCF=\$(readlink -f ${target_vcf})
+    # Get the absolute paths of input files; the target stays the staged link, so its staged .tbi
+    # (an explicit input, empty when the target has none) sits next to it on every executor
+    TARGET_VCF=\$PWD/${target_vcf}
     REFERENCE_LEGEND=\$(readlink -f ${reference_legend})
 
     echo "Processing chromosome: ${chr}"
     echo "Using target VCF: \$TARGET_VCF"
     echo "Using reference legend: \$REFERENCE_LEGEND"
 
+    # The profile from EXTRACT_VCF_INFO is staged next to the target, so the checker reads the build
+    # from it; the sorted-only modes can also sort up front instead of failing a first pass
+    SORTED=\$(python3 ${projectDir}/bin/profile_input.py get ${target_profile} sorted || echo true)
+    if [ "\$SORTED" = "false" ] && { [ "${params.checkEngine}" = "streaming" ] || [ -n "${correct_opt}" ]; }; then
+        echo "Target VCF profile shows it is not position-sorted - sorting before the check"
+        bcftools sort \$TARGET_VCF -Oz -o ${prefix}.sorted_input.vcf.gz
+        TARGET_VCF=${prefix}.sorted_input.vcf.gz
+    fi
+
+    # An indexed target is corrected after the check by rewriting only the BGZF blocks that hold
+    # switched sites; otherwise the checker writes the corrected VCF in the same pass
+    CORRECT_OPT="${correct_opt}"
+    if [ -n "\$CORRECT_OPT" ] && [ -f "\$TARGET_VCF.tbi" ]; then
+        CORRECT_OPT=""
+    fi
+
     # Run the allele switch checker (generates extracted legend file)
-    python3 ${projectDir}/bin/check_allele_switch.py \$TARGET_VCF \$REFERENCE_LEGEND ${report} --legend > ${summary}
+    CHECK_OPTS="--legend --engine ${params.checkEngine} --vcf-reader ${params.vcfReader} --threads ${task.cpus} --compress-level ${params.compressLevel} --metrics ${prefix}_allele_switch_metrics.json ${catalog_opt} ${trace_opt} ${cache_opt}"
+    STATUS=0
+    python3 ${projectDir}/bin/check_allele_switch.py \$TARGET_VCF \$REFERENCE_LEGEND ${report} \$CHECK_OPTS \$CORRECT_OPT > ${summary} || STATUS=\$?
+
+    if [ \$STATUS -eq 3 ]; then
+        # Exit status 3: the sorted-only pass found an unsorted target; sort once and rerun
+        echo "Target VCF is not position-sorted - sorting before rerunning the check"
+        bcftools sort \$TARGET_VCF -Oz -o ${prefix}.sorted_input.vcf.gz
+        python3 ${projectDir}/bin/check_allele_switch.py ${prefix}.sorted_input.vcf.gz \$REFERENCE_LEGEND ${report} \$CHECK_OPTS \$CORRECT_OPT > ${summary}
+    elif [ \$STATUS -ne 0 ]; then
+        exit \$STATUS
+    fi
+    rm -f ${prefix}.sorted_input.vcf.gz
+
+    if [ -n "${correct_opt}" ] && [ -z "\$CORRECT_OPT" ] && [ ! -f "BUILD_MISMATCH_DETECTED" ]; then
+        STATUS=0
+        python3 ${projectDir}/bin/fix_switched_sites.py correct \$TARGET_VCF ${report} ${prefix}.corrected.vcf.gz \
+            --compress-level ${params.compressLevel} >> ${summary} || STATUS=\$?
+        if [ \$STATUS -eq 4 ]; then
+            # Exit status 4: the target index is missing or stale; correct in a full pass instead
+            echo "Target VCF index cannot be used for block-copy correction - correcting in a full pass"
+            python3 ${projectDir}/bin/check_allele_switch.py \$TARGET_VCF \$REFERENCE_LEGEND ${report} \$CHECK_OPTS ${correct_opt} > ${summary}
+        elif [ \$STATUS -ne 0 ]; then
+            exit \$STATUS
+        fi
+    fi
+
+    if [ -f "${prefix}.corrected.vcf.gz" ]; then
+        # Report the number of sites corrected and failed
+        grep "Corrected switched sites:" ${summary} | awk '{print \$NF}' > fixed_count.txt
+        grep "Switched sites left uncorrected" ${summary} | awk '{print \$NF}' > failed_count.txt
+        echo "Chromosome ${chr}: Corrected \$(cat fixed_count.txt) sites, Failed \$(cat failed_count.txt) sites"
+    fi
 
     # Check if build mismatch was detected
     if [ -f "BUILD_MISMATCH_DETECTED" ]; then
@@ -247,24 +417,123 @@ process CHECK_ALLELE_SWITCH {
     """
 }
 
+// Process to check one region shard of a large chromosome (see params.shardRecords)
+process CHECK_SHARD {
+    tag "${chr}:${target_vcf.simpleName}:${shard}"
+
+    input:
+    tuple val(chr), path(target_vcf), path(target_index), path(target_profile), path(reference_legend), val(shard)
+
+    output:
+    tuple val(chr), path(target_vcf), path(target_index), path(reference_legend), path("${shard_dir}"), emit: shard
+
+    script:
+    prefix = "${chr}_${target_vcf.simpleName}"
+    shard_dir = "${prefix}_shard_" + shard.toString().tokenize('/')[0].padLeft(4, '0')
+    catalog_opt = params.referenceCatalog ? "--catalog ${file(params.referenceCatalog)}" : ""
+    cache_opt = params.resultCache ? "--cache-dir ${file(params.resultCache)} --cache-max-size ${params.resultCacheSize}" : ""
+    """
+    TARGET_VCF=\$PWD/${target_vcf}
+    REFERENCE_LEGEND=\$(readlink -f ${reference_legend})
+
+    # Every shard plans the same split from the staged profile's checkpoints and reads only
+    # its region of the target through the staged .tbi next to it
+    python3 ${projectDir}/bin/check_allele_switch.py \$TARGET_VCF \$REFERENCE_LEGEND ${prefix}_allele_switch_results.tsv \
+        --legend --engine ${params.checkEngine} --vcf-reader ${params.vcfReader} --threads ${task.cpus} \
+        --compress-level ${params.compressLevel} --metrics ${prefix}_allele_switch_metrics.json ${catalog_opt} \
+        --shard ${shard} ${cache_opt} > ${prefix}_allele_switch_summary.txt
+
+    mkdir ${shard_dir}
+    mv ${prefix}_allele_switch_* ${shard_dir}/
+    for f in *_extracted.legend.gz* BUILD_MISMATCH_DETECTED; do
+        if [ -f "\$f" ]; then mv "\$f" ${shard_dir}/; fi
+    done
+    """
+}
+
+// Process to merge the shards of a chromosome into the outputs CHECK_ALLELE_SWITCH writes
+process MERGE_SHARDS {
+    publishDir "${params.allele_switch_results}", mode: 'copy', pattern: "*_allele_switch_results.tsv"
+    publishDir "${params.summary_files}", mode: 'copy', pattern: "*_allele_switch_summary.txt"
+    publishDir "${params.summary_files}", mode: 'copy', pattern: "*_allele_switch_metrics.json"
+    publishDir "${params.summary_files}", mode: 'copy', pattern: "*.legend.gz*"
+    publishDir "${params.fixed_vcfs}", mode: 'copy', pattern: "*.{corrected}.vcf.gz*"
+    tag "${chr}:${target_vcf.simpleName}"
+
+    input:
+    tuple val(chr), path(target_vcf), path(target_index), path(reference_legend), path(shard_dirs)
+
+    output:
+    tuple val(chr), path(target_vcf), path("${prefix}_allele_switch_results.tsv"), emit: switch_results
+    path "${prefix}_allele_switch_summary.txt", emit: summary
+    path "${prefix}_allele_switch_metrics.json", emit: metrics, optional: true
+    path "*.legend.gz", emit: ref_legend, optional: true
+    path "BUILD_MISMATCH_DETECTED", emit: build_mismatch, optional: true
+    tuple val(chr), path("${prefix}.corrected.vcf.gz"), path("${prefix}.corrected.vcf.gz.tbi"), emit: corrected_vcf, optional: true
+    tuple val(chr), path("${prefix}_allele_switch_results.tsv"), path("*_extracted.legend.gz"), path("*_extracted.legend.gz.tbi"), emit: verify_inputs, optional: true
+    tuple val(chr), path("fixed_count.txt"), path("failed_count.txt"), emit: correction_stats, optional: true
+
+    script:
+    prefix = "${chr}_${target_vcf.simpleName}"
+    report = "${prefix}_allele_switch_results.tsv"
+    summary = "${prefix}_allele_switch_summary.txt"
+    catalog_opt = params.referenceCatalog ? "--catalog ${file(params.referenceCatalog)}" : ""
+    """
+    TARGET_VCF=\$PWD/${target_vcf}
+    REFERENCE_LEGEND=\$(readlink -f ${reference_legend})
+
+    # The merge orders the shards by the regions their metrics record
+    python3 ${projectDir}/bin/shards.py merge \$TARGET_VCF \$REFERENCE_LEGEND ${report} ${shard_dirs} \
+        --metrics ${prefix}_allele_switch_metrics.json --threads ${task.cpus} \
+        --compress-level ${params.compressLevel} > ${summary}
+
+    if [ "${params.fixMethod}" = "correct" ] && [ ! -f "BUILD_MISMATCH_DETECTED" ]; then
+        # Sharded targets are indexed, so the whole target is corrected block by block
+        STATUS=0
+        python3 ${projectDir}/bin/fix_switched_sites.py correct \$TARGET_VCF ${report} ${prefix}.corrected.vcf.gz \
+            --compress-level ${params.compressLevel} >> ${summary} || STATUS=\$?
+        if [ \$STATUS -eq 4 ]; then
+            # Exit status 4: the target index is stale (or unusable); check and correct in one full pass,
+            # which rewrites the merged outputs with the same results
+            echo "Target VCF index cannot be used for block-copy correction - correcting in a full pass"
+            python3 ${projectDir}/bin/check_allele_switch.py \$TARGET_VCF \$REFERENCE_LEGEND ${report} \
+                --legend --vcf-reader ${params.vcfReader} --threads ${task.cpus} \
+                --compress-level ${params.compressLevel} --metrics ${prefix}_allele_switch_metrics.json ${catalog_opt} \
+                --correct-output ${prefix}.corrected.vcf.gz > ${summary}
+        elif [ \$STATUS -ne 0 ]; then
+            exit \$STATUS
+        fi
+        grep "Corrected switched sites:" ${summary} | awk '{print \$NF}' > fixed_count.txt
+        grep "Switched sites left uncorrected" ${summary} | awk '{print \$NF}' > failed_count.txt
+        echo "Chromosome ${chr}: Corrected \$(cat fixed_count.txt) sites, Failed \$(cat failed_count.txt) sites"
+    fi
+
+    if [ -f "BUILD_MISMATCH_DETECTED" ]; then
+        echo "Genome build mismatch detected in a shard of chromosome ${chr} - see ${summary}"
+    fi
+    """
+}
+
 // Process to extract chromosome and build information from VCF data
 process EXTRACT_VCF_INFO {
     tag "${vcf_file.simpleName}"
 
     input:
-    path vcf_file
+    tuple path(vcf_file), val(vcf_index)
 
     output:
-    tuple stdout, path(vcf_file), emit: vcf_info
+    tuple stdout, path(vcf_file), val(vcf_index), path("${vcf_file}.profile.json"), emit: vcf_info
 
     script:
     """
     #!/bin/bash
     set -e
 
-    # Extract first variant line's CHROM field (column 1) using zcat/grep
-    # Disable pipefail temporarily to avoid SIGPIPE error from head
-    CHROM=\$(zcat ${vcf_file} 2>/dev/null | grep -v "^#" | head -1 | cut -f1 | tr -d '\\n' || true)
+    # Profile the VCF in one scan; validation and the checker read this sidecar instead of rescanning
+    python3 ${projectDir}/bin/profile_input.py profile ${vcf_file} --kind vcf >&2
+
+    # CHROM field (column 1) of the first variant line
+    CHROM=\$(python3 ${projectDir}/bin/profile_input.py get ${vcf_file}.profile.json first_chrom || true)
 
     # Check if we got a chromosome value
     if [ -z "\$CHROM" ]; then
@@ -315,12 +584,21 @@ process EXTRACT_LEGEND_INFO {
     tuple stdout, path(legend_file), emit: legend_info
 
     script:
+    def catalog = params.referenceCatalog ? file(params.referenceCatalog) : ""
     """
     #!/bin/bash
     set -e
 
-    # Extract CHROM from legend file (column 2, skip header line)
-    CHROM=\$(zcat ${legend_file} | awk 'NR==2 {print \$2}' | tr -d '\\n' || true)
+    # Read CHROM from the reference catalog when one is configured and still valid
+    CHROM=""
+    if [ -n "${catalog}" ]; then
+        CHROM=\$(python3 ${projectDir}/bin/reference_catalog.py chrom ${catalog} ${legend_file} || true)
+    fi
+
+    # Otherwise extract CHROM from legend file (column 2, skip header line)
+    if [ -z "\$CHROM" ]; then
+        CHROM=\$(zcat ${legend_file} | awk 'NR==2 {print \$2}' | tr -d '\\n' || true)
+    fi
 
     # Check if we got a chromosome value
     if [ -z "\$CHROM" ]; then
@@ -349,11 +627,10 @@ process REMOVE_SWITCHED_SITES {
     tag "${chr}:${target_vcf.simpleName}"
     
     input:
-    tuple val(chr), path(target_vcf), path(switch_results)
+    tuple val(chr), path(target_vcf), path(switch_results), path(target_index)
     
     output:
-    tuple val(chr), path("${prefix}.noswitch.vcf.gz"), emit: fixed_vcf
-    path "${prefix}.noswitch.vcf.gz.tbi", optional: true
+    tuple val(chr), path("${prefix}.noswitch.vcf.gz"), path("${prefix}.noswitch.vcf.gz.tbi"), emit: fixed_vcf
     
     script:
     prefix = "${chr}_${target_vcf.simpleName}"
@@ -364,18 +641,31 @@ process REMOVE_SWITCHED_SITES {
     
     # Check if there are any sites to exclude
     EXCLUDE_COUNT=\$(wc -l < exclude_sites.bed || echo 0)
+    TARGET_VCF=\$PWD/${target_vcf}
     
     if [ \$EXCLUDE_COUNT -eq 0 ] || [ ! -s exclude_sites.bed ]; then
         echo "No sites to exclude for chromosome ${chr} - copying original VCF"
         cp ${target_vcf} ${prefix}.noswitch.vcf.gz
     else
         echo "Found \$EXCLUDE_COUNT sites to exclude for chromosome ${chr}"
-        # Create a fixed VCF by excluding the sites with allele switches
-        bcftools view -T ^exclude_sites.bed ${target_vcf} -Oz -o ${prefix}.noswitch.vcf.gz
+        # An indexed BGZF target only needs the blocks holding switched sites rewritten;
+        # exit status 4 means there is no usable index, so rewrite the whole VCF instead
+        STATUS=0
+        python3 ${projectDir}/bin/fix_switched_sites.py remove \$TARGET_VCF ${switch_results} ${prefix}.noswitch.vcf.gz \
+            --compress-level ${params.compressLevel} || STATUS=\$?
+        if [ \$STATUS -eq 4 ]; then
+            rm -f ${prefix}.noswitch.vcf.gz.tbi
+            # Create a fixed VCF by excluding the sites with allele switches
+            bcftools view -T ^exclude_sites.bed ${target_vcf} -Oz -o ${prefix}.noswitch.vcf.gz
+        elif [ \$STATUS -ne 0 ]; then
+            exit \$STATUS
+        fi
     fi
     
-    # Index the fixed VCF
-    bcftools index --tbi ${prefix}.noswitch.vcf.gz
+    # Index the fixed VCF, unless the block-copy fixer already wrote its index
+    if [ ! -f ${prefix}.noswitch.vcf.gz.tbi ]; then
+        bcftools index --tbi ${prefix}.noswitch.vcf.gz
+    fi
     
     # Count the number of sites removed
     echo "Chromosome ${chr}: Removed \$EXCLUDE_COUNT sites with allele switches"
@@ -385,164 +675,6 @@ process REMOVE_SWITCHED_SITES {
     """
 }
 
-// Process to create a fixed VCF by correcting allele switches
-process CORRECT_SWITCHED_SITES {
-    publishDir "${params.fixed_vcfs}", mode: 'copy', pattern: "*.{corrected}.vcf.gz*"
-    tag "${chr}:${target_vcf.simpleName}"
-    
-    input:
-    tuple val(chr), path(target_vcf), path(switch_results)
-    
-    output:
-    tuple val(chr), path("${prefix}.corrected.vcf.gz"), emit: fixed_vcf
-    path "${prefix}.corrected.vcf.gz.tbi", optional: true
-    tuple val(chr), path("fixed_count.txt"), path("failed_count.txt"), emit: correction_stats
-    
-    script:
-    prefix = "${chr}_${target_vcf.simpleName}"
-    """
-    # Check if there are any sites to fix
-    SITES_COUNT=\$(awk 'NR>1 {print}' ${switch_results} | wc -l || echo 0)
-    
-    if [ \$SITES_COUNT -eq 0 ]; then
-        echo "No sites to correct for chromosome ${chr} - copying original VCF"
-        cp ${target_vcf} ${prefix}.corrected.vcf.gz
-        bcftools index --tbi ${prefix}.corrected.vcf.gz
-        echo "0" > fixed_count.txt
-        echo "0" > failed_count.txt
-        echo "Chromosome ${chr}: Corrected 0 sites with allele switches"
-        exit 0
-    fi
-    
-    # Create a file with just the sites to be fixed
-    awk 'NR>1 {print \$1"\\t"\$2"\\t"\$3}' ${switch_results} > sites_to_fix.txt
-    
-    # Create a Python script to fix the allele switches
-    echo '#!/usr/bin/env python3
-import sys
-import gzip
-import re
-import os
-
-# Load the sites to fix from file
-sites_to_fix = {}
-build_mismatch_count = 0
-with open("sites_to_fix.txt", "r") as f:
-    for line in f:
-        parts = line.strip().split("\\t")
-        if len(parts) >= 3:
-            chrom = parts[0]
-            pos = parts[1]
-            allele_info = parts[2]
-
-            # Parse allele info (format: "REF>ALT|CORRECT_REF>CORRECT_ALT")
-            match = re.match(r"([ACGT])>([ACGT])\\|([ACGT])>([ACGT])", allele_info)
-            if match:
-                vcf_ref, vcf_alt, correct_ref, correct_alt = match.groups()
-                # Only process if we are switching ALT alleles, not REF alleles
-                # REF allele changes indicate genome build mismatches
-                if vcf_ref == correct_alt and vcf_alt == correct_ref:
-                    sites_to_fix[(chrom, pos)] = (vcf_ref, vcf_alt, correct_ref, correct_alt)
-                else:
-                    build_mismatch_count += 1
-                    print(f"WARNING: Skipping position {chrom}:{pos} - REF allele change detected (possible build mismatch)")
-
-print(f"Loaded {len(sites_to_fix)} sites for correction")
-if build_mismatch_count > 0:
-    print(f"WARNING: Skipped {build_mismatch_count} sites due to potential genome build mismatches")
-
-# Process the VCF file
-vcf_file = sys.argv[1]
-output_file = sys.argv[2]
-
-# Determine if file is gzipped
-is_gzipped = vcf_file.endswith(".gz")
-open_func = gzip.open if is_gzipped else open
-mode = "rt" if is_gzipped else "r"
-
-# Determine output format
-out_is_gzipped = output_file.endswith(".gz")
-out_open_func = gzip.open if out_is_gzipped else open
-out_mode = "wt" if out_is_gzipped else "w"
-
-# Read and correct the VCF
-fixed_count = 0
-header_written = False
-contig_written = False
-with open_func(vcf_file, mode) as infile, out_open_func(output_file, out_mode) as outfile:
-    for line in infile:
-        if line.startswith("#"):
-            # Add contig and SWITCHED INFO field declarations before #CHROM line
-            if line.startswith("#CHROM"):
-                if not contig_written:
-                    # Add contig definition for the chromosome if not present
-                    # Get chromosome from first site to fix
-                    for (site_chrom, _) in sites_to_fix.keys():
-                        outfile.write(f"##contig=<ID={site_chrom}>\\n")
-                        break
-                    contig_written = True
-                if not header_written:
-                    outfile.write("##INFO=<ID=SWITCHED,Number=0,Type=Flag,Description=\\"Alleles were switched to match reference\\">\\n")
-                    header_written = True
-            outfile.write(line)
-            continue
-        
-        parts = line.strip().split("\\t")
-        if len(parts) >= 8:  # Ensure VCF has at least 8 columns
-            chrom = parts[0]
-            pos = parts[1]
-            ref = parts[3]
-            alt = parts[4]
-            info = parts[7]
-            
-            # Check if this site needs correction
-            if (chrom, pos) in sites_to_fix:
-                old_ref, old_alt, new_ref, new_alt = sites_to_fix[(chrom, pos)]
-                
-                # Make sure the reference alleles match
-                if ref == old_ref and alt == old_alt:
-                    # Update the alleles
-                    parts[3] = new_ref
-                    parts[4] = new_alt
-                    
-                    # Mark in INFO field
-                    if info == ".":
-                        parts[7] = "SWITCHED=1"
-                    else:
-                        parts[7] += ";SWITCHED=1"
-                    
-                    fixed_count += 1
-            
-            # Write the updated line
-            outfile.write("\\t".join(parts) + "\\n")
-
-# Write the counts to files for reporting
-with open("fixed_count.txt", "w") as f:
-    f.write(str(fixed_count))
-with open("failed_count.txt", "w") as f:
-    f.write(str(build_mismatch_count))
-' > fix_allele_switches.py
-
-    # Make the script executable
-    chmod +x fix_allele_switches.py
-    
-    # Run the script to fix the allele switches
-    python3 fix_allele_switches.py ${target_vcf} ${prefix}.temp.vcf.gz
-    
-    # Sort and index the corrected VCF
-    bcftools sort ${prefix}.temp.vcf.gz -Oz -o ${prefix}.corrected.vcf.gz
-    bcftools index --tbi ${prefix}.corrected.vcf.gz
-    
-    # Report the number of sites corrected and failed
-    CORRECTED=\$(cat fixed_count.txt)
-    FAILED=\$(cat failed_count.txt)
-    echo "Chromosome ${chr}: Corrected \$CORRECTED sites, Failed \$FAILED sites"
-    
-    # Clean up temporary files (but keep the count files for output)
-    rm -f fix_allele_switches.py sites_to_fix.txt ${prefix}.temp.vcf.gz
-    """
-}
-
 // Verify that corrections were successful
 process VERIFY_CORRECTIONS {
     publishDir "${params.logs}/verification", mode: 'copy'
@@ -550,19 +682,22 @@ process VERIFY_CORRECTIONS {
     container 'mamana/vcf-processing:latest'
     
     input:
-    tuple val(chr), path(corrected_vcf), path(legend)
+    tuple val(chr), path(corrected_vcf), path(corrected_index), path(switch_results), path(extracted_legend), path(extracted_legend_index)
     
     output:
     tuple val(chr), path("${chr}_verification_results.txt"), emit: verification_results
     
     script:
     """
-    # Run the allele switch check on the corrected VCF
+    # Re-check only the switched sites plus a random sample of untouched ones: both are read from the
+    # extracted legend through its index and looked up through the index of the fixed VCF
     python3 ${projectDir}/bin/check_allele_switch.py \
         ${corrected_vcf} \
-        ${legend} \
+        ${extracted_legend} \
         ${chr}_verification_allele_switch_results.tsv \
-        --legend
+        --legend \
+        --verify-sites ${switch_results} \
+        --verify-sample ${params.verifySample} > ${chr}_verification.log
     
     # Create a verification summary
     echo "====================================" > ${chr}_verification_results.txt
@@ -584,6 +719,8 @@ process VERIFY_CORRECTIONS {
     
     echo "" >> ${chr}_verification_results.txt
     echo "Total switches found: \$REMAINING_SWITCHES" >> ${chr}_verification_results.txt
+    echo "" >> ${chr}_verification_results.txt
+    sed -n '/^Verification Summary:/,\$p' ${chr}_verification.log >> ${chr}_verification_results.txt
     """
 }
 
@@ -592,111 +729,18 @@ process CREATE_SUMMARY {
     publishDir "${params.summary_files}", mode: 'copy'
     
     input:
-    path summary_files
+    path metrics_files
     
     output:
     path "all_chromosomes_summary.txt"
+    path "all_chromosomes_metrics.json"
     
     script:
     """
-    # Initialize totals
-    TOTAL_TARGET_VARIANTS=0
-    TOTAL_REF_VARIANTS=0
-    TOTAL_COMMON_VARIANTS=0
-    TOTAL_MATCHED=0
-    TOTAL_SWITCHED=0
-    TOTAL_COMPLEMENT=0
-    TOTAL_COMPLEMENT_SWITCH=0
-    TOTAL_OTHER=0
-    
-    echo "====================================" > all_chromosomes_summary.txt
-    echo "ALLELE SWITCH CHECKER SUMMARY" >> all_chromosomes_summary.txt
-    echo "====================================" >> all_chromosomes_summary.txt
-    echo "" >> all_chromosomes_summary.txt
-    echo "Processed files: \$(echo ${summary_files} | wc -w)" >> all_chromosomes_summary.txt
-    echo "" >> all_chromosomes_summary.txt
-    
-    # Process each summary file and extract statistics
-    echo "Individual Chromosome Results:" >> all_chromosomes_summary.txt
-    echo "------------------------------------" >> all_chromosomes_summary.txt
-    
-    for summary in ${summary_files}; do
-        CHR_NAME=\$(basename \$summary | sed 's/_allele_switch_summary.txt//')
-        echo "" >> all_chromosomes_summary.txt
-        echo "Chromosome: \$CHR_NAME" >> all_chromosomes_summary.txt
-        
-        # Extract values from each summary
-        TARGET_VAR=\$(grep "Total variants in target VCF:" \$summary | awk '{print \$NF}')
-        REF_VAR=\$(grep "Total variants in reference:" \$summary | awk '{print \$NF}')
-        COMMON_VAR=\$(grep "Total variants at common positions:" \$summary | awk '{print \$NF}')
-        MATCHED=\$(grep "Matched variants:" \$summary | awk '{print \$3}')
-        SWITCHED=\$(grep "Switched alleles (written to file):" \$summary | awk '{print \$6}')
-        COMPLEMENT=\$(grep "Complementary strand issues:" \$summary | awk '{print \$4}' | head -1)
-        COMPLEMENT_SW=\$(grep "Complement + switch issues:" \$summary | awk '{print \$5}')
-        OTHER=\$(grep "Other inconsistencies:" \$summary | awk '{print \$3}')
-        
-        # Display per-chromosome stats
-        echo "  - Target variants: \${TARGET_VAR:-0}" >> all_chromosomes_summary.txt
-        echo "  - Common variants: \${COMMON_VAR:-0}" >> all_chromosomes_summary.txt
-        echo "  - Matched: \${MATCHED:-0}" >> all_chromosomes_summary.txt
-        echo "  - Switched: \${SWITCHED:-0}" >> all_chromosomes_summary.txt
-        
-        # Add to totals (handle missing values)
-        TOTAL_TARGET_VARIANTS=\$((TOTAL_TARGET_VARIANTS + \${TARGET_VAR:-0}))
-        TOTAL_REF_VARIANTS=\${REF_VAR:-0}  # Use reference from last file (should be same for all)
-        TOTAL_COMMON_VARIANTS=\$((TOTAL_COMMON_VARIANTS + \${COMMON_VAR:-0}))
-        TOTAL_MATCHED=\$((TOTAL_MATCHED + \${MATCHED:-0}))
-        TOTAL_SWITCHED=\$((TOTAL_SWITCHED + \${SWITCHED:-0}))
-        TOTAL_COMPLEMENT=\$((TOTAL_COMPLEMENT + \${COMPLEMENT:-0}))
-        TOTAL_COMPLEMENT_SWITCH=\$((TOTAL_COMPLEMENT_SWITCH + \${COMPLEMENT_SW:-0}))
-        TOTAL_OTHER=\$((TOTAL_OTHER + \${OTHER:-0}))
-    done
-    
-    # Calculate percentages
-    if [ \$TOTAL_COMMON_VARIANTS -gt 0 ]; then
-        MATCH_PCT=\$(awk "BEGIN {printf \\\"%.2f\\\", \$TOTAL_MATCHED * 100 / \$TOTAL_COMMON_VARIANTS}")
-        SWITCH_PCT=\$(awk "BEGIN {printf \\\"%.2f\\\", \$TOTAL_SWITCHED * 100 / \$TOTAL_COMMON_VARIANTS}")
-    else
-        MATCH_PCT="0.00"
-        SWITCH_PCT="0.00"
-    fi
-    
-    if [ \$TOTAL_TARGET_VARIANTS -gt 0 ]; then
-        TARGET_OVERLAP_PCT=\$(awk "BEGIN {printf \\\"%.2f\\\", \$TOTAL_COMMON_VARIANTS * 100 / \$TOTAL_TARGET_VARIANTS}")
-    else
-        TARGET_OVERLAP_PCT="0.00"
-    fi
-    
-    if [ \$TOTAL_REF_VARIANTS -gt 0 ]; then
-        REF_OVERLAP_PCT=\$(awk "BEGIN {printf \\\"%.2f\\\", \$TOTAL_COMMON_VARIANTS * 100 / \$TOTAL_REF_VARIANTS}")
-    else
-        REF_OVERLAP_PCT="0.00"
-    fi
-    
-    # Output aggregated summary
-    echo "" >> all_chromosomes_summary.txt
-    echo "====================================" >> all_chromosomes_summary.txt
-    echo "AGGREGATED RESULTS (ALL CHROMOSOMES)" >> all_chromosomes_summary.txt
-    echo "====================================" >> all_chromosomes_summary.txt
-    echo "" >> all_chromosomes_summary.txt
-    echo "Total variants in all target VCFs: \$TOTAL_TARGET_VARIANTS" >> all_chromosomes_summary.txt
-    echo "Total variants in reference: \$TOTAL_REF_VARIANTS" >> all_chromosomes_summary.txt
-    echo "Total variants at common positions: \$TOTAL_COMMON_VARIANTS" >> all_chromosomes_summary.txt
-    echo "" >> all_chromosomes_summary.txt
-    echo "Overlap Statistics:" >> all_chromosomes_summary.txt
-    echo "  - Target VCF coverage: \$TOTAL_COMMON_VARIANTS/\$TOTAL_TARGET_VARIANTS (\${TARGET_OVERLAP_PCT}%)" >> all_chromosomes_summary.txt
-    echo "  - Reference coverage: \$TOTAL_COMMON_VARIANTS/\$TOTAL_REF_VARIANTS (\${REF_OVERLAP_PCT}%)" >> all_chromosomes_summary.txt
-    echo "" >> all_chromosomes_summary.txt
-    echo "Allele Comparison Results:" >> all_chromosomes_summary.txt
-    echo "  - Matched variants: \$TOTAL_MATCHED (\${MATCH_PCT}%)" >> all_chromosomes_summary.txt
-    echo "  - Switched alleles: \$TOTAL_SWITCHED (\${SWITCH_PCT}%)" >> all_chromosomes_summary.txt
-    echo "  - Complementary strand issues: \$TOTAL_COMPLEMENT" >> all_chromosomes_summary.txt
-    echo "  - Complement + switch issues: \$TOTAL_COMPLEMENT_SWITCH" >> all_chromosomes_summary.txt
-    echo "  - Other inconsistencies: \$TOTAL_OTHER" >> all_chromosomes_summary.txt
-    echo "" >> all_chromosomes_summary.txt
-    echo "====================================" >> all_chromosomes_summary.txt
-    echo "END OF SUMMARY" >> all_chromosomes_summary.txt
-    echo "====================================" >> all_chromosomes_summary.txt
+    # Merge the per-chromosome metrics records written by check_allele_switch.py --metrics
+    python3 ${projectDir}/bin/aggregate_metrics.py ${metrics_files} \
+        --summary all_chromosomes_summary.txt \
+        --json all_chromosomes_metrics.json
     """
 }
 
@@ -742,16 +786,22 @@ For more information, use: --help
 
     // Extract chromosome information from VCF data (not filenames)
     // The checkIfExists option will automatically fail with clear error if files don't exist
+    // The .tbi next to each VCF travels with it, to be staged by the processes that read through it;
+    // [] stands for no index
     vcf_files_ch = Channel.fromPath(vcfPaths, checkIfExists: true)
+        .map { vcf ->
+            def index = file("${vcf}.tbi")
+            return tuple(vcf, index.exists() ? index : [])
+        }
     EXTRACT_VCF_INFO(vcf_files_ch)
 
-    // Process extracted info and create (chr, vcf_file) tuples
+    // Process extracted info and create (chr, vcf_file, vcf_index, vcf_profile) tuples
     target_vcfs_ch = EXTRACT_VCF_INFO.out.vcf_info
-        .map { chr, vcf_file ->
+        .map { chr, vcf_file, vcf_index, vcf_profile ->
             chr = chr.trim()  // Remove any whitespace
             def build = chr.startsWith('chr') ? 'b38' : 'b37'
             log.info "Detected VCF: ${vcf_file.name} -> chromosome=${chr}, build=${build}"
-            return tuple(chr, vcf_file)
+            return tuple(chr, vcf_file, vcf_index, vcf_profile)
         }
 
     // Validate VCF files before processing
@@ -759,10 +809,10 @@ For more information, use: --help
     
     // Use only files that passed validation for further processing
     validated_vcfs = VALIDATE_VCF_FILES.out.validation_results
-        .map { chr, vcf_file, status_file -> 
+        .map { chr, vcf_file, vcf_index, vcf_profile, status_file -> 
             def status = status_file.text.trim()
             if (status == "PASSED") {
-                return tuple(chr, vcf_file)
+                return tuple(chr, vcf_file, vcf_index, vcf_profile)
             } else {
                 log.warn "Skipping ${chr}: VCF file failed validation (${status})"
                 return null
@@ -808,7 +858,7 @@ Please check:
     def vcf_info_list = []
     def legend_info_list = []
 
-    validated_vcfs.subscribe { chr, vcf ->
+    validated_vcfs.subscribe { chr, vcf, vcf_index, vcf_profile ->
         def build = chr.startsWith('chr') ? 'b38' : 'b37'
         vcf_info_list << [chr: chr, file: vcf.name, build: build]
     }
@@ -820,11 +870,11 @@ Please check:
 
     // Join target VCFs with their matching reference legend files by chromosome
     matched_inputs = validated_vcfs.join(reference_legends_ch, failOnMismatch: false)
-        .filter { it.size() > 2 && it[2] != null } // Filter out entries where no matching legend was found
-        .map { chr, vcf, legend ->
+        .filter { it.size() > 4 && it[4] != null } // Filter out entries where no matching legend was found
+        .map { chr, vcf, vcf_index, vcf_profile, legend ->
             def vcf_build = chr.startsWith('chr') ? 'b38' : 'b37'
             log.info "Matched: VCF ${vcf.name} (${chr}, ${vcf_build}) with legend ${legend.name} (${chr}, ${vcf_build})"
-            return tuple(chr, vcf, legend)
+            return tuple(chr, vcf, vcf_index, vcf_profile, legend)
         }
 
     // Check if we have any matches, if not create a detailed report and exit gracefully
@@ -986,11 +1036,58 @@ Full diagnostic report: ${reportPath}
         }
         .set { matched_inputs_checked }
 
+    // Every pair is sampled first; no check is scheduled until all samples agree with their legends
+    if (params.preflight) {
+        PREFLIGHT(matched_inputs_checked.map { chr, vcf, index, profile, legend -> tuple(chr, vcf, profile, legend) })
+        preflight_gate = PREFLIGHT.out.report
+            .collect()
+            .map { reports ->
+                def failed = reports.collect { new groovy.json.JsonSlurper().parse(it.toFile()) }
+                    .findAll { it.verdict == 'fail' }
+                if (failed) {
+                    preflightFailure(failed)
+                }
+                return true
+            }
+        preflight_inputs = matched_inputs_checked
+            .combine(preflight_gate)
+            .map { chr, vcf, index, profile, legend, passed -> tuple(chr, vcf, index, profile, legend) }
+    } else {
+        preflight_inputs = matched_inputs_checked
+    }
+
+    // Large indexed chromosomes are checked as region shards of about params.shardRecords records
+    preflight_inputs
+        .flatMap { chr, vcf, index, profile, legend ->
+            def count = shardCount(index, profile)
+            if (count == 1) {
+                return [tuple(chr, vcf, index, profile, legend, '')]
+            }
+            (1..count).collect { i -> tuple(groupKey(chr, count), vcf, index, profile, legend, "${i}/${count}") }
+        }
+        .branch {
+            sharded: it[5]
+            whole: true
+        }
+        .set { check_inputs }
+
     // Run allele switch checking for each matched pair
-    CHECK_ALLELE_SWITCH(matched_inputs_checked)
+    CHECK_ALLELE_SWITCH(check_inputs.whole.map { chr, vcf, index, profile, legend, shard -> tuple(chr, vcf, index, profile, legend) })
+
+    CHECK_SHARD(check_inputs.sharded)
+    MERGE_SHARDS(
+        CHECK_SHARD.out.shard
+            .groupTuple()
+            .map { key, vcfs, indexes, legends, dirs -> tuple(key.getGroupTarget(), vcfs[0], indexes[0], legends[0], dirs.sort { it.name }) }
+    )
+
+    // Whole and merged sharded chromosomes feed the same downstream steps
+    switch_results = CHECK_ALLELE_SWITCH.out.switch_results.mix(MERGE_SHARDS.out.switch_results)
+    verify_inputs = CHECK_ALLELE_SWITCH.out.verify_inputs.mix(MERGE_SHARDS.out.verify_inputs)
 
     // Check if any build mismatches were detected
     CHECK_ALLELE_SWITCH.out.build_mismatch
+        .mix(MERGE_SHARDS.out.build_mismatch)
         .collect()
         .ifEmpty([])
         .map { files -> 
@@ -1003,11 +1100,10 @@ Full diagnostic report: ${reportPath}
 
     // Create fixed VCFs using the specified method (only if no build mismatch)
     if (params.fixMethod == 'correct') {
-        // Fix VCF by correcting allele switches
-        CORRECT_SWITCHED_SITES(CHECK_ALLELE_SWITCH.out.switch_results)
-        
+        // Corrected VCFs come straight out of CHECK_ALLELE_SWITCH or MERGE_SHARDS
         // Collect correction stats for reporting
-        CORRECT_SWITCHED_SITES.out.correction_stats
+        CHECK_ALLELE_SWITCH.out.correction_stats
+            .mix(MERGE_SHARDS.out.correction_stats)
             .collectFile(name: 'correction_stats.txt', storeDir: "${params.logs}") { chr, fixed, failed ->
                 def fixedCount = fixed.text.trim()
                 def failedCount = failed.text.trim()
@@ -1015,24 +1111,28 @@ Full diagnostic report: ${reportPath}
             }
         
         // Verify the corrections by re-checking the corrected VCF
-        verification_input = CORRECT_SWITCHED_SITES.out.fixed_vcf
-            .join(matched_inputs.map { chr, vcf, legend -> tuple(chr, legend) })
+        verification_input = CHECK_ALLELE_SWITCH.out.corrected_vcf
+            .mix(MERGE_SHARDS.out.corrected_vcf)
+            .join(verify_inputs)
         
         VERIFY_CORRECTIONS(verification_input)
         
     } else {
         // Fix VCF by removing positions with allele switches (default)
-        REMOVE_SWITCHED_SITES(CHECK_ALLELE_SWITCH.out.switch_results)
+        // The block-copy fixer reads the target through its index, which rejoins it here
+        REMOVE_SWITCHED_SITES(
+            switch_results.join(preflight_inputs.map { chr, vcf, index, profile, legend -> tuple(chr, index) })
+        )
         
         // Verify the removal by re-checking the cleaned VCF
         verification_input = REMOVE_SWITCHED_SITES.out.fixed_vcf
-            .join(matched_inputs.map { chr, vcf, legend -> tuple(chr, legend) })
+            .join(verify_inputs)
         
         VERIFY_CORRECTIONS(verification_input)
     }
     
     // Create a summary of all processed chromosomes
-    CREATE_SUMMARY(CHECK_ALLELE_SWITCH.out.summary.collect())
+    CREATE_SUMMARY(CHECK_ALLELE_SWITCH.out.metrics.mix(MERGE_SHARDS.out.metrics).collect())
 }
 
 // Safety net: if the pipeline crashes anywhere *before* reaching the